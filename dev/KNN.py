@@ -10,6 +10,10 @@ class KNN():
         
         self.first_time = True
 
+    @property
+    def nb_determinant(self):
+        return self.__nb_determinant
+
     """
     Méthode permettant d'ajouter des points aux données d'entrainement du KNN
 
@@ -17,6 +21,41 @@ class KNN():
     """
     def add_point(self, new_point):
         mat = self.__process_list(new_point)
+        self.__append(mat)
+
+    """
+    Méthode permettant d'ajouter plusieurs points d'un coup aux données d'entrainement du KNN
+
+    :parm categories: Une liste python contenant la catégorie de chaque point
+    :parm determinants: Une matrice numpy (N, n) contenant les n déterminants de chaque point
+    """
+    def add_points(self, categories, determinants):
+        if len(categories) == 0:
+            return
+        determinants = np.asarray(determinants, dtype=np.float16).reshape(len(categories), -1)
+        if determinants.shape[1] != self.__nb_determinant:
+            raise ValueError("Le nombre de colonnes dans les nouvelles lignes ne correspond pas aux données contenu dans _data.")
+
+        for category in categories:
+            if category not in self.category:
+                self.category.append(category)
+        indices = np.array([self.category.index(category) for category in categories], dtype=np.float16)
+
+        self.__append(np.column_stack((indices, determinants)))
+
+    """
+    Méthode permettant de retirer des points des données d'entrainement du KNN
+
+    :parm indices: Les indices (rangées de data) des points à retirer
+    """
+    def remove_points(self, indices):
+        self.data = np.delete(self.data, np.asarray(indices, dtype=np.intp), axis=0)
+
+    # Après une première classification, self.data contient aussi la colonne des distances,
+    # recalculée à chaque classification : les nouveaux points y reçoivent une distance nulle
+    def __append(self, mat):
+        if not self.first_time:
+            mat = np.hstack((mat, np.zeros((mat.shape[0], 1), dtype=np.float16)))
         self.data = np.vstack((self.data, mat))
 
     def __process_list(self, list):
@@ -1,7 +1,10 @@
+import argparse
+import os
 import sys
 
 from db_credential import PostgreSQLCredential
-from klustr_dao import PostgreSQLKlustRDAO
+from klustr_dao import CachedKlustRDAO, InstrumentedKlustRDAO, PooledKlustRDAO
+from sqlite_klustr_dao import SQLiteKlustRDAO
 from widgets.classification_widget import ClassificationWidget
 from widgets.klustr_widget import KlustRDataSourceViewWidget
 
@@ -10,20 +13,34 @@ from __feature__ import snake_case, true_property
 
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description='Visualisation et classification des données klustR.')
+    parser.add_argument('--replica', nargs='?', const=SQLiteKlustRDAO.DEFAULT_PATH,
+                        default=os.environ.get('KLUSTR_REPLICA'),
+                        help='copie locale SQLite (voir klustr_sync) lue au lieu du serveur PostgreSQL')
+    # les autres arguments sont ceux de Qt
+    args, qt_arguments = parser.parse_known_args()
+
+    app = QApplication([sys.argv[0], *qt_arguments])
     tabs = QTabWidget()
-    credential = PostgreSQLCredential(
-                      host='localhost', 
-                      port=5432, 
-                      database='postgres', 
-                      user='postgres', 
-                      password='AAAaaa123')
-    klustr_dao = PostgreSQLKlustRDAO(credential)
+    if args.replica:
+        source_dao = SQLiteKlustRDAO(args.replica)
+    else:
+        credential = PostgreSQLCredential(
+                          host='localhost', 
+                          port=5432, 
+                          database='postgres', 
+                          user='postgres', 
+                          password='AAAaaa123')
+        source_dao = PooledKlustRDAO(credential)
+    # un seul DAO, partagé par tous les onglets ; ses statistiques sont écrites à la fermeture
+    klustr_dao = InstrumentedKlustRDAO(CachedKlustRDAO(source_dao))
+    stats_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klustr_dao_stats.json')
+    app.aboutToQuit.connect(lambda: klustr_dao.query_stats.dump(stats_path))
 
     source_data_widget = KlustRDataSourceViewWidget(klustr_dao)
 
     tabs.add_tab(source_data_widget,"klustR Viewer")
-    tabs.add_tab(ClassificationWidget(credential),"Classification")
+    tabs.add_tab(ClassificationWidget(klustr_dao),"Classification")
     
     tabs.show()
 
@@ -0,0 +1,187 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import threading
+
+from PySide6.QtCore import QCoreApplication, QObject, Signal, Slot
+from __feature__ import snake_case, true_property
+
+
+def run_request(klustr_dao, request, args=(), filters=None):
+    """Exécute une requête du DAO, avec ses propres filtres de transformation.
+
+    Les filtres sont passés explicitement à la requête (argument filters des
+    méthodes filtrées du DAO) : les filtres du DAO, partagés par tous les fils
+    de travail, ne sont pas modifiés et les requêtes restent concurrentes.
+
+    Args:
+        klustr_dao (KlustRDAO): DAO interrogé
+        request (str | callable): nom d'une méthode ou d'une propriété du DAO,
+        ou fonction appelée avec le DAO puis args (et filters=filters, si des filtres sont donnés)
+        args (tuple): arguments de la méthode
+        filters (tuple): filtres (translated, rotated, scaled, exclusive), ou None pour ceux du DAO
+
+    Returns:
+        résultat de la requête
+    """
+    kwargs = {} if filters is None else {'filters': tuple(filters)}
+    if callable(request):
+        return request(klustr_dao, *args, **kwargs)
+    attribute = getattr(klustr_dao, request)
+    return attribute(*args, **kwargs) if callable(attribute) else attribute
+
+
+class AsyncKlustRDAO(QObject):
+    """Appels d'un KlustRDAO dans des fils de travail, résultats remis au fil de Qt.
+
+    Chaque requête est associée à un canal (ex. 'labels', 'images') : une
+    nouvelle requête sur un canal annule la précédente. Une requête qui n'a
+    pas encore commencé n'est jamais exécutée ; le résultat d'une requête
+    déjà commencée est ignoré. Les fonctions de rappel sont toujours appelées
+    dans le fil de l'interface, et seulement pour la dernière requête du canal.
+
+    Le DAO décoré doit pouvoir être utilisé par plusieurs fils d'exécution
+    (ex. PooledKlustRDAO, ou CachedKlustRDAO devant un PooledKlustRDAO). Les
+    filtres de transformation du DAO étant partagés par tous ses utilisateurs,
+    une requête filtrée reçoit les siens en argument (filters, voir run_request).
+    """
+
+    # fonction à exécuter dans le fil de l'interface (connexion en file d'attente depuis les fils de travail)
+    _delivered = Signal(object)
+
+    def __init__(self, klustr_dao, max_workers=2, parent=None):
+        super().__init__(parent)
+        self._dao = klustr_dao
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='klustr_dao')
+        self._latest = {}
+        self._delivered.connect(self.__deliver)
+        # un parcours en cours retiendrait l'application à sa fermeture
+        if QCoreApplication.instance() is not None:
+            QCoreApplication.instance().aboutToQuit.connect(self.shutdown)
+
+    @property
+    def dao(self):
+        return self._dao
+
+    def call(self, channel, request, *args, callback=None, error_callback=None, filters=None):
+        """Exécute une requête dans un fil de travail.
+
+        Args:
+            channel (str): canal de la requête
+            request (str | callable): nom d'une méthode ou d'une propriété du DAO,
+            ou fonction appelée avec le DAO puis args
+            args: arguments de la méthode
+            callback (callable): appelée avec le résultat, dans le fil de l'interface
+            error_callback (callable): appelée avec l'exception, dans le fil de l'interface
+            filters (tuple): filtres de transformation (translated, rotated, scaled, exclusive) de la requête
+
+        Returns:
+            concurrent.futures.Future: résultat de la requête
+        """
+        token = self.__replace(channel)
+        future = self._executor.submit(run_request, self._dao, request, args, filters)
+        self._latest[channel] = (token, future)
+        future.add_done_callback(
+            lambda done: self._delivered.emit(partial(self.__finish, channel, token, done, callback, error_callback)))
+        return future
+
+    def iterate(self, channel, request, *args, item_callback=None, done_callback=None, error_callback=None,
+                filters=None, max_pending=2):
+        """Parcourt un itérateur dans un fil de travail et remet chaque élément au fil de l'interface.
+
+        Le fil de travail attend que l'interface ait traité les éléments déjà
+        remis lorsque max_pending éléments sont en attente.
+
+        Args:
+            channel (str): canal de la requête
+            request (str | callable): méthode du DAO, ou fonction appelée avec le DAO puis args,
+            qui retourne un itérable (ex. 'iter_image_from_dataset')
+            args: arguments de la méthode
+            item_callback (callable): appelée avec chaque élément, dans le fil de l'interface
+            done_callback (callable): appelée sans argument à la fin du parcours
+            error_callback (callable): appelée avec l'exception, dans le fil de l'interface
+            filters (tuple): filtres de transformation (translated, rotated, scaled, exclusive) de la requête
+            max_pending (int): nombre maximal d'éléments remis mais pas encore traités
+
+        Returns:
+            concurrent.futures.Future: fin du parcours
+        """
+        token = self.__replace(channel)
+        pending = threading.Semaphore(max_pending)
+
+        def run():
+            iterator = iter(run_request(self._dao, request, args, filters))
+            try:
+                for item in iterator:
+                    # attend que l'interface traite les éléments remis, ou que la requête soit annulée
+                    while not pending.acquire(timeout=0.1):
+                        if not self.__is_latest(channel, token):
+                            return
+                    if not self.__is_latest(channel, token):
+                        break
+                    self._delivered.emit(partial(self.__deliver_item, channel, token, item, item_callback, pending))
+            finally:
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+
+        future = self._executor.submit(run)
+        self._latest[channel] = (token, future)
+        future.add_done_callback(
+            lambda done: self._delivered.emit(partial(self.__finish, channel, token, done,
+                                                      done_callback and (lambda _: done_callback()),
+                                                      error_callback)))
+        return future
+
+    def is_busy(self, ignored_channels=()):
+        """Indique si une requête est en cours sur un canal autre que ignored_channels"""
+        return any(channel not in ignored_channels for channel in list(self._latest))
+
+    def cancel(self, channel=None):
+        """Annule la requête en cours d'un canal, ou de tous les canaux"""
+        for name in [channel] if channel is not None else list(self._latest):
+            latest = self._latest.pop(name, None)
+            if latest is not None and latest[1] is not None:
+                latest[1].cancel()
+
+    def shutdown(self):
+        """Annule toutes les requêtes ; celles qui sont déjà commencées se terminent sans être remises"""
+        self.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __replace(self, channel):
+        # le jeton est enregistré avant le lancement de la requête : le fil de travail peut le vérifier aussitôt
+        self.cancel(channel)
+        token = object()
+        self._latest[channel] = (token, None)
+        return token
+
+    def __is_latest(self, channel, token):
+        latest = self._latest.get(channel)
+        return latest is not None and latest[0] is token
+
+    @Slot(object)
+    def __deliver(self, function):
+        function()
+
+    def __deliver_item(self, channel, token, item, item_callback, pending):
+        try:
+            if self.__is_latest(channel, token) and item_callback is not None:
+                item_callback(item)
+        finally:
+            pending.release()
+
+    def __finish(self, channel, token, future, callback, error_callback):
+        if future.cancelled() or not self.__is_latest(channel, token):
+            return
+        del self._latest[channel]
+        error = future.exception()
+        if error is not None:
+            if error_callback is not None:
+                error_callback(error)
+            else:
+                print(f'AsyncKlustRDAO : erreur de la requete du canal {channel} :')
+                print('-' * 80)
+                print(type(error))
+                print(error)
+                print('-' * 80)
+        elif callback is not None:
+            callback(future.result())
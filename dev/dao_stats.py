@@ -0,0 +1,169 @@
+import bisect
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+
+logger = logging.getLogger('klustr.dao')
+
+
+class QueryStats:
+    """Statistiques des requêtes d'un KlustRDAO, par méthode ou par requête SQL.
+
+    Pour chaque nom (ex. 'labels_from_dataset', ou 'sql:labels_from_dataset' pour sa requête SQL),
+    garde le nombre d'appels et d'erreurs, la durée totale et maximale, un
+    histogramme des durées (LATENCY_BUCKETS), le nombre de rangées et les
+    octets d'images (PNG) retournés.
+
+    Une requête qui dure au moins slow_threshold secondes est inscrite au
+    journal 'klustr.dao' (logging.WARNING) avec son détail (ex. la requête SQL).
+
+    Utilisée par InstrumentedKlustRDAO et PostgreSQLKlustRDAO.query_stats.
+    """
+
+    # bornes supérieures des classes de l'histogramme, en secondes (la dernière classe est au-delà)
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.)
+    DEFAULT_SLOW_THRESHOLD = 0.5
+
+    def __init__(self, slow_threshold=DEFAULT_SLOW_THRESHOLD, slow_log_size=100):
+        self._slow_threshold = slow_threshold
+        self._slow_log_size = slow_log_size
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._methods = {}
+        self._slow_queries = []
+
+    @property
+    def slow_threshold(self):
+        return self._slow_threshold
+
+    @slow_threshold.setter
+    def slow_threshold(self, value):
+        self._slow_threshold = value
+
+    @staticmethod
+    def payload_size(rows):
+        """Retourne le nombre d'octets des données binaires (images) des rangées"""
+        if isinstance(rows, np.ndarray):
+            return rows.nbytes
+        if not isinstance(rows, (list, tuple)):
+            return 0
+        return sum(len(value) if isinstance(value, bytes) else value.nbytes
+                   for row in rows if isinstance(row, (list, tuple))
+                   for value in row if isinstance(value, (bytes, memoryview)))
+
+    def record(self, name, seconds, rows=None, blob_bytes=0, failed=False, detail=None):
+        """Ajoute un appel aux statistiques de name.
+
+        Args:
+            name (str): méthode ou requête
+            seconds (float): durée de l'appel
+            rows (int): nombre de rangées retournées, ou None
+            blob_bytes (int): octets d'images retournés
+            failed (bool): l'appel a échoué
+            detail (str): précision pour le journal des requêtes lentes (ex. la requête SQL)
+        """
+        with self._lock:
+            stats = self._methods.get(name)
+            if stats is None:
+                stats = self._methods[name] = {'calls': 0, 'errors': 0, 'total_seconds': 0., 'max_seconds': 0.,
+                                               'rows': 0, 'blob_bytes': 0,
+                                               'histogram': [0] * (len(self.LATENCY_BUCKETS) + 1)}
+            stats['calls'] += 1
+            stats['errors'] += bool(failed)
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['rows'] += rows or 0
+            stats['blob_bytes'] += blob_bytes
+            stats['histogram'][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+            slow = self._slow_threshold is not None and seconds >= self._slow_threshold
+            if slow:
+                self._slow_queries.append({'name': name, 'seconds': seconds, 'rows': rows, 'time': time.time(),
+                                           'detail': detail})
+                del self._slow_queries[:-self._slow_log_size]
+
+        if slow:
+            logger.warning('requête lente : %s (%.3f s, %s rangées)%s',
+                           name, seconds, rows, f'\n{detail}' if detail else '')
+
+    def measure(self, name, call, detail=None):
+        """Appelle call() et ajoute sa durée, ses rangées et ses octets d'images aux statistiques de name.
+
+        Un résultat None (le DAO a affiché une erreur) compte comme une erreur.
+        """
+        started = time.perf_counter()
+        try:
+            result = call()
+        except Exception:
+            self.record(name, time.perf_counter() - started, failed=True, detail=detail)
+            raise
+        self.record(name, time.perf_counter() - started,
+                    len(result) if isinstance(result, (list, tuple, np.ndarray)) else None,
+                    self.payload_size(result), result is None, detail)
+        return result
+
+    def measure_iterator(self, name, iterator, detail=None):
+        """Parcourt iterator et ajoute ses statistiques à name à la fin du parcours.
+
+        Seul le temps passé à obtenir les rangées est compté, pas celui passé
+        à les traiter.
+        """
+        seconds, rows, blob_bytes, failed = 0., 0, 0, False
+        iterator = iter(iterator)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    row = next(iterator)
+                except StopIteration:
+                    break
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    seconds += time.perf_counter() - started
+                rows += 1
+                blob_bytes += self.payload_size((row,))
+                yield row
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            self.record(name, seconds, rows, blob_bytes, failed, detail)
+
+    def reset(self):
+        with self._lock:
+            self._started = time.time()
+            self._methods.clear()
+            self._slow_queries.clear()
+
+    @property
+    def stats(self):
+        """Retourne un dictionnaire nom -> statistiques, du plus long au plus court en durée totale"""
+        with self._lock:
+            methods = {name: {**stats, 'histogram': list(stats['histogram'])} for name, stats in self._methods.items()}
+        for stats in methods.values():
+            stats['mean_seconds'] = stats['total_seconds'] / stats['calls']
+        return dict(sorted(methods.items(), key=lambda item: item[1]['total_seconds'], reverse=True))
+
+    @property
+    def slow_queries(self):
+        with self._lock:
+            return list(self._slow_queries)
+
+    def report(self):
+        """Retourne le rapport complet (statistiques et requêtes lentes), sérialisable en JSON"""
+        return {'started': self._started,
+                'elapsed_seconds': time.time() - self._started,
+                'slow_threshold': self._slow_threshold,
+                'latency_buckets': list(self.LATENCY_BUCKETS),
+                'methods': self.stats,
+                'slow_queries': self.slow_queries}
+
+    def dump(self, path):
+        """Écrit le rapport (voir report) dans un fichier JSON"""
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(), file, indent=2, ensure_ascii=False)
@@ -0,0 +1,103 @@
+from feature_ingest import FeatureIngest
+from KNN import KNN
+
+
+class DatasetDelta:
+    """Images ajoutées, retirées et modifiées depuis la synchronisation précédente."""
+
+    def __init__(self, added, removed, changed, failures=()):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+        self.failures = list(failures)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return (f'DatasetDelta(added={len(self.added)}, removed={len(self.removed)}, '
+                f'changed={len(self.changed)}, failures={len(self.failures)})')
+
+
+class DatasetSync:
+    """Garde un KNN à jour avec les images d'entrainement d'un jeu de données.
+
+    À chaque refresh, les empreintes des images (KlustRDAO.image_checksums_from_dataset,
+    calculées par la base de données) sont comparées à celles de la synchronisation
+    précédente : seules les images ajoutées ou modifiées sont transférées et
+    leurs déterminants calculés, et les points des images retirées ou modifiées
+    sont retirés du KNN et du cache des déterminants. Le coût d'un refresh
+    dépend donc du nombre d'images changées, et non de la taille du jeu de données.
+
+    Une image dont l'extraction a échoué (ou introuvable au moment du
+    transfert) n'est pas retenue dans les empreintes : le refresh suivant la
+    traite de nouveau comme ajoutée.
+    """
+
+    def __init__(self, klustr_dao, dataset_name, knn: KNN, ingest: FeatureIngest, training_image=True):
+        self._dao = klustr_dao
+        self._dataset_name = dataset_name
+        self._training_image = training_image
+        self._knn = knn
+        self._ingest = ingest
+        self._checksums = {}
+        # image_id du point de chaque rangée de knn.data
+        self._image_ids = []
+
+    @property
+    def knn(self):
+        return self._knn
+
+    @property
+    def image_ids(self):
+        return self._image_ids
+
+    def refresh(self) -> DatasetDelta:
+        """Synchronise le KNN avec le jeu de données.
+
+        Returns:
+            DatasetDelta: images ajoutées, retirées, modifiées et échecs d'extraction
+        """
+        rows = self._dao.image_checksums_from_dataset(self._dataset_name, self._training_image)
+        if rows is None:
+            raise ConnectionError(f"empreintes du jeu de données {self._dataset_name} indisponibles")
+
+        checksums = {image_id: checksum for image_id, _, checksum in rows}
+        labels = {image_id: label_id for image_id, label_id, _ in rows}
+        added = checksums.keys() - self._checksums.keys()
+        removed = self._checksums.keys() - checksums.keys()
+        changed = {image_id for image_id in checksums.keys() & self._checksums.keys()
+                   if checksums[image_id] != self._checksums[image_id]}
+
+        stale = removed | changed
+        if stale:
+            self._knn.remove_points([i for i, image_id in enumerate(self._image_ids) if image_id in stale])
+            self._image_ids = [image_id for image_id in self._image_ids if image_id not in stale]
+            if self._ingest.cache is not None:
+                self._ingest.cache.remove_images(stale)
+
+        failures = []
+        wanted = added | changed
+        if wanted:
+            # une requête par étiquette, avec seulement les PNG (voir KlustRDAO.images_by_ids)
+            by_label = {}
+            for image_id in wanted:
+                by_label.setdefault(labels[image_id], []).append(image_id)
+            images = []
+            for label_id, image_ids in by_label.items():
+                found = self._dao.images_by_ids(label_id, sorted(image_ids), (self._dao.IMAGE_COLUMN,))
+                if found is None:
+                    raise ConnectionError(f"images de l'étiquette {label_id} indisponibles")
+                images += found
+
+            result = self._ingest.run(images)
+            self._knn.add_points(result.labels, result.features)
+            self._image_ids += result.image_ids
+            failures = result.failures
+
+            # réessayées au prochain refresh
+            for image_id in wanted - set(result.image_ids):
+                del checksums[image_id]
+
+        self._checksums = checksums
+        return DatasetDelta(added, removed, changed, failures)
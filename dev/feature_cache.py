@@ -0,0 +1,185 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+
+class FeatureCache:
+    """Cache sur disque (SQLite) des déterminants d'images.
+
+    Une entrée est identifiée par l'image_id, une empreinte du contenu PNG et
+    la version de l'extracteur (ImageProcessor.EXTRACTOR_VERSION) : une image
+    modifiée ou un changement de calcul des déterminants invalide donc
+    automatiquement l'entrée.
+
+    Les empreintes de forme (voir ShapeHash) ne dépendent que du contenu PNG
+    et sont gardées dans une table à part, commune à toutes les versions.
+    Les déterminants sont aussi gardés par empreinte exacte de la forme et
+    par version : une forme déjà vue (autre image, autre jeu de données)
+    n'est pas recalculée (voir FeatureIngest).
+
+    Le cache peut être partagé entre fils d'exécution (ex. l'interface et
+    l'extraction des déterminants de AsyncKlustRDAO) : une seule connexion,
+    protégée par un verrou, comme SQLiteKlustRDAO.
+    """
+
+    DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klustr_features.sqlite')
+
+    def __init__(self, extractor_version, path=DEFAULT_PATH):
+        self._extractor_version = extractor_version
+        self._path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS feature (
+                                        image_id INTEGER NOT NULL,
+                                        content_hash BLOB NOT NULL,
+                                        extractor_version TEXT NOT NULL,
+                                        features BLOB NOT NULL,
+                                        PRIMARY KEY (image_id, content_hash, extractor_version));''')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS shape_hash (
+                                        image_id INTEGER NOT NULL,
+                                        content_hash BLOB NOT NULL,
+                                        exact BLOB NOT NULL,
+                                        perceptual BLOB NOT NULL,
+                                        PRIMARY KEY (image_id, content_hash));''')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS shape_feature (
+                                        exact BLOB NOT NULL,
+                                        extractor_version TEXT NOT NULL,
+                                        features BLOB NOT NULL,
+                                        PRIMARY KEY (exact, extractor_version));''')
+        self._connection.commit()
+
+    @property
+    def extractor_version(self):
+        return self._extractor_version
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def content_hash(png):
+        """Retourne l'empreinte (16 octets) du contenu PNG"""
+        return hashlib.blake2b(png, digest_size=16).digest()
+
+    def get(self, image_id, content_hash):
+        """Retourne les déterminants en cache ou None"""
+        with self._lock:
+            row = self._connection.execute(
+                '''SELECT features FROM feature
+                   WHERE image_id = ? AND content_hash = ? AND extractor_version = ?;''',
+                (image_id, content_hash, self._extractor_version)).fetchone()
+        return None if row is None else np.frombuffer(row[0], dtype=np.float64)
+
+    def get_many(self, keys):
+        """Retourne un dictionnaire (image_id, content_hash) -> déterminants pour les clés en cache.
+
+        Args:
+            keys (list[tuple[int, bytes]]): clés (image_id, content_hash) recherchées
+        """
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            ids = [image_id for image_id, _ in chunk]
+            with self._lock:
+                rows = self._connection.execute(
+                            f'''SELECT image_id, content_hash, features FROM feature
+                                WHERE extractor_version = ? AND image_id IN ({', '.join('?' * len(ids))});''',
+                            (self._extractor_version, *ids)).fetchall()
+            wanted = set(chunk)
+            for image_id, content_hash, features in rows:
+                if (image_id, content_hash) in wanted:
+                    found[(image_id, content_hash)] = np.frombuffer(features, dtype=np.float64)
+        return found
+
+    def put_many(self, entries):
+        """Ajoute ou remplace des déterminants.
+
+        Args:
+            entries (list[tuple[int, bytes, np.ndarray]]): (image_id, content_hash, déterminants)
+        """
+        rows = [(image_id, content_hash, self._extractor_version, np.asarray(features, dtype=np.float64).tobytes())
+                for image_id, content_hash, features in entries]
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO feature VALUES (?, ?, ?, ?);', rows)
+
+    def get_shape_hashes(self, keys):
+        """Retourne un dictionnaire (image_id, content_hash) -> (empreinte exacte, empreinte perceptuelle)
+
+        Args:
+            keys (list[tuple[int, bytes]]): clés (image_id, content_hash) recherchées
+        """
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            ids = [image_id for image_id, _ in chunk]
+            with self._lock:
+                rows = self._connection.execute(
+                            f'''SELECT image_id, content_hash, exact, perceptual FROM shape_hash
+                                WHERE image_id IN ({', '.join('?' * len(ids))});''',
+                            ids).fetchall()
+            wanted = set(chunk)
+            for image_id, content_hash, exact, perceptual in rows:
+                if (image_id, content_hash) in wanted:
+                    found[(image_id, content_hash)] = (exact, int.from_bytes(perceptual, 'big'))
+        return found
+
+    def put_shape_hashes(self, entries):
+        """Ajoute ou remplace des empreintes de forme.
+
+        Args:
+            entries (list[tuple[int, bytes, bytes, int]]): (image_id, content_hash, empreinte exacte,
+            empreinte perceptuelle)
+        """
+        rows = [(image_id, content_hash, exact, perceptual.to_bytes(8, 'big'))
+                for image_id, content_hash, exact, perceptual in entries]
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO shape_hash VALUES (?, ?, ?, ?);', rows)
+
+    def get_shape_features(self, exact_hashes):
+        """Retourne un dictionnaire empreinte exacte -> déterminants pour les formes en cache
+
+        Args:
+            exact_hashes (list[bytes]): empreintes exactes recherchées (voir ShapeHash.exact)
+        """
+        found = {}
+        for start in range(0, len(exact_hashes), 500):
+            chunk = exact_hashes[start:start + 500]
+            with self._lock:
+                rows = self._connection.execute(
+                            f'''SELECT exact, features FROM shape_feature
+                                WHERE extractor_version = ? AND exact IN ({', '.join('?' * len(chunk))});''',
+                            (self._extractor_version, *chunk)).fetchall()
+            for exact, features in rows:
+                found[exact] = np.frombuffer(features, dtype=np.float64)
+        return found
+
+    def put_shape_features(self, entries):
+        """Ajoute ou remplace les déterminants de formes.
+
+        Args:
+            entries (list[tuple[bytes, np.ndarray]]): (empreinte exacte, déterminants)
+        """
+        rows = [(exact, self._extractor_version, np.asarray(features, dtype=np.float64).tobytes())
+                for exact, features in entries]
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO shape_feature VALUES (?, ?, ?);', rows)
+
+    def remove_images(self, image_ids):
+        """Retire les déterminants et les empreintes d'images, pour toutes les versions"""
+        image_ids = list(image_ids)
+        with self._lock, self._connection:
+            for start in range(0, len(image_ids), 500):
+                chunk = image_ids[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                self._connection.execute(f'DELETE FROM feature WHERE image_id IN ({placeholders});', chunk)
+                self._connection.execute(f'DELETE FROM shape_hash WHERE image_id IN ({placeholders});', chunk)
+
+    def put(self, image_id, content_hash, features):
+        self.put_many([(image_id, content_hash, features)])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,362 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import itertools
+import os
+import threading
+
+import numpy as np
+
+from feature_cache import FeatureCache
+from image_processor import ImageProcessor
+from shape_features import FeaturePlan
+from utils.shapehash import ShapeHash
+
+
+class IngestFailure:
+    """Image dont le décodage ou l'extraction des déterminants a échoué."""
+
+    def __init__(self, index, image_id, message):
+        self.index = index
+        self.image_id = image_id
+        self.message = message
+
+    def __repr__(self):
+        return f'IngestFailure(index={self.index}, image_id={self.image_id}, message={self.message!r})'
+
+
+class IngestResult:
+    """Déterminants extraits d'une liste de rangées d'images, prêts pour KNN.add_points.
+
+    Les rangées en échec sont retirées de features, labels, image_ids et
+    des empreintes, et sont décrites dans failures. reused compte les images
+    dont les déterminants ont été repris d'une forme identique.
+    """
+
+    def __init__(self, features, labels, image_ids, failures, shape_hashes, perceptual_hashes, reused=0):
+        self.features = features
+        self.labels = labels
+        self.image_ids = image_ids
+        self.failures = failures
+        self.shape_hashes = shape_hashes
+        self.perceptual_hashes = perceptual_hashes
+        self.reused = reused
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def concatenate(results, feature_count):
+        """Regroupe les résultats successifs de FeatureIngest.stream en un seul résultat"""
+        return IngestResult(np.vstack([result.features for result in results] + [np.empty((0, feature_count))]),
+                            [label for result in results for label in result.labels],
+                            [image_id for result in results for image_id in result.image_ids],
+                            [failure for result in results for failure in result.failures],
+                            [h for result in results for h in result.shape_hashes],
+                            [h for result in results for h in result.perceptual_hashes],
+                            sum(result.reused for result in results))
+
+    def near_duplicates(self, max_distance=ShapeHash.NEAR_DISTANCE):
+        """Retourne les groupes d'image_ids dont les formes sont presque identiques (voir ShapeHash.clusters)"""
+        return [[self.image_ids[i] for i in group]
+                for group in ShapeHash.clusters(self.perceptual_hashes, max_distance)]
+
+    def deduplicated(self):
+        """Retourne le résultat sans les images dont la forme et l'étiquette répètent une image précédente"""
+        seen = set()
+        keep = []
+        for i, key in enumerate(zip(self.labels, self.shape_hashes)):
+            if key not in seen:
+                seen.add(key)
+                keep.append(i)
+        return IngestResult(self.features[keep],
+                            [self.labels[i] for i in keep],
+                            [self.image_ids[i] for i in keep],
+                            self.failures,
+                            [self.shape_hashes[i] for i in keep],
+                            [self.perceptual_hashes[i] for i in keep],
+                            self.reused)
+
+
+class _ShapeMemory:
+    """Déterminants des formes déjà vues par un processus, par empreinte exacte.
+
+    Les formes absentes de la mémoire sont cherchées dans la table
+    shape_feature du FeatureCache, avec une connexion propre au processus.
+    Une seule mémoire par (version de l'extracteur, fichier du cache) et par
+    processus (voir of) : elle sert à tous les paquets qu'il traite. Un
+    processus créé par fork n'hérite pas des mémoires de son parent : la
+    connexion SQLite et les verrous ne peuvent pas traverser un fork.
+    """
+
+    _memories = {}
+    _memories_lock = threading.Lock()
+
+    def __init__(self, extractor_version, cache_path=None):
+        self._features = {}
+        self._cache = FeatureCache(extractor_version, cache_path) if cache_path is not None else None
+
+    @staticmethod
+    def of(extractor_version, cache_path):
+        with _ShapeMemory._memories_lock:
+            key = (extractor_version, cache_path)
+            memory = _ShapeMemory._memories.get(key)
+            if memory is None:
+                memory = _ShapeMemory._memories[key] = _ShapeMemory(extractor_version, cache_path)
+            return memory
+
+    @staticmethod
+    def forget():
+        # nouveau registre, sans les connexions ni les verrous (peut-être pris) du parent
+        _ShapeMemory._memories = {}
+        _ShapeMemory._memories_lock = threading.Lock()
+
+    def get_many(self, exact_hashes):
+        """Retourne un dictionnaire empreinte exacte -> déterminants des formes connues"""
+        found = {exact: self._features[exact] for exact in exact_hashes if exact in self._features}
+        missing = [exact for exact in exact_hashes if exact not in found]
+        if missing and self._cache is not None:
+            stored = self._cache.get_shape_features(missing)
+            self._features.update(stored)
+            found.update(stored)
+        return found
+
+    def put_many(self, features):
+        self._features.update(features)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_ShapeMemory.forget)
+
+
+def _extract_chunk(feature_names, target_resolution, downsampling, extractor_version, cache_path, chunk):
+    """Décode et extrait les déterminants d'un paquet de (index, png ou forme compactée).
+
+    Exécutée dans les processus du pool, sans PySide6 : retourne la liste des
+    index réussis, leurs déterminants, leurs empreintes (exacte, perceptuelle),
+    la liste des (index, message) en échec, le nombre d'images dont les
+    déterminants ont été repris d'une forme identique et les
+    (empreinte exacte, déterminants) des formes calculées ici.
+
+    Une forme déjà vue par le processus, dans ce paquet ou un autre, ou
+    gardée dans le cache (voir _ShapeMemory), n'est pas recalculée.
+    """
+    plan = FeaturePlan(feature_names)
+    indices, masks, hashes, failures = [], [], [], []
+    for index, data in chunk:
+        try:
+            mask = ImageProcessor.mask_from_data(data)
+            hashes.append((ShapeHash.exact(mask), ShapeHash.perceptual(mask)))
+            masks.append(mask)
+            indices.append(index)
+        except Exception as error:
+            failures.append((index, f'{type(error).__name__}: {error}'))
+
+    # une seule extraction par forme identique (à une translation près), et aucune pour les formes connues
+    unique = {}
+    for i, (exact, _) in enumerate(hashes):
+        unique.setdefault(exact, i)
+    memory = _ShapeMemory.of(extractor_version, cache_path)
+    known = memory.get_many(list(unique))
+    missing = [exact for exact in unique if exact not in known]
+
+    # une forme vide donne des déterminants non finis
+    with np.errstate(divide='ignore', invalid='ignore'):
+        computed = ImageProcessor.get_shapes([masks[unique[exact]] for exact in missing], plan,
+                                             target_resolution, downsampling) \
+            if missing else np.empty((0, len(plan)))
+    computed = {exact: features for exact, features in zip(missing, computed) if np.isfinite(features).all()}
+    memory.put_many(computed)
+
+    shapes = {**known, **computed}
+    features = np.array([shapes.get(exact, np.full(len(plan), np.nan)) for exact, _ in hashes]) \
+        .reshape(len(hashes), len(plan))
+    valid = np.isfinite(features).all(axis=1)
+    failures += [(index, 'aucune forme dans l\'image') for index, ok in zip(indices, valid) if not ok]
+    return ([index for index, ok in zip(indices, valid) if ok], features[valid],
+            [h for h, ok in zip(hashes, valid) if ok], failures, len(hashes) - len(missing), list(computed.items()))
+
+
+class FeatureIngest:
+    """Décodage des PNG et extraction des déterminants en parallèle.
+
+    Les rangées du DAO (voir KlustRDAO.image_from_dataset) sont envoyées par
+    paquets à un pool de processus. L'ordre des rangées est conservé. La
+    colonne de l'image contient un PNG ou une forme compactée à 1 bit par
+    pixel (ex. ImageArchive.rows d'une archive de formes) : seuls ces octets
+    sont transmis aux processus, jamais une matrice décodée.
+
+    Chaque forme est identifiée par ses empreintes (voir ShapeHash) : les
+    déterminants d'une forme déjà vue, dans tout le flux et, avec un
+    FeatureCache, dans les ingestions précédentes (autres images, autres jeux
+    de données), sont repris plutôt que recalculés.
+
+    Avec un FeatureCache, seules les images absentes du cache sont décodées.
+    Sa version doit correspondre au plan et à la résolution (voir
+    ImageProcessor.extractor_version).
+
+    Avec target_resolution, les formes sont réduites avant l'extraction (voir
+    ImageProcessor.reduce_resolution et ImageProcessor.choose_resolution).
+    """
+
+    def __init__(self, max_workers=None, chunk_size=32, cache=None, plan=None,
+                 target_resolution=None, downsampling='majority'):
+        self._max_workers = max_workers
+        self._chunk_size = chunk_size
+        self._cache = cache
+        self._plan = plan or ImageProcessor.DEFAULT_PLAN
+        self._target_resolution = target_resolution
+        self._downsampling = downsampling
+        self._executor = None
+
+    @property
+    def plan(self):
+        return self._plan
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def target_resolution(self):
+        return self._target_resolution
+
+    @property
+    def extractor_version(self):
+        """Version de l'extracteur des déterminants calculés (voir ImageProcessor.extractor_version)"""
+        return ImageProcessor.extractor_version(self._plan, self._target_resolution, self._downsampling)
+
+    def run(self, rows):
+        """Retourne les déterminants des rangées d'images.
+
+        Args:
+            rows (list[tuple]): rangées d'images du DAO (label_name en 1, image_id en 2, png en 6)
+
+        Returns:
+            IngestResult: déterminants, étiquettes, identifiants et échecs
+        """
+        return IngestResult.concatenate(list(self.stream(rows, max_pending=len(rows))), len(self._plan))
+
+    def stream(self, rows, max_pending=None):
+        """Extrait les déterminants au fil des rangées reçues, paquet par paquet.
+
+        Les rangées sont lues de façon paresseuse : au plus max_pending paquets
+        sont en cours d'extraction, et le paquet suivant n'est lu qu'une fois
+        le plus ancien remis à l'appelant. La mémoire utilisée ne dépend donc
+        pas du nombre de rangées, et les premiers paquets peuvent être ajoutés
+        au KNN pendant que les suivants arrivent encore de la base de données.
+
+        Args:
+            rows (iterable[tuple]): rangées d'images du DAO (ex. KlustRDAO.iter_image_from_dataset)
+            max_pending (int): nombre maximal de paquets en cours (2 par processus par défaut)
+
+        Yields:
+            IngestResult: déterminants de chaque paquet, dans l'ordre des rangées
+            (les index des échecs sont ceux des rangées dans tout le flux)
+        """
+        max_pending = max(1, max_pending or 2 * (self._max_workers or os.cpu_count() or 1))
+        chunks = _chunked(rows, self._chunk_size)
+        first = next(chunks, None)
+        if first is None:
+            return
+        second = next(chunks, None)
+        if second is None:
+            # un seul paquet : extrait dans ce processus, les 'buffers' sont passés tels quels au décodeur
+            yield self._collect(self._start(first, 0, in_process=True))
+            return
+
+        pending = deque()
+        offset = 0
+        for chunk in itertools.chain((first, second), chunks):
+            pending.append(self._start(chunk, offset, in_process=False))
+            offset += len(chunk)
+            if len(pending) >= max_pending:
+                yield self._collect(pending.popleft())
+        while pending:
+            yield self._collect(pending.popleft())
+
+    def _start(self, rows, offset, in_process):
+        """Cherche un paquet de rangées dans le cache et lance l'extraction des autres"""
+        batch = _Batch(rows, offset, len(self._plan))
+        missing = range(len(rows))
+        if self._cache is not None:
+            batch.keys = [(row[2], self._cache.content_hash(row[6])) for row in rows]
+            cached = self._cache.get_many(batch.keys)
+            cached_hashes = self._cache.get_shape_hashes(batch.keys)
+            missing = []
+            for i, key in enumerate(batch.keys):
+                if key in cached and key in cached_hashes:
+                    batch.features[i] = cached[key]
+                    batch.hashes[i] = cached_hashes[key]
+                    batch.computed[i] = True
+                else:
+                    missing.append(i)
+
+        if missing:
+            version, path = (self._cache.extractor_version, self._cache.path) if self._cache is not None \
+                else (self.extractor_version, None)
+            extract = partial(_extract_chunk, self._plan.names, self._target_resolution, self._downsampling,
+                              version, path)
+            if in_process:
+                batch.result = extract([(i, rows[i][6]) for i in missing])
+            else:
+                # psycopg2 retourne des memoryview, qui ne peuvent pas être envoyées aux processus
+                batch.result = self._pool().submit(extract, [(i, bytes(rows[i][6])) for i in missing])
+        return batch
+
+    def _collect(self, batch):
+        """Attend la fin de l'extraction d'un paquet et retourne son résultat"""
+        failures = []
+        reused = 0
+        if batch.result is not None:
+            result = batch.result if isinstance(batch.result, tuple) else batch.result.result()
+            chunk_indices, chunk_features, chunk_hashes, chunk_failures, reused, shape_features = result
+            batch.features[chunk_indices] = chunk_features
+            batch.computed[chunk_indices] = True
+            for i, shape_hashes in zip(chunk_indices, chunk_hashes):
+                batch.hashes[i] = shape_hashes
+            failures = [IngestFailure(batch.offset + index, batch.rows[index][2], message)
+                        for index, message in sorted(chunk_failures)]
+            if self._cache is not None:
+                self._cache.put_many([(*batch.keys[i], batch.features[i]) for i in chunk_indices])
+                self._cache.put_shape_hashes([(*batch.keys[i], *batch.hashes[i]) for i in chunk_indices])
+                self._cache.put_shape_features(shape_features)
+
+        indices = np.flatnonzero(batch.computed)
+        return IngestResult(batch.features[indices],
+                            [batch.rows[i][1] for i in indices],
+                            [batch.rows[i][2] for i in indices],
+                            failures,
+                            [batch.hashes[i][0] for i in indices],
+                            [batch.hashes[i][1] for i in indices],
+                            reused)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self._max_workers)
+        return self._executor
+
+
+class _Batch:
+    """Paquet de rangées en cours d'extraction dans FeatureIngest.stream."""
+
+    def __init__(self, rows, offset, feature_count):
+        self.rows = rows
+        self.offset = offset
+        self.features = np.empty((len(rows), feature_count))
+        self.computed = np.zeros(len(rows), dtype=bool)
+        self.hashes = [None] * len(rows)
+        self.keys = None
+        self.result = None
+
+
+def _chunked(rows, size):
+    """Découpe un itérable de rangées en listes d'au plus size rangées, sans le lire d'avance"""
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, size)):
+        yield chunk
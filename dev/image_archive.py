@@ -0,0 +1,298 @@
+'''Archive compacte d'un jeu de données klustR, lue par projection en mémoire (mmap).
+
+Un jeu de données (images d'entrainement et de test) est écrit dans un seul
+fichier : un en-tête JSON, des tableaux NumPy (identifiants, étiquettes,
+dimensions, transformations, noms, index des positions) puis le contenu des
+images, PNG ou formes compactées (PackedShape.to_bytes). ImageArchive projette
+le fichier en mémoire : chaque image est trouvée par son identifiant en temps
+constant et retournée sans copie.
+
+Disposition du fichier :
+
+    MAGIC (8 octets) | longueur de l'en-tête (uint32) | en-tête JSON | sections
+
+Chaque section commence sur un multiple de ALIGNMENT octets ; l'en-tête donne
+sa position, son type et sa forme. Les images se suivent dans la section
+'payload' ; l'image i occupe lengths[i] octets à partir de payload[offsets[i]]
+(chaque image commence sur un multiple de 8 octets).
+
+    python image_archive.py --password AAAaaa123 --dataset "ABC" --output abc.klustr
+    python image_archive.py --password AAAaaa123 --dataset "ABC" --payload mask
+'''
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from png_decoder import mask_from_png
+from utils.packedshape import PackedShape
+
+
+MAGIC = b'KLUSTRAR'
+VERSION = 1
+ALIGNMENT = 64
+HEADER_LENGTH_DTYPE = np.dtype('<u4')
+
+# contenu des images de l'archive
+PNG_PAYLOAD = 'png'
+MASK_PAYLOAD = 'mask'
+
+
+def _align(position, alignment=ALIGNMENT):
+    return -(-position // alignment) * alignment
+
+
+def _payload(png, payload):
+    png = png if isinstance(png, bytes) else bytes(png)
+    if payload == MASK_PAYLOAD:
+        return PackedShape.from_array(mask_from_png(png)).to_bytes()
+    return png
+
+
+def export_dataset(klustr_dao, dataset_name, path, payload=PNG_PAYLOAD):
+    """Écrit toutes les images d'un jeu de données dans une archive.
+
+    Les images sont lues avec les itérateurs du DAO, sans filtre de
+    transformation, et leur contenu passe par un fichier temporaire : seules
+    les métadonnées sont gardées en mémoire. L'archive remplace l'ancienne
+    d'un seul coup.
+
+    Args:
+        klustr_dao (KlustRDAO): source des images
+        dataset_name (str): nom du jeu de données
+        path (str): fichier de l'archive
+        payload (str): PNG_PAYLOAD (images d'origine) ou MASK_PAYLOAD (formes compactées, 1 bit par pixel)
+
+    Returns:
+        int: nombre d'images écrites
+    """
+    if payload not in (PNG_PAYLOAD, MASK_PAYLOAD):
+        raise ValueError(f"contenu d'archive inconnu : {payload}")
+
+    image_ids, label_ids, training, widths, heights, transformations, names = [], [], [], [], [], [], []
+    lengths = []
+    labels = {}
+    offsets = [0]
+
+    with tempfile.TemporaryFile() as payload_file:
+        for training_image in (True, False):
+            for row in klustr_dao.iter_image_from_dataset(dataset_name, training_image,
+                                                          filters=klustr_dao.ALL_TRANSFORMATIONS):
+                data = _payload(row[klustr_dao.IMAGE_COLUMN], payload)
+                payload_file.write(data)
+                # chaque image commence sur 8 octets : les en-têtes de PackedShape se lisent sans copie
+                padding = _align(len(data), 8) - len(data)
+                payload_file.write(b'\0' * padding)
+                offsets.append(offsets[-1] + len(data) + padding)
+                lengths.append(len(data))
+
+                labels.setdefault(row[0], row[1])
+                label_ids.append(row[0])
+                image_ids.append(row[2])
+                names.append(row[3].encode('utf-8'))
+                widths.append(row[4])
+                heights.append(row[5])
+                transformations.append(row[klustr_dao.TRANSFORMATION_COLUMN][:3].encode('ascii'))
+                training.append(training_image)
+        name_offsets = np.cumsum([0] + [len(name) for name in names], dtype=np.int64)
+        sections = {
+            'image_ids': np.array(image_ids, dtype=np.int64),
+            'label_ids': np.array(label_ids, dtype=np.int64),
+            'training': np.array(training, dtype=np.bool_),
+            'widths': np.array(widths, dtype=np.int32),
+            'heights': np.array(heights, dtype=np.int32),
+            'transformations': np.array(transformations, dtype='S3'),
+            'name_offsets': name_offsets,
+            'names': np.frombuffer(b''.join(names), dtype=np.uint8),
+            'offsets': np.array(offsets, dtype=np.int64),
+            'lengths': np.array(lengths, dtype=np.int64),
+        }
+        _write_archive(path, payload_file, sections,
+                       {'dataset': dataset_name, 'payload': payload,
+                        'labels': [[label_id, name] for label_id, name in labels.items()]})
+    return len(image_ids)
+
+
+def _write_archive(path, payload_file, sections, description):
+    payload_size = payload_file.tell()
+
+    # positions des sections, à la suite de l'en-tête (dont la longueur dépend des positions)
+    layout, header = {}, b''
+    while True:
+        position = _align(len(MAGIC) + HEADER_LENGTH_DTYPE.itemsize + len(header))
+        for name, array in sections.items():
+            layout[name] = {'offset': position, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+            position = _align(position + array.nbytes)
+        layout['payload'] = {'offset': position, 'dtype': '|u1', 'shape': [payload_size]}
+        encoded = json.dumps({**description, 'version': VERSION, 'count': len(sections['image_ids']),
+                              'sections': layout}).encode('utf-8')
+        if len(encoded) <= len(header):
+            break
+        header = encoded + b' ' * 64
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(np.array([len(header)], dtype=HEADER_LENGTH_DTYPE).tobytes())
+        file.write(encoded.ljust(len(header)))
+        for name, array in sections.items():
+            file.write(b'\0' * (layout[name]['offset'] - file.tell()))
+            file.write(array.tobytes())
+        file.write(b'\0' * (layout['payload']['offset'] - file.tell()))
+        payload_file.seek(0)
+        shutil.copyfileobj(payload_file, file, 1024 * 1024)
+    os.replace(temporary_path, path)
+
+
+class ImageArchive:
+    """Archive d'un jeu de données écrite par export_dataset, projetée en mémoire.
+
+    Les tableaux (image_ids, label_ids, training...) et le contenu des images
+    sont des vues sur le fichier projeté : rien n'est lu avant d'être utilisé,
+    et le système garde en mémoire les pages déjà lues. Les vues retournées
+    ne doivent plus être utilisées après close().
+    """
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self._mmap[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"archive klustR invalide : {path}")
+            header_length = int(np.frombuffer(self._mmap, dtype=HEADER_LENGTH_DTYPE, count=1, offset=len(MAGIC))[0])
+            start = len(MAGIC) + HEADER_LENGTH_DTYPE.itemsize
+            self._header = json.loads(self._mmap[start:start + header_length])
+            if self._header['version'] != VERSION:
+                raise ValueError(f"version d'archive non prise en charge : {self._header['version']}")
+
+            self._sections = {name: np.frombuffer(self._mmap, dtype=np.dtype(section['dtype']),
+                                                  count=int(np.prod(section['shape'])), offset=section['offset'])
+                              for name, section in self._header['sections'].items()}
+        except Exception:
+            self._mmap.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self._index = {image_id: i for i, image_id in enumerate(self._sections['image_ids'].tolist())}
+        self._label_names = {label_id: name for label_id, name in self._header['labels']}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._header['count']
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    def close(self):
+        # les tableaux NumPy retiennent la projection tant qu'ils existent
+        self._sections = {}
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    @property
+    def dataset_name(self):
+        return self._header['dataset']
+
+    @property
+    def payload(self):
+        return self._header['payload']
+
+    @property
+    def label_names(self):
+        """Retourne un dictionnaire label_id -> nom de l'étiquette"""
+        return dict(self._label_names)
+
+    @property
+    def image_ids(self):
+        return self._sections['image_ids']
+
+    @property
+    def label_ids(self):
+        return self._sections['label_ids']
+
+    @property
+    def training(self):
+        return self._sections['training']
+
+    def index_of(self, image_id):
+        """Retourne la position d'une image dans l'archive (KeyError si absente)"""
+        return self._index[image_id]
+
+    def data(self, image_id):
+        """Retourne le contenu d'une image (PNG ou forme compactée), sans copie"""
+        return self._data_at(self._index[image_id])
+
+    def _data_at(self, index):
+        start = self._header['sections']['payload']['offset'] + int(self._sections['offsets'][index])
+        return self._view[start:start + int(self._sections['lengths'][index])]
+
+    def png(self, image_id):
+        """Retourne le PNG d'une image, sans copie"""
+        if self.payload != PNG_PAYLOAD:
+            raise ValueError("l'archive ne contient que les formes des images")
+        return self.data(image_id)
+
+    def shape(self, image_id) -> PackedShape:
+        """Retourne la forme d'une image ; sans copie pour une archive de formes compactées"""
+        if self.payload == MASK_PAYLOAD:
+            return PackedShape.from_bytes(self.data(image_id))
+        return PackedShape.from_array(mask_from_png(self.data(image_id)))
+
+    def name(self, image_id):
+        index = self._index[image_id]
+        name_offsets = self._sections['name_offsets']
+        return bytes(self._sections['names'][name_offsets[index]:name_offsets[index + 1]]).decode('utf-8')
+
+    def row(self, image_id):
+        """Retourne la rangée de l'image, dans l'ordre des colonnes de KlustRDAO (sans vignette).
+
+        Pour une archive de formes compactées, la colonne de l'image contient la forme compactée.
+        """
+        index = self._index[image_id]
+        label_id = int(self._sections['label_ids'][index])
+        return (label_id, self._label_names[label_id], image_id, self.name(image_id),
+                int(self._sections['widths'][index]), int(self._sections['heights'][index]),
+                self._data_at(index), None, None, None, None,
+                self._sections['transformations'][index].decode('ascii'))
+
+    def rows(self, training_image=None):
+        """Parcourt les rangées des images d'entrainement (True), de test (False) ou de toutes (None)"""
+        for image_id, training in zip(self._sections['image_ids'].tolist(), self._sections['training'].tolist()):
+            if training_image is None or training == training_image:
+                yield self.row(image_id)
+
+
+if __name__ == '__main__':
+    from db_credential import PostgreSQLCredential
+    from klustr_dao import PostgreSQLKlustRDAO
+
+    parser = argparse.ArgumentParser(description='Écrit un jeu de données klustR dans une archive compacte.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--database', default='postgres')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--output', help='fichier de l\'archive (par défaut : <dataset>.klustr)')
+    parser.add_argument('--payload', choices=(PNG_PAYLOAD, MASK_PAYLOAD), default=PNG_PAYLOAD)
+    args = parser.parse_args()
+
+    credential = PostgreSQLCredential(host=args.host, port=args.port, database=args.database,
+                                      user=args.user, password=args.password)
+    output = args.output or f'{args.dataset}.klustr'
+    count = export_dataset(PostgreSQLKlustRDAO(credential, quit_if_connection_failed=True), args.dataset,
+                           output, args.payload)
+    print(f'{count} images du jeu de données {args.dataset} écrites dans {output}')
@@ -1,83 +1,276 @@
+from typing import TYPE_CHECKING
+
 import numpy as np
-from PySide6.QtGui import QImage
-from klustr_utils import ndarray_from_qimage_argb32
+from png_decoder import PNG_SIGNATURE, mask_from_png
+from shape_features import FeaturePlan, roundness, circle_ratio, density
 
 from utils.shapecalculator import ShapeCalculator
+from utils.runlengthshape import RunLengthShape
+from utils.packedshape import PackedShape
+from utils.shapemeasures import ShapeMeasures, RunLengthMeasures
+
+# PySide6 n'est importé qu'au besoin : les processus d'extraction n'en ont pas besoin
+if TYPE_CHECKING:
+    from PySide6.QtGui import QImage
 
 
 class ImageProcessor:
 
+    # à changer dès que le calcul des déterminants change (invalide FeatureCache)
+    EXTRACTOR_VERSION = '1'
+
+    # nombre maximal de pixels traités à la fois par get_shapes_batch
+    BATCH_PIXELS = 1 << 22
+
+    # au-delà, get_shape (qui rogne la forme) est plus rapide que get_shapes_batch sur l'image entière
+    BATCH_MAX_IMAGE_PIXELS = 96 * 96
+
+    # déterminants calculés quand aucun FeaturePlan n'est donné
+    DEFAULT_PLAN = FeaturePlan()
+
     @staticmethod
-    def get_shape(shape_name: str, shape_img: QImage):
-        """Retourne le nom de la forme + les 3 determinants
+    def extractor_version(plan: FeaturePlan = None, target_resolution: int = None,
+                          downsampling: str = 'majority') -> str:
+        """Retourne la version de l'extracteur pour un plan, à utiliser avec FeatureCache"""
+        plan = plan or ImageProcessor.DEFAULT_PLAN
+        version = f'{ImageProcessor.EXTRACTOR_VERSION}:{",".join(plan.names)}'
+        if target_resolution:
+            version += f'@{target_resolution}:{downsampling}'
+        return version
+
+    @staticmethod
+    def get_shape(shape_name: str, shape_img: 'QImage | np.ndarray | RunLengthShape | PackedShape',
+                  plan: FeaturePlan = None, target_resolution: int = None, downsampling: str = 'majority'):
+        """Retourne le nom de la forme + ses determinants
 
         Args:
             shape_name (str): nom de la forme
-            shape_img (QImage): image binaire
+            shape_img (QImage | np.ndarray | RunLengthShape | PackedShape): image binaire,
+            matrice dont la forme est remplie de 1 ou forme déjà encodée
+            plan (FeaturePlan): déterminants à calculer (les 3 déterminants habituels par défaut)
+            target_resolution (int): si donné, taille maximale de la forme avant le calcul (voir reduce_resolution)
+            downsampling (str): réduction par blocs 'or' ou 'majority'
+
+        Returns:
+            list: nom de la forme et ses determinants, dans l'ordre du plan
+        """
+        plan = plan or ImageProcessor.DEFAULT_PLAN
+
+        if isinstance(shape_img, RunLengthShape) and not target_resolution:
+            measures = RunLengthMeasures(shape_img)
+        else:
+            measures = ShapeMeasures(ImageProcessor.__prepare(shape_img, target_resolution, downsampling))
+
+        return [shape_name, *plan.compute(measures)]
+
+    @staticmethod
+    def reduce_resolution(image: np.ndarray, target_resolution: int, downsampling: str = 'majority') -> np.ndarray:
+        """Rogne la forme puis réduit sa résolution pour que son plus grand côté
+        ne dépasse pas target_resolution pixels.
+
+        Le facteur de réduction est choisi pour chaque image : le coût du calcul
+        des déterminants ne dépend donc plus de la taille de l'image source.
+
+        Args:
+            image (np.ndarray): matrice dont la forme est remplie de 1
+            target_resolution (int): nombre maximal de pixels sur le plus grand côté
+            downsampling (str): réduction par blocs 'or' ou 'majority'
+
+        Returns:
+            np.ndarray: matrice booléenne réduite
+        """
+        cropped, _ = ShapeCalculator.crop(image, pad=0)
+        factor = -(-max(cropped.shape) // target_resolution)
+        return ShapeCalculator.downsample(cropped, factor, downsampling)
+
+    @staticmethod
+    def downsampling_error(shape_imgs: list, target_resolution: int, downsampling: str = 'majority',
+                           plan: FeaturePlan = None) -> tuple[np.ndarray, np.ndarray]:
+        """Mesure l'erreur des déterminants réduits par rapport à la pleine résolution.
+
+        Args:
+            shape_imgs (list[QImage | np.ndarray | PackedShape]): échantillon d'images
+            target_resolution (int): nombre maximal de pixels sur le plus grand côté
+            downsampling (str): réduction par blocs 'or' ou 'majority'
+            plan (FeaturePlan): déterminants à comparer
 
         Returns:
-            tuple[str, np.ndarray, np.ndarray, np.ndarray]:
-            tuple contenant le nom de la forme et ses 3 determinants
+            tuple[np.ndarray, np.ndarray]: erreur absolue et erreur relative maximales de chaque déterminant
         """
-        img_array = ndarray_from_qimage_argb32(shape_img)
+        full = ImageProcessor.get_shapes(shape_imgs, plan)
+        reduced = ImageProcessor.get_shapes(shape_imgs, plan, target_resolution, downsampling)
+        absolute = np.abs(reduced - full)
+        relative = absolute / np.maximum(np.abs(full), np.finfo(np.float64).tiny)
+        return absolute.max(axis=0, initial=0), relative.max(axis=0, initial=0)
+
+    @staticmethod
+    def choose_resolution(shape_imgs: list, tolerance: float, candidates=(16, 32, 64, 128, 256),
+                          downsampling: str = 'majority', plan: FeaturePlan = None):
+        """Retourne la plus petite résolution dont l'erreur relative mesurée sur
+        l'échantillon reste sous tolerance pour chaque déterminant.
 
-        # switch les 0 et les 1 pour que la forme soit remplie de 1
-        img_array = 1 - img_array
+        Args:
+            shape_imgs (list[QImage | np.ndarray | PackedShape]): échantillon d'images
+            tolerance (float): erreur relative maximale acceptée
+            candidates (tuple[int]): résolutions essayées, en ordre croissant
+            downsampling (str): réduction par blocs 'or' ou 'majority'
+            plan (FeaturePlan): déterminants à comparer
 
-        metric1 = ImageProcessor.__roundness(img_array)
-        metric2 = ImageProcessor.__circle_ratio(img_array)
-        metric3 = ImageProcessor.__density(img_array)
+        Returns:
+            tuple[int | None, np.ndarray]: résolution choisie (None : pleine résolution)
+            et erreur relative maximale de chaque déterminant à cette résolution
+        """
+        plan = plan or ImageProcessor.DEFAULT_PLAN
+        for target_resolution in candidates:
+            _, relative = ImageProcessor.downsampling_error(shape_imgs, target_resolution, downsampling, plan)
+            if np.all(relative <= tolerance):
+                return target_resolution, relative
+        return None, np.zeros(len(plan))
 
-        return [shape_name, metric1, metric2, metric3]
+    @staticmethod
+    def mask_from_data(data) -> np.ndarray:
+        """Retourne la matrice booléenne d'une image PNG ou d'une forme compactée (PackedShape.to_bytes)"""
+        if bytes(data[:len(PNG_SIGNATURE)]) == PNG_SIGNATURE:
+            return mask_from_png(data)
+        return PackedShape.from_bytes(data).to_array()
 
     @staticmethod
-    def __roundness(img: np.ndarray):
-        """Retourne la circularité de l'aire et circonférence du cercle
+    def get_shape_from_png(shape_name: str, png, image_id: int, cache=None, plan: FeaturePlan = None,
+                           target_resolution: int = None, downsampling: str = 'majority'):
+        """Retourne le nom de la forme + ses determinants d'une image PNG.
+
+        Si un FeatureCache est donné, il est consulté avant le décodage du PNG
+        et mis à jour après le calcul. Sa version doit correspondre au plan
+        (voir extractor_version).
 
         Args:
-            img (np.ndarray): matrice de l'image
+            shape_name (str): nom de la forme
+            png (bytes | memoryview): contenu de l'image PNG, ou forme compactée (voir mask_from_data)
+            image_id (int): identifiant de l'image
+            cache (FeatureCache): cache des déterminants
+            plan (FeaturePlan): déterminants à calculer
+            target_resolution (int): si donné, taille maximale de la forme avant le calcul
+            downsampling (str): réduction par blocs 'or' ou 'majority'
 
         Returns:
-            float: ratio de la circularité
+            list: nom de la forme et ses determinants
         """
-        area = np.sum(img)
-        perim = ShapeCalculator.perimeter(img)
+        if cache is not None:
+            content_hash = cache.content_hash(png)
+            features = cache.get(image_id, content_hash)
+            if features is not None:
+                return [shape_name, *features]
 
-        return (4 * np.pi * area) / (perim ** 2)
+        shape = ImageProcessor.get_shape(shape_name, ImageProcessor.mask_from_data(png), plan,
+                                         target_resolution, downsampling)
+
+        if cache is not None:
+            cache.put(image_id, content_hash, shape[1:])
+        return shape
 
     @staticmethod
-    def __circle_ratio(img: np.ndarray):
-        """Retourne un rapport de l'air de du petit cercle sur l'aire du grand cercle
-        créés avec le centre de l'image et la plus petite et grande distance de cette dernière.
+    def get_shapes(shape_imgs: list, plan: FeaturePlan = None, target_resolution: int = None,
+                   downsampling: str = 'majority') -> np.ndarray:
+        """Retourne les determinants de plusieurs images.
+
+        Pour les 3 déterminants habituels, les petites images de même taille
+        sont regroupées et traitées ensemble par get_shapes_batch, peu importe
+        leur ordre dans la liste. Les grandes images (plus de
+        BATCH_MAX_IMAGE_PIXELS pixels) et les autres plans sont calculés image
+        par image.
 
         Args:
-            img (np.ndarray): matrice de l'image
+            shape_imgs (list[QImage | np.ndarray | PackedShape]): images binaires, ou matrices dont la forme est remplie de 1
+            plan (FeaturePlan): déterminants à calculer
+            target_resolution (int): si donné, taille maximale des formes avant le calcul
+            downsampling (str): réduction par blocs 'or' ou 'majority'
 
         Returns:
-            float: ratio du rapport
+            np.ndarray: matrice (N, len(plan)) des determinants, dans l'ordre des images
         """
-        
-        min_radius, max_radius = ShapeCalculator.min_and_max(img)
-        small_circle_area = np.pi * min_radius ** 2
-        big_circle_area = np.pi * max_radius ** 2
+        masks = [ImageProcessor.__prepare(img, target_resolution, downsampling) for img in shape_imgs]
+
+        plan = plan or ImageProcessor.DEFAULT_PLAN
+        if not plan.is_default:
+            return np.array([plan.compute(ShapeMeasures(mask)) for mask in masks]).reshape(len(masks), len(plan))
 
-        metric2 = small_circle_area / big_circle_area
+        metrics = np.empty((len(masks), 3))
+        groups = {}
+        for i, mask in enumerate(masks):
+            if mask.size > ImageProcessor.BATCH_MAX_IMAGE_PIXELS:
+                metrics[i] = ImageProcessor.get_shape(None, mask)[1:]
+            else:
+                groups.setdefault(mask.shape, []).append(i)
 
-        return metric2 
+        for (height, width), indices in groups.items():
+            # limite la taille des matrices intermédiaires (N, H, W) de get_shapes_batch
+            chunk = max(1, ImageProcessor.BATCH_PIXELS // max(1, height * width))
+            for start in range(0, len(indices), chunk):
+                group = indices[start:start + chunk]
+                metrics[group] = ImageProcessor.get_shapes_batch(np.stack([masks[i] for i in group]))
+
+        return metrics
 
     @staticmethod
-    def __density(img: np.ndarray) -> float:
-        """Retourne la densité de l'image et du cercle
-            créé avec la plus grosse distance à partir
-            du centre de l'image
+    def get_shapes_batch(stack: np.ndarray) -> np.ndarray:
+        """Retourne les 3 determinants d'une pile d'images de même taille.
+
+        Les 3 déterminants habituels (shape_features.DEFAULT_FEATURES) sont
+        calculés en une seule fois sur toute la pile, selon les axes de l'image.
 
         Args:
-            img (np.ndarray): matrice de l'image
+            stack (np.ndarray): pile (N, H, W) de matrices dont la forme est remplie de 1
 
         Returns:
-            float: densité de l'aire de l'image et de l'aire du cercle
+            np.ndarray: matrice (N, 3) des determinants
         """
-        max_radius = ShapeCalculator.min_and_max(img)[1]
-        big_circle_area = np.pi * max_radius ** 2
-        return np.sum(img) / big_circle_area
+        # bordure vide autour de chaque image, comme ShapeCalculator.crop
+        stack = np.pad(stack.astype(bool, copy=False), ((0, 0), (1, 1), (1, 1)))
+
+        area = stack.sum(axis=(1, 2))
+        perim = np.logical_or(
+            (stack[:, :, 1:] != stack[:, :, :-1])[:, 1:, :],
+            (stack[:, 1:, :] != stack[:, :-1, :])[:, :, 1:]).sum(axis=(1, 2))
+
+        rows = np.arange(stack.shape[1])
+        cols = np.arange(stack.shape[2])
+        center_r = stack.sum(axis=2) @ rows / area
+        center_c = stack.sum(axis=1) @ cols / area
+
+        # points du périmètre : pixels de la forme ayant un voisin vide
+        inner = stack[:, 1:-1, 1:-1]
+        boundary = np.zeros_like(stack)
+        boundary[:, 1:-1, 1:-1] = inner & ~(stack[:, :-2, 1:-1] & stack[:, 2:, 1:-1]
+                                            & stack[:, 1:-1, :-2] & stack[:, 1:-1, 2:])
+
+        distances = np.hypot(rows[None, :, None] - center_r[:, None, None],
+                             cols[None, None, :] - center_c[:, None, None])
+        min_radius = np.where(boundary, distances, np.inf).min(axis=(1, 2))
+        max_radius = np.where(boundary, distances, -np.inf).max(axis=(1, 2))
+
+        return np.column_stack((roundness(area, perim),
+                                circle_ratio(min_radius, max_radius),
+                                density(area, max_radius)))
+
+    @staticmethod
+    def __prepare(shape_img, target_resolution, downsampling) -> np.ndarray:
+        """Retourne la matrice de l'image, réduite si target_resolution est donné"""
+        if isinstance(shape_img, RunLengthShape):
+            mask = shape_img.to_array()[0]
+        else:
+            mask = ImageProcessor.__mask(shape_img)
+        if target_resolution:
+            mask = ImageProcessor.reduce_resolution(mask, target_resolution, downsampling)
+        return mask
+
+    @staticmethod
+    def __mask(shape_img: 'QImage | np.ndarray | PackedShape') -> np.ndarray:
+        """Retourne la matrice de l'image, la forme remplie de 1"""
+        if isinstance(shape_img, np.ndarray):
+            return shape_img
+        if isinstance(shape_img, PackedShape):
+            return shape_img.to_array()
+
+        from klustr_utils import mask_from_qimage_argb32
 
+        return mask_from_qimage_argb32(shape_img)
@@ -1,9 +1,33 @@
 from abc import ABC, abstractmethod
-import psycopg2 as pg
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+import hashlib
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from dao_stats import QueryStats
 
 
 
 class KlustRDAO(ABC):
+    # positions des colonnes des rangées d'images
+    LABEL_ID_COLUMN = 0
+    IMAGE_ID_COLUMN = 2
+    IMAGE_COLUMN = 6
+    THUMBNAIL_COLUMN = 7
+    TRANSFORMATION_COLUMN = 11
+    BLOB_COLUMNS = (IMAGE_COLUMN, THUMBNAIL_COLUMN)
+
+    # déterminants précalculés (voir features_from_dataset), gardés en float64 petit-boutiste
+    FEATURE_DTYPE = np.dtype('<f8')
+
+    # filtres de transformation (translated, rotated, scaled, exclusive) qui laissent passer toutes les images
+    ALL_TRANSFORMATIONS = (True, True, True, False)
+
     def __init__(self):
         self._translated = True
         self._rotated = True
@@ -26,12 +50,48 @@ class KlustRDAO(ABC):
     def exclusive(self):
         return self._exclusive
 
+    @property
+    def transformation_filters(self):
+        return (self._translated, self._rotated, self._scaled, self._exclusive)
+
     def set_transformation_filters(self, translated=True, rotated=True, scaled=True, exclusive=True):
         self._translated = translated
         self._rotated = rotated
         self._scaled = scaled
         self._exclusive = exclusive
 
+    # Filtres de transformation, appliqués aux images selon leur colonne de transformation ('101' :
+    # translation et mise à l'échelle appliquées) :
+    #   - non exclusif : chaque transformation appliquée à l'image doit être permise
+    #                    (tous les filtres à True laissent donc passer toutes les images)
+    #   - exclusif : les transformations appliquées doivent être exactement celles permises
+    # Les méthodes filtrées acceptent des filtres explicites (translated, rotated, scaled, exclusive),
+    # sans modifier ceux du DAO partagé ; None : les filtres du DAO (voir set_transformation_filters).
+    def _filters(self, filters):
+        return self.transformation_filters if filters is None else tuple(filters)
+
+    def matches_transformation_filters(self, transformation, filters=None):
+        translated, rotated, scaled, exclusive = self._filters(filters)
+        applied = tuple(flag == '1' for flag in transformation[:3])
+        enabled = (bool(translated), bool(rotated), bool(scaled))
+        if exclusive:
+            return applied == enabled
+        return all(allowed or not done for done, allowed in zip(applied, enabled))
+
+    def filter_transformations(self, rows, filters=None):
+        if rows is None:
+            return None
+        filters = self._filters(filters)
+        return [row for row in rows if self.matches_transformation_filters(row[self.TRANSFORMATION_COLUMN], filters)]
+
+    def _transformation_condition(self, column, placeholder='%s', filters=None):
+        # condition SQL équivalente à matches_transformation_filters (chaîne vide : aucun filtre)
+        *enabled, exclusive = self._filters(filters)
+        if exclusive:
+            return f'substr({column}, 1, 3) = {placeholder}', (''.join('1' if flag else '0' for flag in enabled),)
+        refused = [f"substr({column}, {position}, 1) <> '1'" for position, flag in enumerate(enabled, 1) if not flag]
+        return ' AND '.join(refused), ()
+
     @property
     @abstractmethod
     def is_available(self):
@@ -57,26 +117,148 @@ class KlustRDAO(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def image_from_label(self, label_id):
+    def image_from_label(self, label_id, filters=None):
         raise NotImplementedError
 
     @abstractmethod
-    def image_from_dataset_label(self, dataset_name, label_id, training_image):
+    def image_from_dataset_label(self, dataset_name, label_id, training_image, filters=None):
         raise NotImplementedError
 
     @abstractmethod
-    def image_from_dataset(self, dataset_name, training_image):
+    def image_from_dataset(self, dataset_name, training_image, filters=None):
         raise NotImplementedError
 
+    # Variantes itératives : les rangées sont produites au fur et à mesure.
+    # Par défaut, elles parcourent simplement le résultat complet de la méthode correspondante
+    # (les filtres sont lus à l'appel, pas au début du parcours).
+    def iter_image_from_label(self, label_id, itersize=None, filters=None):
+        return self.__iterate(self.image_from_label, label_id, filters=self._filters(filters))
+
+    def iter_image_from_dataset_label(self, dataset_name, label_id, training_image, itersize=None, filters=None):
+        return self.__iterate(self.image_from_dataset_label, dataset_name, label_id, training_image,
+                              filters=self._filters(filters))
+
+    def iter_image_from_dataset(self, dataset_name, training_image, itersize=None, filters=None):
+        return self.__iterate(self.image_from_dataset, dataset_name, training_image, filters=self._filters(filters))
+
+    @staticmethod
+    def __iterate(method, *args, **kwargs):
+        yield from method(*args, **kwargs) or ()
+
+    # Variantes sans les images : les rangées gardent les mêmes positions, mais les colonnes
+    # d'images (BLOB_COLUMNS) absentes de blob_columns valent None.
+    # Par défaut, elles retirent les images du résultat complet de la méthode correspondante.
+    def image_metadata_from_label(self, label_id, blob_columns=(), filters=None):
+        return self._strip_blobs(self.image_from_label(label_id, filters=filters), blob_columns)
+
+    def image_metadata_from_dataset_label(self, dataset_name, label_id, training_image, blob_columns=(),
+                                          filters=None):
+        return self._strip_blobs(self.image_from_dataset_label(dataset_name, label_id, training_image,
+                                                               filters=filters), blob_columns)
+
+    def image_metadata_from_dataset(self, dataset_name, training_image, blob_columns=(), filters=None):
+        return self._strip_blobs(self.image_from_dataset(dataset_name, training_image, filters=filters), blob_columns)
+
+    def images_by_ids(self, label_id, image_ids, blob_columns=BLOB_COLUMNS):
+        # toutes les images de l'étiquette, quels que soient les filtres de transformation
+        rows = self.image_from_label(label_id, filters=self.ALL_TRANSFORMATIONS) or ()
+        return self._order_by_ids(self._strip_blobs(rows, blob_columns), image_ids)
+
+    # Empreintes (image_id, label_id, md5 hexadécimal du PNG) des images d'un jeu de données,
+    # pour repérer les images ajoutées, retirées ou modifiées sans transférer les images.
+    # Par défaut, les empreintes sont calculées ici à partir du résultat complet.
+    def image_checksums_from_dataset(self, dataset_name, training_image, filters=None):
+        rows = self.image_from_dataset(dataset_name, training_image, filters=filters)
+        if rows is None:
+            return None
+        return [(row[self.IMAGE_ID_COLUMN], row[self.LABEL_ID_COLUMN], hashlib.md5(row[self.IMAGE_COLUMN]).hexdigest())
+                for row in rows]
+
+    # Table des déterminants précalculés : une rangée par (image_id, extractor_version), avec le
+    # md5 hexadécimal du PNG dont ils ont été calculés (voir populate_features). Les DAO sans
+    # table de déterminants lèvent NotImplementedError.
+    def create_feature_table(self):
+        raise NotImplementedError
+
+    def images_missing_features(self, dataset_name, extractor_version):
+        """Retourne les (image_id, label_id) des images du jeu de données (entrainement puis test)
+        sans déterminants pour extractor_version, ou dont le PNG a changé depuis leur calcul"""
+        raise NotImplementedError
+
+    def put_features(self, extractor_version, entries):
+        """Ajoute ou remplace des déterminants.
+
+        Args:
+            extractor_version (str): version de l'extracteur (voir ImageProcessor.extractor_version)
+            entries (list[tuple]): (image_id, md5 hexadécimal du PNG, déterminants)
+
+        Returns:
+            int: nombre de rangées écrites, None en cas d'erreur
+        """
+        raise NotImplementedError
+
+    def features_from_dataset(self, dataset_name, training_image, extractor_version, filters=None):
+        """Retourne les déterminants précalculés des images du jeu de données.
+
+        Seules les images qui ont des déterminants pour extractor_version sont
+        retournées ; les filtres de transformation (filters, ou ceux du DAO)
+        s'appliquent comme pour image_from_dataset.
+
+        Returns:
+            np.ndarray: tableau structuré ('label' : nom de l'étiquette, 'image_id', 'features'),
+            prêt pour KNN.add_points(result['label'], result['features']), None en cas d'erreur
+        """
+        raise NotImplementedError
+
+    def _features_array(self, rows):
+        # rangées (label_name, image_id, déterminants en octets) -> tableau de features_from_dataset
+        if rows is None:
+            return None
+        feature_count = len(rows[0][2]) // self.FEATURE_DTYPE.itemsize if rows else 0
+        result = np.empty(len(rows), dtype=[('label', object), ('image_id', np.int64),
+                                            ('features', self.FEATURE_DTYPE, (feature_count,))])
+        for i, (label_name, image_id, features) in enumerate(rows):
+            result[i] = (label_name, image_id, np.frombuffer(features, dtype=self.FEATURE_DTYPE))
+        return result
+
+    def _feature_rows(self, extractor_version, entries):
+        # entrées de put_features -> rangées (image_id, extractor_version, checksum, déterminants en octets)
+        return [(image_id, extractor_version, checksum, np.asarray(features, dtype=self.FEATURE_DTYPE).tobytes())
+                for image_id, checksum, features in entries]
+
+    def _strip_blobs(self, rows, blob_columns):
+        if rows is None:
+            return None
+        removed = [column for column in self.BLOB_COLUMNS if column not in blob_columns]
+        stripped = []
+        for row in rows:
+            row = list(row)
+            for column in removed:
+                row[column] = None
+            stripped.append(tuple(row))
+        return stripped
+
+    def _order_by_ids(self, rows, image_ids):
+        # rangées dans l'ordre de image_ids, les identifiants introuvables sont ignorés
+        if rows is None:
+            return None
+        by_id = {row[self.IMAGE_ID_COLUMN]: row for row in rows}
+        return [by_id[image_id] for image_id in image_ids if image_id in by_id]
+
 
 
-# TO DO : APPLY TRANSFORMATION FILTERS!!! AND move to serverside function
 class PostgreSQLKlustRDAO(KlustRDAO):
-    def __init__(self, pg_connection_credential, quit_if_connection_failed=False):
+    FEATURE_TABLE = 'klustr.image_feature'
+
+    def __init__(self, pg_connection_credential, quit_if_connection_failed=False, itersize=64):
+        super().__init__()
         self._pg_connection_credential = pg_connection_credential
+        self.itersize = itersize
+        self._column_names = {}
+        # QueryStats des requêtes SQL (voir InstrumentedKlustRDAO), None : aucune mesure
+        self.query_stats = None
         try:
-            self.pg_connection = pg.connect(self._pg_connection_credential.connection_string)
-            self.pg_cursor = self.pg_connection.cursor()
+            self._connect()
             self._is_available = True
         except Exception as error:
             self._is_available = False
@@ -88,22 +270,154 @@ class PostgreSQLKlustRDAO(KlustRDAO):
             if quit_if_connection_failed:
                 quit()
 
-    def _execute_simple_query(self, query, param_to_bind=tuple()):
+    def _connect(self):
+        # psycopg2 n'est importé qu'à la connexion : les autres DAO (ex. SQLiteKlustRDAO) s'en passent
+        import psycopg2
+        self.pg_connection = psycopg2.connect(self._pg_connection_credential.connection_string)
+        self.pg_cursor = self.pg_connection.cursor()
+
+    @contextmanager
+    def _checkout(self):
+        # une requête en échec annule la transaction : la connexion reste utilisable pour les suivantes
+        try:
+            yield self.pg_connection
+        except Exception:
+            if not self.pg_connection.closed:
+                self.pg_connection.rollback()
+            raise
+
+    def _report_error(self, error, query):
+        print(f'{type(self).__name__} : erreur de la requete avec le message suivant :')
+        print('-' * 80)
+        print(type(error))
+        print(error)
+        print(f'Avec la requete :\n{query}')
+        print('-' * 80)
+
+    def _measured(self, query, execute, method=None):
+        # execute() retourne les rangées de la requête, mesurées sous 'sql:<method>' si query_stats est défini :
+        # plusieurs méthodes lisent la même fonction du schéma, elles sont gardées séparément
+        if self.query_stats is None:
+            return execute()
+        return self.query_stats.measure(f'sql:{method or query.split(None, 1)[0].lower()}', execute, query)
+
+    def _iterate_query(self, query, param_to_bind=tuple(), itersize=None):
+        # curseur nommé (côté serveur) : seules itersize rangées à la fois sont transférées au client
         if self.is_available:
             try:
-                self.pg_cursor.execute(query, param_to_bind)
-                return self.pg_cursor.fetchall()
+                with self._checkout() as connection:
+                    cursor = connection.cursor(name=f'klustr_{uuid.uuid4().hex}')
+                    cursor.itersize = itersize or self.itersize
+                    try:
+                        cursor.execute(query, param_to_bind)
+                        yield from cursor
+                    finally:
+                        cursor.close()
             except Exception as error:
-                print('PostgreSQLKlustRDAO : erreur de la requete avec le message suivant :')
-                print('-' * 80)
-                print(type(error))
-                print(error)
-                print(f'Avec la requete :\n{query}')
-                print('-' * 80)
+                # un parcours interrompu ne doit pas passer pour un parcours complet
+                self._report_error(error, query)
+                raise
         else:
-            print('PostgreSQLKlustRDAO n\'est pas disponible.')
+            print(f'{type(self).__name__} n\'est pas disponible.')
+
+    def _source_columns(self, source, param_to_bind):
+        # noms des colonnes retournées par une fonction du schéma klustr, lus une seule fois
+        if source not in self._column_names:
+            with self._checkout() as connection, connection.cursor() as cursor:
+                cursor.execute(f'SELECT * FROM {source} AS source LIMIT 0;', param_to_bind)
+                self._column_names[source] = [column.name for column in cursor.description]
+        return self._column_names[source]
+
+    def _select_query(self, source, param_to_bind, expressions, condition='', condition_params=(),
+                      join='', join_params=()):
+        # expressions, condition et join désignent les colonnes par leur position : 'md5({6})', '{2} = ANY(%s)'
+        names = self._source_columns(source, param_to_bind)
+        quoted = ['source."{}"'.format(name.replace('"', '""')) for name in names]
+        columns = ', '.join(expression.format(*quoted) for expression in expressions)
+        where = f' WHERE {condition.format(*quoted)}' if condition else ''
+        return (f'SELECT {columns} FROM {source} AS source{join.format(*quoted)}{where};',
+                (*param_to_bind, *join_params, *condition_params))
+
+    def _projected_query(self, source, param_to_bind, blob_columns, condition='', condition_params=()):
+        # même rangées que SELECT *, mais les images non demandées ne quittent pas le serveur
+        column_count = len(self._source_columns(source, param_to_bind))
+        expressions = ['NULL' if i in self.BLOB_COLUMNS and i not in blob_columns else f'{{{i}}}'
+                       for i in range(column_count)]
+        return self._select_query(source, param_to_bind, expressions, condition, condition_params)
+
+    def _execute_projected_query(self, source, param_to_bind, blob_columns, condition='', condition_params=(),
+                                 method=None):
+        if not self.is_available:
+            print(f'{type(self).__name__} n\'est pas disponible.')
+            return None
+        try:
+            query, params = self._projected_query(source, param_to_bind, blob_columns, condition, condition_params)
+        except Exception as error:
+            self._report_error(error, source)
+            return None
+        return self._execute_simple_query(query, params, method)
+
+    def _filtered_query(self, source, param_to_bind, blob_columns=KlustRDAO.BLOB_COLUMNS, filters=None, method=None):
+        # filtres de transformation appliqués par le serveur ; si la requête filtrée échoue,
+        # les rangées sont filtrées ici
+        filters = self._filters(filters)
+        condition, condition_params = self._transformation_condition(f'{{{self.TRANSFORMATION_COLUMN}}}',
+                                                                     filters=filters)
+        rows = self._execute_projected_query(source, param_to_bind, blob_columns, condition, condition_params,
+                                             method=method)
+        if rows is None and condition:
+            rows = self.filter_transformations(self._execute_projected_query(source, param_to_bind, blob_columns,
+                                                                             method=method),
+                                               filters)
+        return rows
+
+    def _iterate_filtered_query(self, source, param_to_bind, itersize=None, filters=None):
+        # les filtres sont lus à l'appel, pas au début du parcours
+        return self.__iterate_filtered(source, param_to_bind, itersize, self._filters(filters))
+
+    def __iterate_filtered(self, source, param_to_bind, itersize, filters):
+        # comme _filtered_query : si la requête filtrée échoue avant sa première rangée,
+        # toutes les rangées sont lues et filtrées ici
+        query = None
+        if self.is_available:
+            try:
+                query, params = self._projected_query(source, param_to_bind, self.BLOB_COLUMNS,
+                                                      *self._transformation_condition(
+                                                          f'{{{self.TRANSFORMATION_COLUMN}}}', filters=filters))
+            except Exception as error:
+                self._report_error(error, source)
+        if query is not None:
+            started = False
+            try:
+                for row in self._iterate_query(query, params, itersize):
+                    started = True
+                    yield row
+                return
+            except Exception:
+                # erreur déjà signalée par _iterate_query
+                if started:
+                    raise
+        rows = self._iterate_query(f'SELECT * FROM {source};', param_to_bind, itersize)
+        yield from (row for row in rows
+                    if self.matches_transformation_filters(row[self.TRANSFORMATION_COLUMN], filters))
+
+    def _execute_simple_query(self, query, param_to_bind=tuple(), method=None):
+        if self.is_available:
+            try:
+                return self._measured(query, lambda: self._execute(query, param_to_bind), method)
+            except Exception as error:
+                self._report_error(error, query)
+        else:
+            print(f'{type(self).__name__} n\'est pas disponible.')
         return None
 
+    def _execute(self, query, param_to_bind):
+        # exécute la requête et retourne ses rangées (voir PooledKlustRDAO._execute) ;
+        # _checkout annule la transaction en échec avant la requête suivante (ex. celle de repli)
+        with self._checkout():
+            self.pg_cursor.execute(query, param_to_bind)
+            return self.pg_cursor.fetchall()
+
     @property
     def is_available(self):
         return self._is_available and not self.pg_connection.closed
@@ -111,30 +425,575 @@ class PostgreSQLKlustRDAO(KlustRDAO):
     @property
     def total_label_image_count(self):
         query = 'SELECT * FROM klustr.label_image_total_count();'
-        return self._execute_simple_query(query)
+        return self._execute_simple_query(query, method='total_label_image_count')
 
     @property
     def available_datasets(self): 
-        return self._execute_simple_query('''SELECT * FROM klustr.data_set_info;''')
+        return self._execute_simple_query('''SELECT * FROM klustr.data_set_info;''', method='available_datasets')
 
     @property
     def available_labels(self):
-        return self._execute_simple_query('''SELECT * FROM klustr.available_labels;''')
+        return self._execute_simple_query('''SELECT * FROM klustr.available_labels;''', method='available_labels')
 
     def labels_from_dataset(self, dataset_name):
-        return self._execute_simple_query(f'''SELECT * FROM klustr.select_label_from_data_set(%s);''', (dataset_name,))
+        return self._execute_simple_query(f'''SELECT * FROM klustr.select_label_from_data_set(%s);''', (dataset_name,),
+                                          'labels_from_dataset')
 
-    def image_from_label(self, label_id):
+    def image_from_label(self, label_id, filters=None):
         return self._execute_simple_query(
                         f'''SELECT 	* FROM klustr.select_image_by_label_and_transformation(%s, %s, %s, %s, %s);''',
-                        (label_id, self._translated, self._rotated, self._scaled, self._exclusive))
+                        (label_id, *self._filters(filters)),
+                        'image_from_label')
 
-    def image_from_dataset_label(self, dataset_name, label_id, training_image):
-        return self._execute_simple_query(
-                        f'''SELECT * FROM klustr.select_image_from_data_set(%s, %s, %s);''',
-                        (dataset_name, label_id, training_image))
+    # les fonctions des jeux de données n'ont pas de paramètres de transformation :
+    # les filtres sont ajoutés à la requête (voir _filtered_query)
+    def image_from_dataset_label(self, dataset_name, label_id, training_image, filters=None):
+        return self._filtered_query(
+                        'klustr.select_image_from_data_set(%s, %s, %s)',
+                        (dataset_name, label_id, training_image),
+                        filters=filters, method='image_from_dataset_label')
 
-    def image_from_dataset(self, dataset_name, training_image):
-        return self._execute_simple_query(
-                        f'''SELECT * FROM klustr.select_image_from_data_set(%s, %s);''',
-                        (dataset_name, training_image))
+    def image_from_dataset(self, dataset_name, training_image, filters=None):
+        return self._filtered_query(
+                        'klustr.select_image_from_data_set(%s, %s)',
+                        (dataset_name, training_image),
+                        filters=filters, method='image_from_dataset')
+
+    def iter_image_from_label(self, label_id, itersize=None, filters=None):
+        return self._iterate_query(
+                        f'''SELECT 	* FROM klustr.select_image_by_label_and_transformation(%s, %s, %s, %s, %s);''',
+                        (label_id, *self._filters(filters)),
+                        itersize)
+
+    def iter_image_from_dataset_label(self, dataset_name, label_id, training_image, itersize=None, filters=None):
+        return self._iterate_filtered_query(
+                        'klustr.select_image_from_data_set(%s, %s, %s)',
+                        (dataset_name, label_id, training_image),
+                        itersize, filters)
+
+    def iter_image_from_dataset(self, dataset_name, training_image, itersize=None, filters=None):
+        return self._iterate_filtered_query(
+                        'klustr.select_image_from_data_set(%s, %s)',
+                        (dataset_name, training_image),
+                        itersize, filters)
+
+
+    def image_metadata_from_label(self, label_id, blob_columns=(), filters=None):
+        return self._execute_projected_query(
+                        'klustr.select_image_by_label_and_transformation(%s, %s, %s, %s, %s)',
+                        (label_id, *self._filters(filters)),
+                        blob_columns, method='image_metadata_from_label')
+
+    def image_metadata_from_dataset_label(self, dataset_name, label_id, training_image, blob_columns=(),
+                                          filters=None):
+        return self._filtered_query(
+                        'klustr.select_image_from_data_set(%s, %s, %s)',
+                        (dataset_name, label_id, training_image),
+                        blob_columns, filters, 'image_metadata_from_dataset_label')
+
+    def image_metadata_from_dataset(self, dataset_name, training_image, blob_columns=(), filters=None):
+        return self._filtered_query(
+                        'klustr.select_image_from_data_set(%s, %s)',
+                        (dataset_name, training_image),
+                        blob_columns, filters, 'image_metadata_from_dataset')
+
+    def image_checksums_from_dataset(self, dataset_name, training_image, filters=None):
+        # empreintes calculées par le serveur : aucune image n'est transférée
+        source = 'klustr.select_image_from_data_set(%s, %s)'
+        if not self.is_available:
+            print(f'{type(self).__name__} n\'est pas disponible.')
+            return None
+        try:
+            query, params = self._select_query(
+                            source, (dataset_name, training_image),
+                            (f'{{{self.IMAGE_ID_COLUMN}}}', f'{{{self.LABEL_ID_COLUMN}}}', f'md5({{{self.IMAGE_COLUMN}}})'),
+                            *self._transformation_condition(f'{{{self.TRANSFORMATION_COLUMN}}}', filters=filters))
+        except Exception as error:
+            self._report_error(error, source)
+            return None
+        return self._execute_simple_query(query, params, 'image_checksums_from_dataset')
+
+    def images_by_ids(self, label_id, image_ids, blob_columns=KlustRDAO.BLOB_COLUMNS):
+        rows = self._execute_projected_query(
+                        'klustr.select_image_by_label_and_transformation(%s, TRUE, TRUE, TRUE, FALSE)',
+                        (label_id,),
+                        blob_columns,
+                        f'{{{self.IMAGE_ID_COLUMN}}} = ANY(%s)',
+                        (list(image_ids),),
+                        'images_by_ids')
+        return self._order_by_ids(rows, image_ids)
+
+
+    def _execute_write(self, query, rows):
+        # écriture dans sa propre transaction ; retourne le nombre de rangées écrites, None en cas d'erreur
+        if not self.is_available:
+            print(f'{type(self).__name__} n\'est pas disponible.')
+            return None
+        try:
+            with self._checkout() as connection:
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.executemany(query, rows)
+                    connection.commit()
+                except Exception:
+                    connection.rollback()
+                    raise
+            return len(rows)
+        except Exception as error:
+            self._report_error(error, query)
+            return None
+
+    def create_feature_table(self):
+        return self._execute_write(f'''CREATE TABLE IF NOT EXISTS {self.FEATURE_TABLE} (
+                                          image_id integer NOT NULL,
+                                          extractor_version text NOT NULL,
+                                          checksum text NOT NULL,
+                                          features bytea NOT NULL,
+                                          PRIMARY KEY (image_id, extractor_version));''', [()])
+
+    def images_missing_features(self, dataset_name, extractor_version):
+        source = 'klustr.select_image_from_data_set(%s, %s)'
+        missing = []
+        for training_image in (True, False):
+            try:
+                query, params = self._select_query(
+                                source, (dataset_name, training_image), ['{2}', '{0}'],
+                                f'''NOT EXISTS (SELECT 1 FROM {self.FEATURE_TABLE} AS feature
+                                                WHERE feature.image_id = {{2}} AND feature.extractor_version = %s
+                                                AND feature.checksum = md5({{{self.IMAGE_COLUMN}}}))''',
+                                (extractor_version,))
+            except Exception as error:
+                self._report_error(error, source)
+                return None
+            rows = self._execute_simple_query(query, params, 'images_missing_features')
+            if rows is None:
+                return None
+            missing += rows
+        # une image peut faire partie des images d'entrainement et de test
+        return list(dict.fromkeys(tuple(row) for row in missing))
+
+    def put_features(self, extractor_version, entries):
+        return self._execute_write(f'''INSERT INTO {self.FEATURE_TABLE} VALUES (%s, %s, %s, %s)
+                                      ON CONFLICT (image_id, extractor_version)
+                                      DO UPDATE SET checksum = EXCLUDED.checksum, features = EXCLUDED.features;''',
+                                   self._feature_rows(extractor_version, entries))
+
+    # seuls le nom de l'étiquette, l'identifiant et les déterminants quittent le serveur
+    def features_from_dataset(self, dataset_name, training_image, extractor_version, filters=None):
+        source = 'klustr.select_image_from_data_set(%s, %s)'
+        try:
+            query, params = self._select_query(
+                            source, (dataset_name, training_image), ['{1}', '{2}', 'feature.features'],
+                            *self._transformation_condition(f'{{{self.TRANSFORMATION_COLUMN}}}', filters=filters),
+                            join=f''' JOIN {self.FEATURE_TABLE} AS feature
+                                     ON feature.image_id = {{2}} AND feature.extractor_version = %s''',
+                            join_params=(extractor_version,))
+        except Exception as error:
+            self._report_error(error, source)
+            return None
+        return self._features_array(self._execute_simple_query(query, params, 'features_from_dataset'))
+
+class PooledKlustRDAO(PostgreSQLKlustRDAO):
+    """DAO PostgreSQL utilisable par plusieurs fils d'exécution à la fois.
+
+    Chaque opération emprunte une connexion à un pool borné (au plus maxconn
+    connexions ; au-delà, l'appel attend qu'une connexion soit rendue) et
+    utilise son propre curseur. Les requêtes sont préparées (PREPARE) une
+    seule fois par connexion, puis exécutées avec EXECUTE.
+
+    Les itérateurs (iter_image_from_...) gardent leur connexion jusqu'à la
+    fin du parcours.
+    """
+
+    def __init__(self, pg_connection_credential, minconn=1, maxconn=4, quit_if_connection_failed=False, itersize=64):
+        self._minconn = minconn
+        self._maxconn = maxconn
+        self._semaphore = threading.BoundedSemaphore(maxconn)
+        self._prepared = {}
+        self._pool = None
+        super().__init__(pg_connection_credential, quit_if_connection_failed, itersize)
+
+    def _connect(self):
+        import psycopg2.pool
+        self._pool = psycopg2.pool.ThreadedConnectionPool(self._minconn, self._maxconn,
+                                                          self._pg_connection_credential.connection_string)
+
+    @property
+    def is_available(self):
+        return self._is_available and not self._pool.closed
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.closeall()
+
+    @contextmanager
+    def _checkout(self):
+        # le sémaphore fait attendre au lieu de lever PoolError quand toutes les connexions sont prises ;
+        # le pool annule la transaction en cours quand la connexion lui est rendue
+        with self._semaphore:
+            connection = self._pool.getconn()
+            try:
+                yield connection
+            finally:
+                self._pool.putconn(connection)
+
+    def _prepare(self, connection, cursor, query, param_count):
+        """Prépare la requête sur la connexion au besoin et retourne l'instruction EXECUTE correspondante"""
+        name = f'klustr_{hashlib.md5(query.encode()).hexdigest()[:16]}'
+        # une connexion recréée par le pool n'a plus les requêtes préparées de l'ancienne
+        prepared = self._prepared.setdefault((id(connection), connection.info.backend_pid), set())
+        if name not in prepared:
+            numbers = iter(range(1, param_count + 1))
+            statement = re.sub(r'%s', lambda _: f'${next(numbers)}', query.strip().rstrip(';'))
+            cursor.execute(f'PREPARE {name} AS {statement};')
+            prepared.add(name)
+        return f'EXECUTE {name}({", ".join(["%s"] * param_count)});' if param_count else f'EXECUTE {name};'
+
+    def _execute(self, query, param_to_bind):
+        with self._checkout() as connection, connection.cursor() as cursor:
+            cursor.execute(self._prepare(connection, cursor, query, len(param_to_bind)), param_to_bind)
+            return cursor.fetchall()
+
+
+class CachedKlustRDAO(KlustRDAO):
+    """Cache des résultats de requêtes devant un autre KlustRDAO.
+
+    Chaque méthode a sa durée de validité (ttl, en secondes ; 0 : pas de
+    cache) et les résultats les moins récemment utilisés sont retirés au-delà
+    de max_entries résultats. Les résultats qui dépendent des filtres de
+    transformation sont gardés séparément pour chaque combinaison de filtres.
+
+    Les résultats retournés sont partagés entre les appels : ils ne doivent
+    pas être modifiés.
+    """
+
+    # les listes d'images complètes (PNG et vignettes) ne sont pas gardées par défaut
+    DEFAULT_TTL = {
+        'total_label_image_count': 300.,
+        'available_datasets': 300.,
+        'available_labels': 300.,
+        'labels_from_dataset': 300.,
+        'image_metadata_from_label': 60.,
+        'image_metadata_from_dataset_label': 60.,
+        'image_metadata_from_dataset': 60.,
+        'image_from_label': 0.,
+        'image_from_dataset_label': 0.,
+        'image_from_dataset': 0.,
+        'images_by_ids': 0.,
+        'features_from_dataset': 60.,
+    }
+
+    def __init__(self, klustr_dao, ttl=None, max_entries=256, clock=time.monotonic):
+        super().__init__()
+        self._dao = klustr_dao
+        self._ttl = {**self.DEFAULT_TTL, **(ttl or {})}
+        self._max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._hits = Counter()
+        self._misses = Counter()
+        self._lock = threading.Lock()
+        self.set_transformation_filters(klustr_dao.translated, klustr_dao.rotated, klustr_dao.scaled, klustr_dao.exclusive)
+
+    @property
+    def dao(self):
+        return self._dao
+
+    def __getattr__(self, name):
+        # autres méthodes propres au DAO décoré (ex. close)
+        return getattr(self._dao, name)
+
+    def set_transformation_filters(self, translated=True, rotated=True, scaled=True, exclusive=True):
+        super().set_transformation_filters(translated, rotated, scaled, exclusive)
+        self._dao.set_transformation_filters(translated, rotated, scaled, exclusive)
+
+    def invalidate(self, method=None):
+        """Oublie les résultats d'une méthode, ou tous les résultats"""
+        with self._lock:
+            for key in [key for key in self._entries if method is None or key[0] == method]:
+                del self._entries[key]
+
+    @property
+    def stats(self):
+        """Retourne un dictionnaire méthode -> (succès, échecs) du cache"""
+        with self._lock:
+            return {method: (self._hits[method], self._misses[method])
+                    for method in sorted(set(self._hits) | set(self._misses))}
+
+    @property
+    def hit_count(self):
+        return sum(self._hits.values())
+
+    @property
+    def miss_count(self):
+        return sum(self._misses.values())
+
+    def _cached(self, method, args, compute, filters=None):
+        # filters : filtres de transformation (explicites) du résultat, None s'il n'en dépend pas
+        ttl = self._ttl.get(method, 0.)
+        if not ttl:
+            return compute()
+
+        key = (method, args, filters)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                self._entries.move_to_end(key)
+                self._hits[method] += 1
+                return entry[1]
+            self._misses[method] += 1
+
+        value = compute()
+        if value is not None:
+            with self._lock:
+                self._entries[key] = (self._clock() + ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    @property
+    def is_available(self):
+        return self._dao.is_available
+
+    @property
+    def total_label_image_count(self):
+        return self._cached('total_label_image_count', (), lambda: self._dao.total_label_image_count)
+
+    @property
+    def available_datasets(self):
+        return self._cached('available_datasets', (), lambda: self._dao.available_datasets)
+
+    @property
+    def available_labels(self):
+        return self._cached('available_labels', (), lambda: self._dao.available_labels)
+
+    def labels_from_dataset(self, dataset_name):
+        return self._cached('labels_from_dataset', (dataset_name,),
+                            lambda: self._dao.labels_from_dataset(dataset_name))
+
+    def image_from_label(self, label_id, filters=None):
+        filters = self._filters(filters)
+        return self._cached('image_from_label', (label_id,),
+                            lambda: self._dao.image_from_label(label_id, filters=filters), filters)
+
+    def image_from_dataset_label(self, dataset_name, label_id, training_image, filters=None):
+        filters = self._filters(filters)
+        return self._cached('image_from_dataset_label', (dataset_name, label_id, training_image),
+                            lambda: self._dao.image_from_dataset_label(dataset_name, label_id, training_image,
+                                                                       filters=filters),
+                            filters)
+
+    def image_from_dataset(self, dataset_name, training_image, filters=None):
+        filters = self._filters(filters)
+        return self._cached('image_from_dataset', (dataset_name, training_image),
+                            lambda: self._dao.image_from_dataset(dataset_name, training_image, filters=filters),
+                            filters)
+
+    def image_metadata_from_label(self, label_id, blob_columns=(), filters=None):
+        filters = self._filters(filters)
+        return self._cached('image_metadata_from_label', (label_id, tuple(blob_columns)),
+                            lambda: self._dao.image_metadata_from_label(label_id, blob_columns, filters=filters),
+                            filters)
+
+    def image_metadata_from_dataset_label(self, dataset_name, label_id, training_image, blob_columns=(),
+                                          filters=None):
+        filters = self._filters(filters)
+        return self._cached('image_metadata_from_dataset_label',
+                            (dataset_name, label_id, training_image, tuple(blob_columns)),
+                            lambda: self._dao.image_metadata_from_dataset_label(dataset_name, label_id,
+                                                                                training_image, blob_columns,
+                                                                                filters=filters),
+                            filters)
+
+    def image_metadata_from_dataset(self, dataset_name, training_image, blob_columns=(), filters=None):
+        filters = self._filters(filters)
+        return self._cached('image_metadata_from_dataset', (dataset_name, training_image, tuple(blob_columns)),
+                            lambda: self._dao.image_metadata_from_dataset(dataset_name, training_image, blob_columns,
+                                                                          filters=filters),
+                            filters)
+
+    def images_by_ids(self, label_id, image_ids, blob_columns=KlustRDAO.BLOB_COLUMNS):
+        return self._cached('images_by_ids', (label_id, tuple(image_ids), tuple(blob_columns)),
+                            lambda: self._dao.images_by_ids(label_id, image_ids, blob_columns))
+
+    def image_checksums_from_dataset(self, dataset_name, training_image, filters=None):
+        # jamais gardées en cache : elles servent justement à détecter les changements
+        return self._dao.image_checksums_from_dataset(dataset_name, training_image, filters=self._filters(filters))
+
+    def create_feature_table(self):
+        return self._dao.create_feature_table()
+
+    def images_missing_features(self, dataset_name, extractor_version):
+        return self._dao.images_missing_features(dataset_name, extractor_version)
+
+    def put_features(self, extractor_version, entries):
+        written = self._dao.put_features(extractor_version, entries)
+        self.invalidate('features_from_dataset')
+        return written
+
+    def features_from_dataset(self, dataset_name, training_image, extractor_version, filters=None):
+        filters = self._filters(filters)
+        return self._cached('features_from_dataset', (dataset_name, training_image, extractor_version),
+                            lambda: self._dao.features_from_dataset(dataset_name, training_image, extractor_version,
+                                                                    filters=filters),
+                            filters)
+
+    # les itérateurs ne sont jamais gardés en cache
+    def iter_image_from_label(self, label_id, itersize=None, filters=None):
+        return self._dao.iter_image_from_label(label_id, itersize, filters=self._filters(filters))
+
+    def iter_image_from_dataset_label(self, dataset_name, label_id, training_image, itersize=None, filters=None):
+        return self._dao.iter_image_from_dataset_label(dataset_name, label_id, training_image, itersize,
+                                                       filters=self._filters(filters))
+
+    def iter_image_from_dataset(self, dataset_name, training_image, itersize=None, filters=None):
+        return self._dao.iter_image_from_dataset(dataset_name, training_image, itersize,
+                                                 filters=self._filters(filters))
+
+
+class InstrumentedKlustRDAO(KlustRDAO):
+    """Mesures des appels d'un autre KlustRDAO (voir QueryStats).
+
+    Chaque méthode du DAO est mesurée sous son nom : nombre d'appels et
+    d'erreurs, histogramme des durées, rangées et octets d'images retournés.
+    Les itérateurs sont mesurés à la fin du parcours. Si le DAO décoré est un
+    PostgreSQLKlustRDAO (éventuellement derrière un CachedKlustRDAO), ses
+    requêtes SQL sont aussi mesurées, sous 'sql:<méthode du DAO>'.
+
+        klustr_dao = InstrumentedKlustRDAO(CachedKlustRDAO(PooledKlustRDAO(credential)))
+        ...
+        klustr_dao.query_stats.dump('klustr_dao_stats.json')
+    """
+
+    def __init__(self, klustr_dao, query_stats=None):
+        super().__init__()
+        self._dao = klustr_dao
+        self._query_stats = query_stats if query_stats is not None else QueryStats()
+        self.set_transformation_filters(klustr_dao.translated, klustr_dao.rotated, klustr_dao.scaled, klustr_dao.exclusive)
+
+        dao = klustr_dao
+        while isinstance(dao, (CachedKlustRDAO, InstrumentedKlustRDAO)):
+            dao = dao.dao
+        if isinstance(dao, PostgreSQLKlustRDAO):
+            dao.query_stats = self._query_stats
+
+    @property
+    def dao(self):
+        return self._dao
+
+    @property
+    def query_stats(self):
+        return self._query_stats
+
+    @property
+    def stats(self):
+        return self._query_stats.stats
+
+    def __getattr__(self, name):
+        # autres méthodes propres au DAO décoré (ex. close, invalidate)
+        return getattr(self._dao, name)
+
+    def set_transformation_filters(self, translated=True, rotated=True, scaled=True, exclusive=True):
+        super().set_transformation_filters(translated, rotated, scaled, exclusive)
+        self._dao.set_transformation_filters(translated, rotated, scaled, exclusive)
+
+    @property
+    def is_available(self):
+        return self._dao.is_available
+
+    @property
+    def total_label_image_count(self):
+        return self._query_stats.measure('total_label_image_count', lambda: self._dao.total_label_image_count)
+
+    @property
+    def available_datasets(self):
+        return self._query_stats.measure('available_datasets', lambda: self._dao.available_datasets)
+
+    @property
+    def available_labels(self):
+        return self._query_stats.measure('available_labels', lambda: self._dao.available_labels)
+
+    def labels_from_dataset(self, dataset_name):
+        return self._query_stats.measure('labels_from_dataset', lambda: self._dao.labels_from_dataset(dataset_name))
+
+    def image_from_label(self, label_id, filters=None):
+        filters = self._filters(filters)
+        return self._query_stats.measure('image_from_label',
+                                         lambda: self._dao.image_from_label(label_id, filters=filters))
+
+    def image_from_dataset_label(self, dataset_name, label_id, training_image, filters=None):
+        filters = self._filters(filters)
+        return self._query_stats.measure('image_from_dataset_label',
+                                         lambda: self._dao.image_from_dataset_label(dataset_name, label_id,
+                                                                                    training_image, filters=filters))
+
+    def image_from_dataset(self, dataset_name, training_image, filters=None):
+        filters = self._filters(filters)
+        return self._query_stats.measure('image_from_dataset',
+                                         lambda: self._dao.image_from_dataset(dataset_name, training_image,
+                                                                              filters=filters))
+
+    def image_metadata_from_label(self, label_id, blob_columns=(), filters=None):
+        filters = self._filters(filters)
+        return self._query_stats.measure('image_metadata_from_label',
+                                         lambda: self._dao.image_metadata_from_label(label_id, blob_columns,
+                                                                                     filters=filters))
+
+    def image_metadata_from_dataset_label(self, dataset_name, label_id, training_image, blob_columns=(),
+                                          filters=None):
+        filters = self._filters(filters)
+        return self._query_stats.measure('image_metadata_from_dataset_label',
+                                         lambda: self._dao.image_metadata_from_dataset_label(dataset_name, label_id,
+                                                                                             training_image,
+                                                                                             blob_columns,
+                                                                                             filters=filters))
+
+    def image_metadata_from_dataset(self, dataset_name, training_image, blob_columns=(), filters=None):
+        filters = self._filters(filters)
+        return self._query_stats.measure('image_metadata_from_dataset',
+                                         lambda: self._dao.image_metadata_from_dataset(dataset_name, training_image,
+                                                                                       blob_columns, filters=filters))
+
+    def images_by_ids(self, label_id, image_ids, blob_columns=KlustRDAO.BLOB_COLUMNS):
+        return self._query_stats.measure('images_by_ids',
+                                         lambda: self._dao.images_by_ids(label_id, image_ids, blob_columns))
+
+    def image_checksums_from_dataset(self, dataset_name, training_image, filters=None):
+        filters = self._filters(filters)
+        return self._query_stats.measure('image_checksums_from_dataset',
+                                         lambda: self._dao.image_checksums_from_dataset(dataset_name, training_image,
+                                                                                        filters=filters))
+
+    def create_feature_table(self):
+        return self._query_stats.measure('create_feature_table', self._dao.create_feature_table)
+
+    def images_missing_features(self, dataset_name, extractor_version):
+        return self._query_stats.measure('images_missing_features',
+                                         lambda: self._dao.images_missing_features(dataset_name, extractor_version))
+
+    def put_features(self, extractor_version, entries):
+        return self._query_stats.measure('put_features', lambda: self._dao.put_features(extractor_version, entries))
+
+    def features_from_dataset(self, dataset_name, training_image, extractor_version, filters=None):
+        filters = self._filters(filters)
+        return self._query_stats.measure('features_from_dataset',
+                                         lambda: self._dao.features_from_dataset(dataset_name, training_image,
+                                                                                 extractor_version, filters=filters))
+
+    def iter_image_from_label(self, label_id, itersize=None, filters=None):
+        return self._query_stats.measure_iterator('iter_image_from_label',
+                                                  self._dao.iter_image_from_label(label_id, itersize,
+                                                                                  filters=self._filters(filters)))
+
+    def iter_image_from_dataset_label(self, dataset_name, label_id, training_image, itersize=None, filters=None):
+        return self._query_stats.measure_iterator('iter_image_from_dataset_label',
+                                                  self._dao.iter_image_from_dataset_label(dataset_name, label_id,
+                                                                                          training_image, itersize,
+                                                                                          filters=self._filters(filters)))
+
+    def iter_image_from_dataset(self, dataset_name, training_image, itersize=None, filters=None):
+        return self._query_stats.measure_iterator('iter_image_from_dataset',
+                                                  self._dao.iter_image_from_dataset(dataset_name, training_image,
+                                                                                    itersize,
+                                                                                    filters=self._filters(filters)))
@@ -0,0 +1,139 @@
+'''Copie des données klustR dans une base SQLite locale (voir SQLiteKlustRDAO).
+
+Les jeux de données, les étiquettes et les images sont lus avec un KlustRDAO
+(en pratique PostgreSQLKlustRDAO), écrits dans un fichier temporaire, puis
+le fichier remplace l'ancienne copie d'un seul coup.
+
+Les déterminants précalculés (table image_feature, voir populate_features) de
+l'ancienne copie sont gardés pour les images dont le PNG n'a pas changé.
+
+Une sauvegarde pg_restore (voir dump/restore_command.txt) ne peut pas être
+lue directement : avec --dump, elle est d'abord restaurée dans la base
+PostgreSQL indiquée, qui est ensuite copiée.
+
+    python klustr_sync.py --password AAAaaa123 --output klustr_replica.sqlite
+    python klustr_sync.py --password AAAaaa123 --dump C:/travail/klustr.dump
+'''
+
+import argparse
+import os
+import sqlite3
+import subprocess
+
+from db_credential import PostgreSQLCredential
+from klustr_dao import PostgreSQLKlustRDAO
+from sqlite_klustr_dao import SQLiteKlustRDAO
+
+
+def _row(row):
+    # psycopg2 retourne les 'buffers' en memoryview
+    return tuple(bytes(value) if isinstance(value, memoryview) else value for value in row)
+
+
+def sync(klustr_dao, path=SQLiteKlustRDAO.DEFAULT_PATH):
+    """Copie toutes les données d'un KlustRDAO dans le fichier SQLite path.
+
+    Args:
+        klustr_dao (KlustRDAO): source des données
+        path (str): fichier de la copie locale
+
+    Returns:
+        dict: nombre de jeux de données, d'étiquettes et d'images copiés
+    """
+    temporary_path = path + '.tmp'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+
+    connection = sqlite3.connect(temporary_path)
+    try:
+        connection.executescript(SQLiteKlustRDAO.SCHEMA)
+
+        datasets = klustr_dao.available_datasets or []
+        connection.executemany('INSERT INTO data_set VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                               [_row(dataset[:9]) for dataset in datasets])
+
+        labels = klustr_dao.available_labels or []
+        connection.executemany('INSERT INTO label VALUES (?, ?, ?);', [_row(label[:3]) for label in labels])
+
+        image_count = 0
+        insert_image = f'INSERT OR REPLACE INTO image VALUES ({", ".join("?" * len(SQLiteKlustRDAO.IMAGE_COLUMNS))});'
+        for label in labels:
+            batch = []
+            for image in klustr_dao.iter_image_from_label(label[0], filters=klustr_dao.ALL_TRANSFORMATIONS):
+                batch.append(_row(image))
+                if len(batch) == 256:
+                    connection.executemany(insert_image, batch)
+                    image_count += len(batch)
+                    batch = []
+            connection.executemany(insert_image, batch)
+            image_count += len(batch)
+
+        for dataset in datasets:
+            name = dataset[1]
+            connection.executemany('INSERT INTO data_set_label VALUES (?, ?, ?);',
+                                   [(name, position, label[0])
+                                    for position, label in enumerate(klustr_dao.labels_from_dataset(name) or [])])
+            for training in (True, False):
+                images = klustr_dao.image_metadata_from_dataset(name, training,
+                                                               filters=klustr_dao.ALL_TRANSFORMATIONS) or []
+                connection.executemany('INSERT OR IGNORE INTO data_set_image VALUES (?, ?, ?, ?);',
+                                       [(name, training, position, image[SQLiteKlustRDAO.IMAGE_ID_COLUMN])
+                                        for position, image in enumerate(images)])
+
+        if os.path.exists(path):
+            _keep_features(connection, path)
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(temporary_path, path)
+    return {'datasets': len(datasets), 'labels': len(labels), 'images': image_count}
+
+
+def _keep_features(connection, previous_path):
+    # déterminants de l'ancienne copie dont le PNG est identique dans la nouvelle
+    SQLiteKlustRDAO.register_md5(connection)
+    connection.execute('ATTACH DATABASE ? AS previous;', (previous_path,))
+    try:
+        if connection.execute("SELECT 1 FROM previous.sqlite_master WHERE name = 'image_feature';").fetchone():
+            connection.execute('''INSERT INTO image_feature
+                                  SELECT feature.* FROM previous.image_feature AS feature
+                                  JOIN image ON image.image_id = feature.image_id
+                                  WHERE feature.checksum = md5(image.png);''')
+        connection.commit()
+    finally:
+        connection.execute('DETACH DATABASE previous;')
+
+
+def restore_dump(dump_path, credential, pg_restore='pg_restore'):
+    """Restaure une sauvegarde pg_restore dans la base PostgreSQL de credential"""
+    subprocess.run([pg_restore,
+                    f'--host={credential.host}',
+                    f'--port={credential.port}',
+                    f'--username={credential.user}',
+                    f'--dbname={credential.database}',
+                    dump_path],
+                   env={**os.environ, 'PGPASSWORD': credential.password},
+                   check=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copie les données klustR dans une base SQLite locale.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--database', default='postgres')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--output', default=SQLiteKlustRDAO.DEFAULT_PATH)
+    parser.add_argument('--dump', help='sauvegarde pg_restore à restaurer avant la copie')
+    parser.add_argument('--pg-restore', default='pg_restore', help='chemin de l\'exécutable pg_restore')
+    args = parser.parse_args()
+
+    credential = PostgreSQLCredential(host=args.host, port=args.port, database=args.database,
+                                      user=args.user, password=args.password)
+    if args.dump:
+        restore_dump(args.dump, credential, args.pg_restore)
+
+    counts = sync(PostgreSQLKlustRDAO(credential, quit_if_connection_failed=True), args.output)
+    print(f'{counts["datasets"]} jeux de données, {counts["labels"]} étiquettes et '
+          f'{counts["images"]} images copiés dans {args.output}')
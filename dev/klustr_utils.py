@@ -1,5 +1,5 @@
 import numpy as np
-from PySide6 import QtCore, QtGui
+from PySide6 import QtGui
 from __feature__ import snake_case, true_property 
 
 
@@ -11,12 +11,20 @@ def qimage_argb32_from_png_decoding(img_data):
 
        En sortie on obtient une QImage du format QImage.Format_ARGB32.'''
     image = QtGui.QImage()
-    if image.load_from_data(QtCore.QByteArray(bytearray(img_data)), 'png'):
+    # psycopg2 retourne un memoryview : une seule copie vers bytes, sans passer par un bytearray
+    if image.load_from_data(img_data if isinstance(img_data, bytes) else bytes(img_data), 'png'):
         return image.convert_to_format(QtGui.QImage.Format_ARGB32)
     
     print("Erreur de décodage d'une image avec la fonction _png_decoding.")
     return image
 
+def qimage_argb32(img_data):
+    '''Retourne l'image d'un 'buffer' PNG, décodé avec qimage_argb32_from_png_decoding,
+       ou img_data si c'est déjà une QImage (ex. décodée d'avance par Prefetcher).'''
+    if isinstance(img_data, QtGui.QImage):
+        return img_data
+    return qimage_argb32_from_png_decoding(img_data)
+
 def ndarray_from_qimage_argb32(img):
     '''Effectue la conversion d'une image de format 
        QImage.Format_ARGB32 vers une matrice numpy.
@@ -25,4 +33,13 @@ def ndarray_from_qimage_argb32(img):
        à une image binaire avec les couleurs noir et blanc.
 
        L'image de sortie est convertie en une matrice de la même taille ayant des valeurs 0-1 en format uint8.'''
-    return (np.frombuffer(img.bits(), dtype=np.uint32).reshape((img.height(), img.width())) != 0xFF000000).astype(np.uint8)
\ No newline at end of file
+    return (np.frombuffer(img.bits(), dtype=np.uint32).reshape((img.height(), img.width())) != 0xFF000000).astype(np.uint8)
+
+def mask_from_qimage_argb32(img):
+    '''Retourne la forme d'une image de format QImage.Format_ARGB32.
+
+       Équivaut à 1 - ndarray_from_qimage_argb32(img), mais en une seule
+       opération sur les pixels de l'image, sans copie intermédiaire.
+
+       La matrice de sortie est booléenne et vaut True sur les pixels noirs opaques (la forme).'''
+    return np.frombuffer(img.bits(), dtype=np.uint32).reshape((img.height(), img.width())) == 0xFF000000
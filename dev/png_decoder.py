@@ -0,0 +1,282 @@
+'''Décodeur PNG minimal basé uniquement sur zlib et NumPy.
+
+Permet d'extraire la forme d'une image binaire klustR sans charger PySide6,
+ce qui garde les processus d'extraction des déterminants légers. Le décodage
+par Qt (voir klustr_utils) reste utilisé pour l'affichage.
+'''
+
+import zlib
+
+import numpy as np
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# nombre d'échantillons par pixel selon le type de couleur
+_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# passes Adam7 : (ligne de départ, colonne de départ, pas des lignes, pas des colonnes)
+_ADAM7 = ((0, 0, 8, 8), (0, 4, 8, 8), (4, 0, 8, 4), (0, 2, 4, 4), (2, 0, 4, 2), (0, 1, 2, 2), (1, 0, 2, 1))
+
+# prédiction des filtres None, Sub, Up et Average (Paeth à part) :
+# (gauche * poids_gauche + haut * poids_haut) >> décalage
+_LINEAR_FILTERS = np.array(((0, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 1), (0, 0, 0)), dtype=np.int16)
+
+
+class PNGDecodingError(ValueError):
+    pass
+
+
+def _read_chunks(view):
+    '''Retourne les blocs (type, contenu) du PNG, sans copier leur contenu.'''
+    if bytes(view[:8]) != PNG_SIGNATURE:
+        raise PNGDecodingError("signature PNG invalide")
+    pos = 8
+    while pos + 8 <= len(view):
+        length = int.from_bytes(view[pos:pos + 4], 'big')
+        chunk_type = bytes(view[pos + 4:pos + 8])
+        yield chunk_type, view[pos + 8:pos + 8 + length]
+        if chunk_type == b'IEND':
+            return
+        pos += 12 + length
+    raise PNGDecodingError("bloc IEND absent")
+
+
+def _paeth(a, b, c):
+    # p = a + b - c : |p - a| = |b - c|, |p - b| = |a - c|, |p - c| = |(b - c) + (a - c)|
+    up, left = b - c, a - c
+    pa, pb, pc = np.abs(up), np.abs(left), np.abs(up + left)
+    return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+
+def _unfilter_wavefront(raw, prev, kinds, bpp):
+    '''Inverse les filtres d'un bloc de lignes consécutives, par anti-diagonales.
+
+    Un pixel ne dépend que de ses voisins de gauche, du haut et du haut à
+    gauche : tous les pixels d'une même anti-diagonale (y + x constant) sont
+    donc calculés ensemble, en hauteur + largeur étapes vectorisées plutôt
+    qu'une étape par pixel pour Average et Paeth. Les pixels sont recopiés
+    par anti-diagonale (diagonals[y + x, octet, y], bordés de zéros) : à
+    chaque étape, la diagonale et ses voisines sont des tranches contiguës.
+    Le bloc est traité par bandes d'environ `largeur` lignes, pour que la
+    copie reste de l'ordre de la taille de l'image.
+
+    Args:
+        raw (np.ndarray): octets filtrés du bloc (h, row_bytes), modifiés sur place
+        prev (np.ndarray): ligne qui précède le bloc, déjà reconstruite
+        kinds (np.ndarray): filtre de chaque ligne du bloc
+        bpp (int): nombre d'octets par pixel
+    '''
+    height, row_bytes = raw.shape
+    width = row_bytes // bpp
+    band = max(width, 16)
+    for top in range(0, height, band):
+        _unfilter_band(raw[top:top + band], prev, kinds[top:top + band], bpp)
+        prev = raw[min(top + band, height) - 1]
+
+
+def _unfilter_band(raw, prev, kinds, bpp):
+    height, row_bytes = raw.shape
+    width = row_bytes // bpp
+
+    # ligne y (bordée : 0 est la ligne précédente) et colonne x (0 est la bordure) -> diagonals[y + x, :, y]
+    diagonals = np.zeros((height + width + 1, bpp, height + 1), dtype=np.int16)
+    diagonals[1:width + 1, :, 0] = prev.reshape(width, bpp)
+    pixels = raw.reshape(height, width, bpp)
+    for y in range(height):
+        diagonals[y + 2:y + width + 2, :, y + 1] = pixels[y]
+
+    left_weights, up_weights, shifts = np.vstack(((0, 0, 0), _LINEAR_FILTERS[kinds])).T
+    paeth_rows = np.append(False, kinds == 4)
+    paeth_only = bool(paeth_rows[1:].all())
+    linear = not paeth_rows.any()
+
+    for t in range(2, height + width + 1):
+        first, last = max(1, t - width), min(height, t - 1) + 1
+        rows = slice(first, last)
+        upper = slice(first - 1, last - 1)
+        left = diagonals[t - 1, :, rows]
+        up = diagonals[t - 1, :, upper]
+        if paeth_only:
+            predictor = _paeth(left, up, diagonals[t - 2, :, upper])
+        else:
+            predictor = (left * left_weights[rows] + up * up_weights[rows]) >> shifts[rows]
+            if not linear:
+                predictor = np.where(paeth_rows[rows], _paeth(left, up, diagonals[t - 2, :, upper]), predictor)
+        current = diagonals[t, :, rows]
+        current += predictor
+        current &= 0xFF
+
+    for y in range(height):
+        pixels[y] = diagonals[y + 2:y + width + 2, :, y + 1]
+
+
+def _unfilter(raw, height, row_bytes, bpp):
+    '''Inverse les filtres PNG.
+
+    Les filtres None, Sub et Up sont vectorisés sur toute la ligne. Average et
+    Paeth dépendent du pixel précédent : les lignes de la première à la
+    dernière qui les utilisent sont reconstruites ensemble, par
+    anti-diagonales (voir _unfilter_wavefront).
+    '''
+    rows = np.frombuffer(raw, dtype=np.uint8, count=height * (row_bytes + 1)).reshape(height, row_bytes + 1)
+    filters = rows[:, 0]
+    if not filters.any():
+        # aucun filtre : vue en lecture seule sur les données décompressées, sans copie
+        return rows[:, 1:]
+    if (filters > 4).any():
+        raise PNGDecodingError(f"filtre PNG inconnu : {filters[filters > 4][0]}")
+    out = rows[:, 1:].copy()
+
+    wavefront = np.flatnonzero(filters >= 3)
+    first, end = (wavefront[0], wavefront[-1] + 1) if wavefront.size else (height, height)
+
+    prev = np.zeros(row_bytes, dtype=np.uint8)
+    for y in range(first):
+        prev = _unfilter_line(out[y], prev, filters[y], bpp)
+    if first < end:
+        _unfilter_wavefront(out[first:end], prev, filters[first:end], bpp)
+        prev = out[end - 1]
+    for y in range(end, height):
+        prev = _unfilter_line(out[y], prev, filters[y], bpp)
+    return out
+
+
+def _unfilter_line(line, prev, kind, bpp):
+    '''Inverse le filtre None, Sub ou Up d'une ligne, sur place, et la retourne.'''
+    if kind == 1:
+        row_bytes = len(line)
+        line[:] = np.cumsum(np.pad(line, (0, -row_bytes % bpp)).reshape(-1, bpp), axis=0, dtype=np.uint8).ravel()[:row_bytes]
+    elif kind == 2:
+        line += prev
+    return line
+
+
+def _samples(lines, width, channels, bit_depth):
+    '''Convertit les lignes d'octets en matrice (H, W, canaux) d'échantillons.'''
+    height = lines.shape[0]
+    if bit_depth == 16:
+        return lines.view('>u2').reshape(height, width, channels)
+    if bit_depth == 8:
+        return lines.reshape(height, width, channels)
+    bits = np.unpackbits(lines, axis=1)[:, :width * channels * bit_depth]
+    if bit_depth == 1:
+        return bits.reshape(height, width, channels)
+    weights = (1 << np.arange(bit_depth - 1, -1, -1)).astype(np.uint8)
+    return (bits.reshape(height, width * channels, bit_depth) @ weights).astype(np.uint8).reshape(height, width, channels)
+
+
+def decode_png(data):
+    '''Décode un 'buffer' PNG.
+
+    Args:
+        data (bytes | memoryview): contenu de l'image PNG
+
+    Returns:
+        tuple[np.ndarray, dict]: échantillons (H, W, canaux) et informations
+        de l'en-tête (width, height, bit_depth, color_type, palette, transparency)
+    '''
+    # le contenu des blocs est lu par tranches de memoryview : le 'buffer' reçu
+    # (ex. memoryview de psycopg2) est passé à zlib sans être copié
+    view = memoryview(data)
+    info = {'palette': None, 'transparency': None}
+    decompressor = zlib.decompressobj()
+    raw = []
+    for chunk_type, body in _read_chunks(view):
+        if chunk_type == b'IHDR':
+            width, height, bit_depth, color_type, _, _, interlace = \
+                int.from_bytes(body[0:4], 'big'), int.from_bytes(body[4:8], 'big'), *bytes(body[8:13])
+            if color_type not in _CHANNELS:
+                raise PNGDecodingError(f"type de couleur PNG inconnu : {color_type}")
+            info.update(width=width, height=height, bit_depth=bit_depth, color_type=color_type)
+        elif chunk_type == b'PLTE':
+            info['palette'] = np.frombuffer(body, dtype=np.uint8).reshape(-1, 3)
+        elif chunk_type == b'tRNS':
+            info['transparency'] = np.frombuffer(body, dtype=np.uint8)
+        elif chunk_type == b'IDAT':
+            raw.append(decompressor.decompress(body))
+    if 'width' not in info:
+        raise PNGDecodingError("bloc IHDR absent")
+    raw.append(decompressor.flush())
+    raw = b''.join(raw)
+
+    channels = _CHANNELS[color_type]
+    bits_per_pixel = channels * bit_depth
+    bpp = max(1, bits_per_pixel // 8)
+
+    if not interlace:
+        row_bytes = (width * bits_per_pixel + 7) // 8
+        if len(raw) < height * (row_bytes + 1):
+            raise PNGDecodingError("données d'image incomplètes")
+        return _samples(_unfilter(raw, height, row_bytes, bpp), width, channels, bit_depth), info
+
+    dtype = np.uint16 if bit_depth == 16 else np.uint8
+    samples = np.zeros((height, width, channels), dtype=dtype)
+    pos = 0
+    for row0, col0, row_step, col_step in _ADAM7:
+        pass_width = (width - col0 + col_step - 1) // col_step
+        pass_height = (height - row0 + row_step - 1) // row_step
+        if pass_width == 0 or pass_height == 0:
+            continue
+        row_bytes = (pass_width * bits_per_pixel + 7) // 8
+        size = pass_height * (row_bytes + 1)
+        if len(raw) < pos + size:
+            raise PNGDecodingError("données d'image incomplètes")
+        lines = _unfilter(memoryview(raw)[pos:pos + size], pass_height, row_bytes, bpp)
+        samples[row0::row_step, col0::col_step] = _samples(lines, pass_width, channels, bit_depth)
+        pos += size
+    return samples, info
+
+
+def _to_8_bits(samples, bit_depth):
+    '''Ramène les échantillons sur 8 bits comme le fait Qt.'''
+    if bit_depth == 16:
+        samples = samples.astype(np.uint32)
+        return ((samples + 128 - (samples >> 8)) >> 8).astype(np.uint8)
+    if bit_depth < 8:
+        return (samples.astype(np.uint16) * 255 // ((1 << bit_depth) - 1)).astype(np.uint8)
+    return samples
+
+
+def mask_from_png(data):
+    '''Décode une image PNG binaire klustR en matrice booléenne de la forme.
+
+    Un pixel fait partie de la forme s'il est noir et opaque, ce qui correspond
+    à 1 - ndarray_from_qimage_argb32(qimage_argb32_from_png_decoding(data)).
+
+    Args:
+        data (bytes | memoryview): contenu de l'image PNG
+
+    Returns:
+        np.ndarray: matrice booléenne (H, W), True sur la forme
+    '''
+    samples, info = decode_png(data)
+    color_type, bit_depth, transparency = info['color_type'], info['bit_depth'], info['transparency']
+
+    if color_type == 3:
+        palette = info['palette']
+        if palette is None:
+            raise PNGDecodingError("bloc PLTE absent")
+        alpha = np.full(len(palette), 255, dtype=np.uint8)
+        if transparency is not None:
+            alpha[:len(transparency)] = transparency[:len(palette)]
+        black = (palette == 0).all(axis=1) & (alpha == 255)
+        # un index hors palette est lu comme du noir opaque par Qt, mais on l'écarte
+        black = np.append(black, np.zeros(256 - len(black), dtype=bool))
+        return black[samples[:, :, 0]]
+
+    color_channels = 1 if color_type in (0, 4) else 3
+    if color_channels == 1 and bit_depth <= 8:
+        # cas habituel des images binaires : une seule comparaison, sans conversion
+        black = samples[:, :, 0] == 0
+    else:
+        black = (_to_8_bits(samples[:, :, :color_channels], bit_depth) == 0).all(axis=2)
+
+    if color_type in (4, 6):
+        return black & (_to_8_bits(samples[:, :, -1], bit_depth) == 255)
+
+    if transparency is not None:
+        # couleur transparente (tRNS) : un échantillon de 16 bits par canal
+        key = transparency.view('>u2')[:color_channels]
+        black &= ~(key == 0).all()
+    return black
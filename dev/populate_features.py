@@ -0,0 +1,96 @@
+'''Calcul des déterminants manquants de la table des déterminants du DAO.
+
+Pour chaque jeu de données, les images sans déterminants à jour pour la
+version de l'extracteur (voir KlustRDAO.images_missing_features) sont lues
+par paquets, leurs déterminants calculés avec FeatureIngest, puis écrits
+avec KlustRDAO.put_features. Les clients chargent ensuite un KNN avec
+KlustRDAO.features_from_dataset, sans transférer les images.
+
+L'écriture dans PostgreSQL demande un utilisateur qui peut créer la table
+klustr.image_feature et y écrire ; avec --sqlite, la copie locale (voir
+klustr_sync) est complétée à la place.
+
+    python populate_features.py --password AAAaaa123
+    python populate_features.py --sqlite klustr_replica.sqlite --dataset "ABC"
+'''
+
+import argparse
+import hashlib
+
+from feature_ingest import FeatureIngest
+
+
+def populate(klustr_dao, dataset_name, ingest=None, batch_size=256):
+    """Calcule et écrit les déterminants manquants des images d'un jeu de données.
+
+    Args:
+        klustr_dao (KlustRDAO): DAO avec table des déterminants
+        dataset_name (str): nom du jeu de données
+        ingest (FeatureIngest): extraction des déterminants (plan et version de l'extracteur)
+        batch_size (int): nombre maximal d'images lues à la fois
+
+    Returns:
+        tuple[int, list]: nombre de déterminants écrits, échecs d'extraction (voir IngestFailure)
+    """
+    ingest = ingest or FeatureIngest()
+    version = ingest.extractor_version
+    missing = klustr_dao.images_missing_features(dataset_name, version)
+    if missing is None:
+        raise ConnectionError(f"images du jeu de données {dataset_name} indisponibles")
+
+    by_label = {}
+    for image_id, label_id in missing:
+        by_label.setdefault(label_id, []).append(image_id)
+
+    written, failures = 0, []
+    for label_id, image_ids in by_label.items():
+        for start in range(0, len(image_ids), batch_size):
+            # seuls les PNG sont transférés (voir KlustRDAO.images_by_ids)
+            rows = klustr_dao.images_by_ids(label_id, image_ids[start:start + batch_size], (klustr_dao.IMAGE_COLUMN,))
+            if rows is None:
+                raise ConnectionError(f"images de l'étiquette {label_id} indisponibles")
+
+            result = ingest.run(rows)
+            checksums = {row[klustr_dao.IMAGE_ID_COLUMN]: hashlib.md5(row[klustr_dao.IMAGE_COLUMN]).hexdigest()
+                         for row in rows}
+            count = klustr_dao.put_features(version, [(image_id, checksums[image_id], features)
+                                                      for image_id, features in zip(result.image_ids, result.features)])
+            if count is None:
+                raise ConnectionError(f"écriture des déterminants de l'étiquette {label_id} impossible")
+            written += count
+            failures += result.failures
+    return written, failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calcule les déterminants manquants de la table des déterminants.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--database', default='postgres')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--sqlite', help='copie locale à compléter plutôt que la base PostgreSQL')
+    parser.add_argument('--dataset', action='append', help='jeu de données (par défaut : tous)')
+    parser.add_argument('--batch-size', type=int, default=256)
+    args = parser.parse_args()
+
+    if args.sqlite:
+        from sqlite_klustr_dao import SQLiteKlustRDAO
+        klustr_dao = SQLiteKlustRDAO(args.sqlite)
+    else:
+        from db_credential import PostgreSQLCredential
+        from klustr_dao import PostgreSQLKlustRDAO
+        credential = PostgreSQLCredential(host=args.host, port=args.port, database=args.database,
+                                          user=args.user, password=args.password)
+        klustr_dao = PostgreSQLKlustRDAO(credential, quit_if_connection_failed=True)
+
+    if klustr_dao.create_feature_table() is None:
+        raise SystemExit('table des déterminants indisponible')
+
+    ingest = FeatureIngest()
+    try:
+        for name in args.dataset or [dataset[1] for dataset in klustr_dao.available_datasets or []]:
+            written, failures = populate(klustr_dao, name, ingest, args.batch_size)
+            print(f'{name} : {written} déterminants écrits, {len(failures)} image(s) ignorée(s)')
+    finally:
+        ingest.close()
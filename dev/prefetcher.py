@@ -0,0 +1,203 @@
+from collections import OrderedDict, deque
+import threading
+
+from async_klustr_dao import run_request
+from klustr_utils import qimage_argb32_from_png_decoding
+
+from PySide6.QtGui import QImage
+from __feature__ import snake_case, true_property
+
+
+class Prefetcher:
+    """Lecture anticipée des requêtes d'un KlustRDAO, gardées en mémoire.
+
+    Les vues parcourent surtout les jeux de données, les étiquettes et les
+    images dans l'ordre des listes : à chaque sélection, les requêtes des
+    voisines sont confiées au Prefetcher, qui les exécute (et décode leurs
+    images) dans un seul fil de travail, en basse priorité. Ce fil attend
+    tant qu'une requête de l'interface est en cours (voir
+    AsyncKlustRDAO.is_busy).
+
+    Les résultats sont gardés dans un cache LRU limité en octets (budget) ;
+    une requête est identifiée par (request, args, filters), comme pour
+    AsyncKlustRDAO.call.
+
+    Les requêtes anticipées sont regroupées (ex. 'labels', 'images') : une
+    nouvelle anticipation remplace celles du même groupe qui ne sont pas
+    encore faites, et le dernier groupe anticipé passe en premier.
+    """
+
+    DEFAULT_BUDGET = 64 * 1024 * 1024
+    IDLE_DELAY = 0.05
+
+    def __init__(self, klustr_dao, budget=DEFAULT_BUDGET, foreground=None, ignored_channels=()):
+        """
+        Args:
+            klustr_dao (KlustRDAO): DAO interrogé, utilisable par plusieurs fils d'exécution
+            budget (int): taille maximale des résultats gardés, en octets
+            foreground (AsyncKlustRDAO): requêtes de l'interface, prioritaires
+            ignored_channels (tuple[str]): canaux de foreground qui ne bloquent pas l'anticipation
+            (ex. un long parcours des images d'entrainement)
+        """
+        self._dao = klustr_dao
+        self._budget = budget
+        self._foreground = foreground
+        self._ignored_channels = tuple(ignored_channels)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._tasks = OrderedDict()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self.__run, name='klustr_prefetch', daemon=True)
+        self._thread.start()
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def stats(self):
+        """Retourne un dictionnaire : succès, échecs, nombre de résultats et octets gardés"""
+        with self._condition:
+            return {'hits': self._hits, 'misses': self._misses, 'entries': len(self._entries), 'size': self._size}
+
+    @staticmethod
+    def key(request, args=(), filters=None):
+        return request, tuple(args), filters
+
+    @staticmethod
+    def decoded(*columns):
+        """Retourne une fonction qui décode en QImage les PNG des colonnes données de chaque rangée"""
+        def decode(rows):
+            if rows is None:
+                return None
+            return [tuple(qimage_argb32_from_png_decoding(value) if i in columns and value is not None else value
+                          for i, value in enumerate(row))
+                    for row in rows]
+        return decode
+
+    @staticmethod
+    def size_of(value):
+        """Estime la mémoire occupée par un résultat, en octets"""
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        if isinstance(value, memoryview):
+            return value.nbytes
+        if isinstance(value, QImage):
+            return value.size_in_bytes()
+        if isinstance(value, (tuple, list)):
+            return 64 + sum(Prefetcher.size_of(item) for item in value)
+        return 32
+
+    def get(self, key):
+        """Retourne le résultat gardé d'une requête, ou None"""
+        with self._condition:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Garde un résultat ; les plus anciens sont oubliés pour respecter le budget"""
+        if value is None:
+            return
+        size = self.size_of(value)
+        if size > self._budget:
+            return
+        with self._condition:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self._budget:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= evicted
+
+    def fetch(self, async_dao, channel, request, *args, callback, filters=None):
+        """Appelle callback avec le résultat d'une requête : gardé en mémoire, sinon lu par async_dao.
+
+        Le résultat gardé est remis aussitôt (la requête en cours du canal est
+        annulée) ; sinon, la requête passe par async_dao.call et son résultat
+        est gardé.
+        """
+        key = self.key(request, args, filters)
+        value = self.get(key)
+        if value is not None:
+            async_dao.cancel(channel)
+            callback(value)
+            return
+
+        def store(result):
+            self.put(key, result)
+            callback(result)
+
+        async_dao.call(channel, request, *args, callback=store, filters=filters)
+
+    def prefetch(self, group, requests):
+        """Remplace les requêtes à anticiper d'un groupe.
+
+        Args:
+            group (str): groupe des requêtes (ex. 'images')
+            requests (list[tuple]): (request, args, filters, decode) dans l'ordre de priorité ;
+            decode (callable ou None) transforme le résultat dans le fil de travail (voir decoded)
+        """
+        with self._condition:
+            self._tasks.pop(group, None)
+            tasks = deque((self.key(request, args, filters), decode)
+                          for request, args, filters, decode in requests
+                          if self.key(request, args, filters) not in self._entries)
+            if tasks:
+                self._tasks[group] = tasks
+                self._condition.notify()
+
+    def cancel(self, group=None):
+        """Oublie les requêtes à anticiper d'un groupe, ou de tous les groupes"""
+        with self._condition:
+            if group is None:
+                self._tasks.clear()
+            else:
+                self._tasks.pop(group, None)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._tasks.clear()
+            self._condition.notify()
+
+    def __next_task(self):
+        with self._condition:
+            while True:
+                if self._closed:
+                    return None
+                if not self._tasks:
+                    self._condition.wait()
+                elif self._foreground is not None and self._foreground.is_busy(self._ignored_channels):
+                    # basse priorité : l'interface passe d'abord
+                    self._condition.wait(self.IDLE_DELAY)
+                else:
+                    group, tasks = next(reversed(self._tasks.items()))
+                    key, decode = tasks.popleft()
+                    if not tasks:
+                        del self._tasks[group]
+                    if key not in self._entries:
+                        return key, decode
+
+    def __run(self):
+        while (task := self.__next_task()) is not None:
+            (request, args, filters), decode = task
+            try:
+                value = run_request(self._dao, request, args, filters)
+                self.put((request, args, filters), decode(value) if decode is not None else value)
+            except Exception as error:
+                # sans conséquence : la requête sera faite par l'interface au besoin
+                print(f'Prefetcher : la lecture anticipée de {request} a échoué : {error}')
@@ -0,0 +1,185 @@
+'''Registre des déterminants de forme.
+
+Chaque déterminant déclare l'ordre des moments bruts et les autres mesures
+(périmètre, rayons, enveloppe convexe...) dont il a besoin. Un FeaturePlan
+regroupe les déterminants choisis, prépare ces mesures une seule fois par
+image à l'aide de ShapeMeasures, puis évalue chaque déterminant.
+
+Pour ajouter un déterminant :
+
+    @register_feature('nom', 'Titre', moment_order=2, requires=('radii',))
+    def _nom(measures):
+        return ...
+'''
+
+import numpy as np
+
+from utils.shapemeasures import ShapeMeasures
+
+
+def roundness(area, perim):
+    """Retourne la circularité de l'aire et circonférence du cercle
+
+    Args:
+        area (float): aire de la forme
+        perim (float): périmètre de la forme
+
+    Returns:
+        float: ratio de la circularité
+    """
+    return (4 * np.pi * area) / (perim ** 2)
+
+
+def circle_ratio(min_radius, max_radius):
+    """Retourne un rapport de l'air de du petit cercle sur l'aire du grand cercle
+    créés avec le centre de l'image et la plus petite et grande distance de cette dernière.
+
+    Args:
+        min_radius (float): plus petite distance entre le centre et le périmètre
+        max_radius (float): plus grande distance entre le centre et le périmètre
+
+    Returns:
+        float: ratio du rapport
+    """
+    small_circle_area = np.pi * min_radius ** 2
+    big_circle_area = np.pi * max_radius ** 2
+
+    return small_circle_area / big_circle_area
+
+
+def density(area, max_radius):
+    """Retourne la densité de l'image et du cercle
+        créé avec la plus grosse distance à partir
+        du centre de l'image
+
+    Args:
+        area (float): aire de la forme
+        max_radius (float): plus grande distance entre le centre et le périmètre
+
+    Returns:
+        float: densité de l'aire de l'image et de l'aire du cercle
+    """
+    big_circle_area = np.pi * max_radius ** 2
+    return area / big_circle_area
+
+
+class ShapeFeature:
+    """Déterminant du registre et mesures dont il a besoin."""
+
+    def __init__(self, name, title, compute, moment_order=0, requires=()):
+        self.name = name
+        self.title = title
+        self.compute = compute
+        self.moment_order = moment_order
+        self.requires = tuple(requires)
+
+
+FEATURES = {}
+
+
+def register_feature(name, title, moment_order=0, requires=()):
+    """Décorateur ajoutant un déterminant au registre.
+
+    Args:
+        name (str): nom unique du déterminant
+        title (str): titre affiché (ex. axe du nuage de points)
+        moment_order (int): ordre maximal des moments bruts utilisés
+        requires (tuple[str]): autres mesures de ShapeMeasures utilisées
+    """
+    def decorator(compute):
+        if name in FEATURES:
+            raise ValueError(f"déterminant déjà enregistré : {name}")
+        FEATURES[name] = ShapeFeature(name, title, compute, moment_order, requires)
+        return compute
+    return decorator
+
+
+@register_feature('roundness', 'Roundness', requires=('perimeter',))
+def _roundness(measures):
+    return roundness(measures.area, measures.perimeter)
+
+
+@register_feature('circle_ratio', 'Rapport de cercle', moment_order=1, requires=('radii',))
+def _circle_ratio(measures):
+    return circle_ratio(*measures.radii)
+
+
+@register_feature('density', 'Densité', moment_order=1, requires=('radii',))
+def _density(measures):
+    return density(measures.area, measures.radii[1])
+
+
+@register_feature('eccentricity', 'Excentricité', moment_order=2, requires=('inertia',))
+def _eccentricity(measures):
+    major, minor = measures.inertia
+    return np.sqrt(1 - minor / major)
+
+
+@register_feature('elongation', 'Élongation', moment_order=2, requires=('inertia',))
+def _elongation(measures):
+    major, minor = measures.inertia
+    return 1 - np.sqrt(minor / major)
+
+
+@register_feature('solidity', 'Solidité', requires=('hull_area',))
+def _solidity(measures):
+    return measures.area / measures.hull_area
+
+
+def _register_hu_moment(i):
+    register_feature(f'hu{i + 1}', f'Hu {i + 1}', moment_order=3, requires=('hu_moments',))(
+        lambda measures: measures.hu_moments[i])
+
+
+for _i in range(7):
+    _register_hu_moment(_i)
+
+
+DEFAULT_FEATURES = ('roundness', 'circle_ratio', 'density')
+
+
+class FeaturePlan:
+    """Ensemble ordonné de déterminants à calculer pour chaque image."""
+
+    def __init__(self, names=DEFAULT_FEATURES):
+        unknown = [name for name in names if name not in FEATURES]
+        if unknown:
+            raise ValueError(f"déterminant(s) inconnu(s) : {', '.join(unknown)}")
+
+        self._features = [FEATURES[name] for name in names]
+        self._moment_order = max(feature.moment_order for feature in self._features)
+        self._requires = list(dict.fromkeys(requirement for feature in self._features
+                                            for requirement in feature.requires))
+
+    def __len__(self):
+        return len(self._features)
+
+    @property
+    def names(self):
+        return tuple(feature.name for feature in self._features)
+
+    @property
+    def titles(self):
+        return [feature.title for feature in self._features]
+
+    @property
+    def is_default(self):
+        return self.names == DEFAULT_FEATURES
+
+    def compute(self, measures: ShapeMeasures) -> np.ndarray:
+        """Retourne les déterminants d'une forme.
+
+        Les moments bruts jusqu'à l'ordre le plus élevé demandé, puis les
+        autres mesures requises, sont calculés une seule fois et partagés par
+        tous les déterminants du plan.
+
+        Args:
+            measures (ShapeMeasures): mesures de la forme
+
+        Returns:
+            np.ndarray: déterminants, dans l'ordre du plan
+        """
+        measures.raw_moments(self._moment_order)
+        for requirement in self._requires:
+            getattr(measures, requirement)
+        return np.array([feature.compute(measures) for feature in self._features])
@@ -0,0 +1,295 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+from klustr_dao import KlustRDAO
+
+
+sqlite3.register_converter('KLUSTR_BOOLEAN', lambda value: value == b'1')
+
+
+class SQLiteKlustRDAO(KlustRDAO):
+    """Copie locale (SQLite) des données klustR, créée par klustr_sync.
+
+    Retourne les mêmes rangées que PostgreSQLKlustRDAO : les jeux de données,
+    les étiquettes et les images sont lus dans un fichier local indexé, sans
+    serveur de base de données.
+
+    Les images sont gardées avec les colonnes et dans l'ordre des rangées du
+    DAO (voir KlustRDAO.IMAGE_COLUMN...) ; les filtres de transformation sont
+    appliqués dans la requête (voir KlustRDAO.matches_transformation_filters).
+    """
+
+    DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klustr_replica.sqlite')
+
+    IMAGE_COLUMNS = ('label_id', 'label_name', 'image_id', 'name', 'width', 'height', 'png', 'thumbnail',
+                     'extra_8', 'extra_9', 'extra_10', 'transformation')
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS data_set (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            translated KLUSTR_BOOLEAN,
+            rotated KLUSTR_BOOLEAN,
+            scaled KLUSTR_BOOLEAN,
+            label_count INTEGER,
+            training_image_count INTEGER,
+            test_image_count INTEGER,
+            image_count INTEGER);
+        CREATE TABLE IF NOT EXISTS label (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            thumbnail BLOB);
+        CREATE TABLE IF NOT EXISTS image (
+            label_id INTEGER NOT NULL,
+            label_name TEXT,
+            image_id INTEGER PRIMARY KEY,
+            name TEXT,
+            width INTEGER,
+            height INTEGER,
+            png BLOB,
+            thumbnail BLOB,
+            extra_8,
+            extra_9,
+            extra_10,
+            transformation TEXT);
+        CREATE TABLE IF NOT EXISTS data_set_label (
+            data_set_name TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            label_id INTEGER NOT NULL,
+            PRIMARY KEY (data_set_name, label_id));
+        CREATE TABLE IF NOT EXISTS data_set_image (
+            data_set_name TEXT NOT NULL,
+            training INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            image_id INTEGER NOT NULL,
+            PRIMARY KEY (data_set_name, training, image_id));
+        CREATE TABLE IF NOT EXISTS image_feature (
+            image_id INTEGER NOT NULL,
+            extractor_version TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            features BLOB NOT NULL,
+            PRIMARY KEY (image_id, extractor_version));
+        CREATE INDEX IF NOT EXISTS image_label ON image (label_id);
+        CREATE INDEX IF NOT EXISTS data_set_image_position ON data_set_image (data_set_name, training, position);
+        CREATE INDEX IF NOT EXISTS data_set_label_position ON data_set_label (data_set_name, position);
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, itersize=64):
+        super().__init__()
+        self._path = path
+        self.itersize = itersize
+        self._lock = threading.Lock()
+        try:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"copie locale introuvable : {path} (voir klustr_sync)")
+            self._connection = self._connect()
+            self._is_available = True
+        except Exception as error:
+            self._connection = None
+            self._is_available = False
+            print('L\'ouverture de la copie locale a échouée avec le message suivant :')
+            print('-'*80)
+            print(type(error))
+            print(error)
+            print('-'*80)
+
+    @staticmethod
+    def register_md5(connection):
+        # md5 hexadécimal, comme celui de PostgreSQL (voir image_checksums_from_dataset)
+        connection.create_function('md5', 1, lambda data: None if data is None else hashlib.md5(data).hexdigest(),
+                                   deterministic=True)
+
+    def _connect(self):
+        connection = sqlite3.connect(self._path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        connection.executescript(self.SCHEMA)
+        self.register_md5(connection)
+        return connection
+
+    def reload(self):
+        # klustr_sync remplace le fichier : une connexion déjà ouverte lit encore l'ancienne copie
+        self.close()
+        self._connection = self._connect()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _execute_simple_query(self, query, param_to_bind=tuple()):
+        if self.is_available:
+            try:
+                with self._lock:
+                    return self._connection.execute(query, param_to_bind).fetchall()
+            except Exception as error:
+                print('SQLiteKlustRDAO : erreur de la requete avec le message suivant :')
+                print('-' * 80)
+                print(type(error))
+                print(error)
+                print(f'Avec la requete :\n{query}')
+                print('-' * 80)
+        else:
+            print('SQLiteKlustRDAO n\'est pas disponible.')
+        return None
+
+    def _execute_write(self, query, rows):
+        if self.is_available:
+            try:
+                with self._lock, self._connection:
+                    self._connection.executemany(query, rows)
+                return len(rows)
+            except Exception as error:
+                print('SQLiteKlustRDAO : erreur de l\'écriture avec le message suivant :')
+                print('-' * 80)
+                print(type(error))
+                print(error)
+                print(f'Avec la requete :\n{query}')
+                print('-' * 80)
+        else:
+            print('SQLiteKlustRDAO n\'est pas disponible.')
+        return None
+
+    def _iterate_query(self, query, param_to_bind=tuple(), itersize=None):
+        # connexion propre à l'itérateur : le parcours ne bloque pas les autres requêtes
+        if self.is_available:
+            connection = self._connect()
+            try:
+                cursor = connection.execute(query, param_to_bind)
+                while rows := cursor.fetchmany(itersize or self.itersize):
+                    yield from rows
+            finally:
+                connection.close()
+        else:
+            print('SQLiteKlustRDAO n\'est pas disponible.')
+
+    def _image_query(self, blob_columns, source, condition, order, filtered=True, columns=None, filters=None):
+        columns = columns or ', '.join('NULL' if i in self.BLOB_COLUMNS and i not in blob_columns else f'image.{name}'
+                                       for i, name in enumerate(self.IMAGE_COLUMNS))
+        conditions, params = [condition], ()
+        if filtered:
+            transformation, params = self._transformation_condition('image.transformation', '?', filters)
+            if transformation:
+                conditions.append(transformation)
+        return f'SELECT {columns} FROM {source} WHERE {" AND ".join(conditions)} ORDER BY {order};', params
+
+    def _label_query(self, blob_columns=KlustRDAO.BLOB_COLUMNS, filters=None):
+        return self._image_query(blob_columns, 'image', 'image.label_id = ?', 'image.rowid', filters=filters)
+
+    def _dataset_query(self, with_label, blob_columns=KlustRDAO.BLOB_COLUMNS, columns=None, filters=None):
+        condition = 'data_set_image.data_set_name = ? AND data_set_image.training = ?'
+        if with_label:
+            condition += ' AND image.label_id = ?'
+        return self._image_query(blob_columns,
+                                 'data_set_image JOIN image ON image.image_id = data_set_image.image_id',
+                                 condition, 'data_set_image.position', columns=columns, filters=filters)
+
+    @property
+    def is_available(self):
+        return self._is_available and self._connection is not None
+
+    @property
+    def total_label_image_count(self):
+        return self._execute_simple_query('SELECT (SELECT COUNT(*) FROM label), (SELECT COUNT(*) FROM image);')
+
+    @property
+    def available_datasets(self):
+        return self._execute_simple_query('SELECT * FROM data_set ORDER BY id;')
+
+    @property
+    def available_labels(self):
+        return self._execute_simple_query('SELECT id, name, thumbnail FROM label ORDER BY id;')
+
+    def labels_from_dataset(self, dataset_name):
+        return self._execute_simple_query(
+                        '''SELECT label.id, label.name, label.thumbnail
+                           FROM data_set_label JOIN label ON label.id = data_set_label.label_id
+                           WHERE data_set_label.data_set_name = ? ORDER BY data_set_label.position;''',
+                        (dataset_name,))
+
+    def image_from_label(self, label_id, filters=None):
+        query, params = self._label_query(filters=filters)
+        return self._execute_simple_query(query, (label_id, *params))
+
+    def image_from_dataset_label(self, dataset_name, label_id, training_image, filters=None):
+        query, params = self._dataset_query(True, filters=filters)
+        return self._execute_simple_query(query, (dataset_name, training_image, label_id, *params))
+
+    def image_from_dataset(self, dataset_name, training_image, filters=None):
+        query, params = self._dataset_query(False, filters=filters)
+        return self._execute_simple_query(query, (dataset_name, training_image, *params))
+
+    def iter_image_from_label(self, label_id, itersize=None, filters=None):
+        query, params = self._label_query(filters=filters)
+        return self._iterate_query(query, (label_id, *params), itersize)
+
+    def iter_image_from_dataset_label(self, dataset_name, label_id, training_image, itersize=None, filters=None):
+        query, params = self._dataset_query(True, filters=filters)
+        return self._iterate_query(query, (dataset_name, training_image, label_id, *params), itersize)
+
+    def iter_image_from_dataset(self, dataset_name, training_image, itersize=None, filters=None):
+        query, params = self._dataset_query(False, filters=filters)
+        return self._iterate_query(query, (dataset_name, training_image, *params), itersize)
+
+    def image_metadata_from_label(self, label_id, blob_columns=(), filters=None):
+        query, params = self._label_query(blob_columns, filters=filters)
+        return self._execute_simple_query(query, (label_id, *params))
+
+    def image_metadata_from_dataset_label(self, dataset_name, label_id, training_image, blob_columns=(), filters=None):
+        query, params = self._dataset_query(True, blob_columns, filters=filters)
+        return self._execute_simple_query(query, (dataset_name, training_image, label_id, *params))
+
+    def image_metadata_from_dataset(self, dataset_name, training_image, blob_columns=(), filters=None):
+        query, params = self._dataset_query(False, blob_columns, filters=filters)
+        return self._execute_simple_query(query, (dataset_name, training_image, *params))
+
+    def image_checksums_from_dataset(self, dataset_name, training_image, filters=None):
+        query, params = self._dataset_query(False, columns='image.image_id, image.label_id, md5(image.png)',
+                                            filters=filters)
+        return self._execute_simple_query(query, (dataset_name, training_image, *params))
+
+    def images_by_ids(self, label_id, image_ids, blob_columns=KlustRDAO.BLOB_COLUMNS):
+        image_ids = list(image_ids)
+        rows = []
+        for start in range(0, len(image_ids), 500):
+            chunk = image_ids[start:start + 500]
+            query, _ = self._image_query(blob_columns, 'image',
+                                         f'image.label_id = ? AND image.image_id IN ({", ".join("?" * len(chunk))})',
+                                         'image.rowid', filtered=False)
+            found = self._execute_simple_query(query, (label_id, *chunk))
+            if found is None:
+                return None
+            rows += found
+        return self._order_by_ids(rows, image_ids)
+
+    # la table image_feature fait partie du schéma de la copie locale
+    def create_feature_table(self):
+        return 0
+
+    def images_missing_features(self, dataset_name, extractor_version):
+        query, _ = self._image_query((), 'data_set_image JOIN image ON image.image_id = data_set_image.image_id',
+                                     '''data_set_image.data_set_name = ? AND NOT EXISTS (
+                                            SELECT 1 FROM image_feature
+                                            WHERE image_feature.image_id = image.image_id
+                                            AND image_feature.extractor_version = ?
+                                            AND image_feature.checksum = md5(image.png))''',
+                                     'data_set_image.training DESC, data_set_image.position',
+                                     filtered=False, columns='image.image_id, image.label_id')
+        rows = self._execute_simple_query(query, (dataset_name, extractor_version))
+        # une image peut faire partie des images d'entrainement et de test
+        return None if rows is None else list(dict.fromkeys(rows))
+
+    def put_features(self, extractor_version, entries):
+        return self._execute_write('INSERT OR REPLACE INTO image_feature VALUES (?, ?, ?, ?);',
+                                   self._feature_rows(extractor_version, entries))
+
+    def features_from_dataset(self, dataset_name, training_image, extractor_version, filters=None):
+        query, params = self._image_query((), '''data_set_image JOIN image ON image.image_id = data_set_image.image_id
+                                              JOIN image_feature ON image_feature.image_id = image.image_id''',
+                                          '''data_set_image.data_set_name = ? AND data_set_image.training = ?
+                                             AND image_feature.extractor_version = ?''',
+                                          'data_set_image.position',
+                                          columns='image.label_name, image.image_id, image_feature.features',
+                                          filters=filters)
+        return self._features_array(self._execute_simple_query(query, (dataset_name, training_image,
+                                                                       extractor_version, *params)))
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+# nombre de bits à 1 de chaque octet
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# bits de chaque octet, du bit de poids fort (première colonne) au plus faible : BITS[octet, position]
+BITS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.int64)
+
+
+class PackedShape:
+    """Forme binaire compactée à 1 bit par pixel (np.packbits par ligne).
+
+    Sert à garder en cache ou à transmettre les matrices des formes : une
+    matrice uint8 prend 8 fois plus de place et une QImage ARGB32 32 fois plus.
+    L'aire et les sommes des lignes et des colonnes se calculent directement
+    sur les octets compactés.
+    """
+
+    HEADER_DTYPE = np.dtype('<u4')
+
+    def __init__(self, packed: np.ndarray, width: int):
+        """
+        Args:
+            packed (np.ndarray): octets compactés (H, ceil(W / 8))
+            width (int): largeur de l'image en pixels
+        """
+        self._packed = packed
+        self._width = width
+
+    @staticmethod
+    def from_array(image: np.ndarray) -> 'PackedShape':
+        """Compacte une matrice dont la forme est remplie de 1"""
+        return PackedShape(np.packbits(image.astype(bool, copy=False), axis=1), image.shape[1])
+
+    @staticmethod
+    def from_bytes(buffer) -> 'PackedShape':
+        """Relit une forme écrite par to_bytes, sans copier les octets compactés"""
+        height, width = np.frombuffer(buffer, dtype=PackedShape.HEADER_DTYPE, count=2)
+        packed = np.frombuffer(buffer, dtype=np.uint8, offset=2 * PackedShape.HEADER_DTYPE.itemsize)
+        return PackedShape(packed.reshape(int(height), -1), int(width))
+
+    def to_bytes(self) -> bytes:
+        """Retourne la hauteur, la largeur puis les octets compactés"""
+        return np.array(self.shape, dtype=self.HEADER_DTYPE).tobytes() + self._packed.tobytes()
+
+    def to_array(self) -> np.ndarray:
+        """Retourne la matrice booléenne de la forme"""
+        return np.unpackbits(self._packed, axis=1, count=self._width).view(bool)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self._packed.shape[0], self._width
+
+    @property
+    def packed(self) -> np.ndarray:
+        return self._packed
+
+    @property
+    def nbytes(self) -> int:
+        return self._packed.nbytes
+
+    @property
+    def area(self) -> int:
+        """Retourne le nombre de pixels de la forme"""
+        return int(POPCOUNT[self._packed].sum(dtype=np.int64))
+
+    def row_sums(self) -> np.ndarray:
+        """Retourne le nombre de pixels de la forme sur chaque ligne"""
+        return POPCOUNT[self._packed].sum(axis=1, dtype=np.int64)
+
+    def column_sums(self) -> np.ndarray:
+        """Retourne le nombre de pixels de la forme sur chaque colonne"""
+        # nombre d'occurrences de chaque valeur d'octet dans chaque colonne d'octets,
+        # puis somme de chaque position de bit par la table BITS
+        byte_columns = self._packed.shape[1]
+        counts = np.bincount((self._packed + np.arange(byte_columns) * 256).ravel(), minlength=byte_columns * 256)
+        return (counts.reshape(byte_columns, 256) @ BITS).ravel()[:self._width]
+
+    @property
+    def centroid(self) -> np.ndarray:
+        """Retourne le point centre (ligne, colonne) de la forme"""
+        area = self.area
+        r = np.dot(np.arange(self._packed.shape[0]), self.row_sums()) / area
+        c = np.dot(np.arange(self._width), self.column_sums()) / area
+        return np.array((r, c))
@@ -0,0 +1,139 @@
+import numpy as np
+
+from utils.shapecalculator import ShapeCalculator
+
+
+class RunLengthShape:
+    """Représentation compacte d'une forme binaire.
+
+    Chaque ligne de la forme est encodée en segments [début, fin[ de pixels
+    remplis, et le contour (points du périmètre) est extrait une seule fois
+    à la construction. L'aire, le centre et le périmètre se calculent à partir
+    des segments et les rayons à partir du contour, sans jamais parcourir
+    toute l'image.
+    """
+
+    def __init__(self, rows: np.ndarray, starts: np.ndarray, ends: np.ndarray, contour: np.ndarray = None):
+        """
+        Args:
+            rows (np.ndarray): ligne de chaque segment (triés par ligne puis par colonne)
+            starts (np.ndarray): première colonne de chaque segment
+            ends (np.ndarray): colonne suivant la dernière colonne de chaque segment
+            contour (np.ndarray): points (ligne, colonne) du périmètre, calculés au besoin si absents
+        """
+        self._rows = np.asarray(rows, dtype=np.int64)
+        self._starts = np.asarray(starts, dtype=np.int64)
+        self._ends = np.asarray(ends, dtype=np.int64)
+        self._contour = contour
+
+    @staticmethod
+    def from_array(image: np.ndarray) -> 'RunLengthShape':
+        """Encode une matrice binaire (forme remplie de 1).
+
+        Args:
+            image (np.ndarray): matrice de l'image
+
+        Returns:
+            RunLengthShape: forme encodée
+        """
+        cropped, (top, left) = ShapeCalculator.crop(image)
+
+        # la bordure vide de crop garantit qu'un segment commence et finit toujours dans la ligne
+        transitions = np.diff(cropped.astype(np.int8), axis=1)
+        starts = np.argwhere(transitions == 1)
+        ends = np.argwhere(transitions == -1)
+
+        return RunLengthShape(starts[:, 0] + top,
+                              starts[:, 1] + 1 + left,
+                              ends[:, 1] + 1 + left,
+                              ShapeCalculator.boundary_points(cropped) + (top, left))
+
+    def to_array(self) -> tuple[np.ndarray, tuple[int, int]]:
+        """Décode la forme dans sa boîte englobante, avec une bordure vide d'un pixel.
+
+        Returns:
+            tuple[np.ndarray, tuple[int, int]]: matrice de la forme et décalage (ligne, colonne)
+            vers les coordonnées de l'image
+        """
+        if self._rows.size == 0:
+            return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+
+        top, left = self._rows.min() - 1, self._starts.min() - 1
+        height = self._rows.max() - top + 2
+        width = self._ends.max() - left + 1
+
+        # somme cumulative des débuts (+1) et fins (-1) de segments sur chaque ligne
+        marks = np.zeros((height, width + 1), dtype=np.int32)
+        np.add.at(marks, (self._rows - top, self._starts - left), 1)
+        np.add.at(marks, (self._rows - top, self._ends - left), -1)
+        return np.cumsum(marks, axis=1)[:, :-1].astype(np.uint8), (int(top), int(left))
+
+    @property
+    def contour(self) -> np.ndarray:
+        if self._contour is None:
+            image, offset = self.to_array()
+            self._contour = ShapeCalculator.boundary_points(image) + offset
+        return self._contour
+
+    @property
+    def rows(self) -> np.ndarray:
+        return self._rows
+
+    @property
+    def starts(self) -> np.ndarray:
+        return self._starts
+
+    @property
+    def ends(self) -> np.ndarray:
+        return self._ends
+
+    @property
+    def run_count(self) -> int:
+        return self._rows.size
+
+    @property
+    def area(self) -> int:
+        """Retourne le nombre de pixels de la forme"""
+        return int(np.sum(self._ends - self._starts))
+
+    @property
+    def centroid(self) -> np.ndarray:
+        """Retourne le point centre (ligne, colonne) de la forme"""
+        lengths = self._ends - self._starts
+        area = np.sum(lengths)
+        # somme des colonnes d'un segment : longueur * milieu du segment
+        r = np.dot(self._rows, lengths) / area
+        c = np.dot(self._starts + self._ends - 1, lengths) / (2 * area)
+        return np.array((r, c))
+
+    def perimeter(self) -> int:
+        """Retourne le périmètre de la forme.
+
+        Donne le même résultat que ShapeCalculator.perimeter sur la boîte
+        englobante rognée par ShapeCalculator.crop : on compte les pixels qui
+        diffèrent de leur voisin de gauche ou de leur voisin du haut.
+        """
+        if self._rows.size == 0:
+            return 0
+
+        # clé unique (ligne, colonne) pour trier les bornes de segments de toutes les lignes d'un coup
+        left = self._starts.min() - 1
+        stride = self._ends.max() - left + 1
+        starts = self._rows * stride + (self._starts - left)
+        ends = self._rows * stride + (self._ends - left)
+
+        # pixels qui diffèrent de celui du haut : différence symétrique des segments de la ligne
+        # et de ceux de la ligne précédente, délimitée par les bornes des deux lignes
+        bounds = np.sort(np.concatenate((starts, ends, starts + stride, ends + stride)))
+        vertical = np.sum(bounds[1::2] - bounds[0::2])
+
+        # pixels qui diffèrent de celui de gauche (débuts et fins de segments)
+        # et qui n'ont pas déjà été comptés dans la différence symétrique
+        horizontal = np.concatenate((starts, ends))
+        already_counted = np.searchsorted(bounds, horizontal, side='right') % 2 == 1
+
+        return int(vertical + np.count_nonzero(~already_counted))
+
+    def min_and_max(self) -> tuple[float, float]:
+        """Retourne la plus petite et la plus grande distance entre le centre et le contour"""
+        return ShapeCalculator.radii(self.centroid, self.contour)
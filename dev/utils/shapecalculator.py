@@ -2,6 +2,58 @@ import numpy as np
 
 class ShapeCalculator:
     
+    @staticmethod
+    def crop(image: np.ndarray, pad: int = 1) -> tuple[np.ndarray, tuple[int, int]]:
+        """Retourne la boîte englobante de la forme avec une bordure de `pad` pixels vides.
+
+        Les calculs des déterminants se font ensuite sur cette petite matrice
+        plutôt que sur toute l'image. La bordure vide garantit aussi que le
+        np.roll de __perimeter_array ne fait jamais le tour de l'image.
+
+        Args:
+            image (np.ndarray): matrice de l'image
+            pad (int): nombre de pixels vides ajoutés autour de la forme
+
+        Returns:
+            tuple[np.ndarray, tuple[int, int]]: matrice rognée et décalage (ligne, colonne)
+            à ajouter aux coordonnées rognées pour revenir à celles de l'image
+        """
+        rows = np.flatnonzero(image.any(axis=1))
+        if rows.size == 0:
+            return image, (0, 0)
+        cols = np.flatnonzero(image.any(axis=0))
+
+        top, bottom = rows[0], rows[-1] + 1
+        left, right = cols[0], cols[-1] + 1
+        cropped = np.pad(image[top:bottom, left:right], pad)
+
+        return cropped, (int(top) - pad, int(left) - pad)
+
+    @staticmethod
+    def downsample(image: np.ndarray, factor: int, mode: str = 'majority') -> np.ndarray:
+        """Réduit la résolution de l'image par blocs de factor x factor pixels.
+
+        Args:
+            image (np.ndarray): matrice de l'image
+            factor (int): taille des blocs
+            mode (str): 'or' (un bloc est rempli s'il contient un pixel de la forme)
+                        ou 'majority' (s'il en contient plus de la moitié)
+
+        Returns:
+            np.ndarray: matrice booléenne réduite
+        """
+        if mode not in ('or', 'majority'):
+            raise ValueError(f"mode de réduction inconnu : {mode}")
+        if factor <= 1:
+            return image.astype(bool, copy=False)
+
+        height, width = image.shape
+        image = np.pad(image, ((0, -height % factor), (0, -width % factor)))
+        blocks = image.reshape(image.shape[0] // factor, factor, image.shape[1] // factor, factor)
+        if mode == 'or':
+            return blocks.any(axis=(1, 3))
+        return blocks.sum(axis=(1, 3), dtype=np.int32) * 2 > factor * factor
+
     @staticmethod
     def perimeter(image: np.ndarray):
         """Retourne le perimetre de l'image"""
@@ -11,16 +63,24 @@ class ShapeCalculator:
 
 
     @staticmethod
-    def __centroid(image) -> tuple[float, float]:
-        """Retourne le point centre de l'image"""
-        c, r = np.meshgrid(np.arange(image.shape[1]), np.arange(image.shape[0]))
-        return (np.sum(r * image), np.sum(c * image)) / np.sum(image)
+    def __centroid(image, offset: tuple[int, int] = (0, 0)) -> tuple[float, float]:
+        """Retourne le point centre de l'image
+
+        Le calcul utilise les sommes des lignes et des colonnes plutôt
+        qu'une grille de coordonnées de la taille de l'image.
+        """
+        area = np.sum(image)
+        r = np.dot(np.arange(image.shape[0]), image.sum(axis=1)) / area
+        c = np.dot(np.arange(image.shape[1]), image.sum(axis=0)) / area
+        return np.array((r + offset[0], c + offset[1]))
 
     @staticmethod
     def min_and_max(image: np.ndarray) -> tuple[float, float]:
         """Retourne une distance minimum et une distance maximum du centre
         de l'image et le point le plus proche et plus grand de cette dernière.
 
+        Le calcul est fait sur la boîte englobante de la forme (voir crop).
+
         Args:
             image (np.ndarray): matrice de l'image
     
@@ -28,13 +88,77 @@ class ShapeCalculator:
             tuple(float, float): plus petite et plus grande distance
         """
        
-        center = ShapeCalculator.__centroid(image)
-        image = ShapeCalculator.__perimeter_array(image)
-        c, r = np.meshgrid(np.arange(image.shape[1]), np.arange(image.shape[0]))
-        points = np.column_stack((r[image == 1], c[image == 1]))
+        image, offset = ShapeCalculator.crop(image)
+        center = ShapeCalculator.__centroid(image, offset)
+        points = np.argwhere(ShapeCalculator.__perimeter_array(image)) + offset
+        return ShapeCalculator.radii(center, points)
+
+    @staticmethod
+    def boundary_points(image: np.ndarray) -> np.ndarray:
+        """Retourne les coordonnées (ligne, colonne) des points du périmètre,
+        triées par ligne puis par colonne.
+
+        Args:
+            image (np.ndarray): matrice de l'image
+
+        Returns:
+            np.ndarray: points du périmètre de forme (N, 2)
+        """
+        image, offset = ShapeCalculator.crop(image)
+        return np.argwhere(ShapeCalculator.__perimeter_array(image)) + offset
+
+    @staticmethod
+    def radii(center: np.ndarray, points: np.ndarray) -> tuple[float, float]:
+        """Retourne la plus petite et la plus grande distance entre le centre et les points du périmètre.
+
+        Args:
+            center (np.ndarray): centre (ligne, colonne) de la forme
+            points (np.ndarray): points du périmètre de forme (N, 2)
+
+        Returns:
+            tuple(float, float): plus petite et plus grande distance
+        """
         distances = np.linalg.norm(points - center, axis=1)
         return np.amin(distances), np.amax(distances)
 
+    @staticmethod
+    def convex_hull(points: np.ndarray) -> np.ndarray:
+        """Retourne les sommets de l'enveloppe convexe (algorithme monotone chain d'Andrew).
+
+        Args:
+            points (np.ndarray): points (ligne, colonne) de forme (N, 2)
+
+        Returns:
+            np.ndarray: sommets ordonnés de l'enveloppe, de forme (M, 2)
+        """
+        points = np.unique(points, axis=0)
+        if len(points) < 3:
+            return points
+
+        def half_hull(ordered):
+            hull = []
+            for p in ordered.tolist():
+                while len(hull) >= 2:
+                    (r0, c0), (r1, c1) = hull[-2], hull[-1]
+                    if (r1 - r0) * (p[1] - c0) - (c1 - c0) * (p[0] - r0) > 0:
+                        break
+                    hull.pop()
+                hull.append(p)
+            return hull[:-1]
+
+        return np.array(half_hull(points) + half_hull(points[::-1]), dtype=points.dtype)
+
+    @staticmethod
+    def row_extremities(points: np.ndarray) -> np.ndarray:
+        """Retourne, pour chaque ligne, le premier et le dernier point.
+
+        Les points doivent être triés par ligne puis par colonne (comme np.argwhere).
+        Seuls ces points peuvent être des sommets de l'enveloppe convexe.
+        """
+        _, first = np.unique(points[:, 0], return_index=True)
+        last = np.append(first[1:], len(points)) - 1
+        return points[np.union1d(first, last)]
+
     @staticmethod
     def __perimeter_array(image: np.ndarray) -> np.ndarray:
         """Retourne une matrice avec seulement les points du périmètre.
@@ -0,0 +1,105 @@
+import hashlib
+
+import numpy as np
+
+from utils.packedshape import POPCOUNT
+from utils.shapecalculator import ShapeCalculator
+
+
+class ShapeHash:
+    """Empreintes d'une forme binaire, calculées sur sa boîte englobante.
+
+    La forme est d'abord rognée : deux images qui ne diffèrent que par une
+    translation ont donc la même empreinte exacte. L'empreinte perceptuelle
+    (64 bits) est calculée sur la forme ramenée à une grille de 8 x 8, ce qui
+    la rend aussi insensible à l'échelle ; deux formes presque identiques
+    n'y diffèrent que de quelques bits.
+    """
+
+    SIZE = 8
+    NEAR_DISTANCE = 4
+
+    @staticmethod
+    def normalize(image: np.ndarray) -> np.ndarray:
+        """Retourne la forme rognée, sans bordure, en matrice booléenne"""
+        cropped, _ = ShapeCalculator.crop(image, pad=0)
+        return cropped.astype(bool, copy=False)
+
+    @staticmethod
+    def exact(image: np.ndarray) -> bytes:
+        """Retourne l'empreinte exacte (16 octets) de la forme"""
+        normalized = ShapeHash.normalize(image)
+        digest = hashlib.blake2b(np.array(normalized.shape, dtype='<u4').tobytes(), digest_size=16)
+        digest.update(np.packbits(normalized, axis=1).tobytes())
+        return digest.digest()
+
+    @staticmethod
+    def perceptual(image: np.ndarray) -> int:
+        """Retourne l'empreinte perceptuelle (64 bits) de la forme.
+
+        Chaque bit indique si la forme couvre au moins la moitié de la case
+        correspondante de la grille 8 x 8 posée sur sa boîte englobante.
+        """
+        normalized = ShapeHash.normalize(image)
+        if normalized.size == 0:
+            return 0
+
+        # répète les lignes et colonnes pour que chaque case contienne au moins un pixel
+        size = ShapeHash.SIZE
+        height, width = normalized.shape
+        normalized = np.repeat(normalized, -(-size // height), axis=0)
+        normalized = np.repeat(normalized, -(-size // width), axis=1)
+        height, width = normalized.shape
+
+        row_bounds = np.arange(size) * height // size
+        col_bounds = np.arange(size) * width // size
+        counts = np.add.reduceat(np.add.reduceat(normalized.astype(np.int32), row_bounds, axis=0), col_bounds, axis=1)
+        cells = np.outer(np.diff(np.append(row_bounds, height)), np.diff(np.append(col_bounds, width)))
+        bits = np.packbits(counts * 2 >= cells)
+        return int.from_bytes(bits.tobytes(), 'big')
+
+    @staticmethod
+    def hamming(a: int, b: int) -> int:
+        """Retourne le nombre de bits qui diffèrent entre deux empreintes perceptuelles"""
+        return bin(a ^ b).count('1')
+
+    @staticmethod
+    def clusters(hashes, max_distance: int = NEAR_DISTANCE) -> list[list[int]]:
+        """Regroupe les formes presque identiques.
+
+        Deux formes sont reliées si leurs empreintes perceptuelles diffèrent
+        d'au plus max_distance bits ; les groupes sont les composantes connexes
+        de ces liens (union-find).
+
+        Args:
+            hashes (list[int]): empreintes perceptuelles
+            max_distance (int): distance de Hamming maximale entre deux voisines
+
+        Returns:
+            list[list[int]]: index des formes de chaque groupe de plus d'une forme
+        """
+        values = np.array([int(h) for h in hashes], dtype=np.uint64)
+        parent = list(range(len(values)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # distances de chaque empreinte avec les suivantes, par blocs pour limiter la mémoire
+        for start in range(0, len(values), 1024):
+            block = values[start:start + 1024]
+            differing = (block[:, None] ^ values[None, :]).view(np.uint8).reshape(len(block), len(values), 8)
+            distances = POPCOUNT[differing].sum(axis=2)
+            for i, j in np.argwhere(distances <= max_distance):
+                i += start
+                if i < j:
+                    root_i, root_j = find(i), find(j)
+                    if root_i != root_j:
+                        parent[root_j] = root_i
+
+        groups = {}
+        for i in range(len(values)):
+            groups.setdefault(find(i), []).append(i)
+        return [group for group in groups.values() if len(group) > 1]
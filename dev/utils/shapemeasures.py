@@ -0,0 +1,156 @@
+from functools import cached_property
+from math import comb
+
+import numpy as np
+
+from utils.shapecalculator import ShapeCalculator
+
+
+class ShapeMeasures:
+    """Mesures brutes d'une forme, calculées au besoin et une seule fois.
+
+    Les déterminants du registre (voir shape_features) ne lisent les pixels
+    qu'à travers cet objet : les moments, le périmètre, le contour et
+    l'enveloppe convexe sont donc partagés entre tous les déterminants
+    choisis pour une même image.
+    """
+
+    def __init__(self, image: np.ndarray):
+        """
+        Args:
+            image (np.ndarray): matrice dont la forme est remplie de 1
+        """
+        self._image, _ = ShapeCalculator.crop(image)
+        self._moments = np.zeros((0, 0))
+
+    def raw_moments(self, order: int) -> np.ndarray:
+        """Retourne les moments bruts m[p, q] = somme(r^p * c^q) pour p, q <= order.
+
+        Tous les moments sont obtenus par un seul produit matriciel sur les
+        pixels, et gardés pour les appels suivants d'ordre inférieur ou égal.
+        """
+        if self._moments.shape[0] <= order:
+            self._moments = self._compute_moments(order)
+        return self._moments[:order + 1, :order + 1]
+
+    def _compute_moments(self, order):
+        height, width = self._image.shape
+        rows = np.vander(np.arange(height, dtype=np.float64), order + 1, increasing=True)
+        cols = np.vander(np.arange(width, dtype=np.float64), order + 1, increasing=True)
+        return rows.T @ self._image @ cols
+
+    def central_moments(self, order: int) -> np.ndarray:
+        """Retourne les moments centrés mu[p, q] pour p, q <= order"""
+        m = self.raw_moments(order)
+        r, c = self.centroid
+        # mu[p, q] = somme sur i <= p, j <= q de C(p, i) C(q, j) (-r)^(p - i) (-c)^(q - j) m[i, j]
+        shift_r = np.array([[comb(p, i) * (-r) ** (p - i) if i <= p else 0. for i in range(order + 1)]
+                            for p in range(order + 1)])
+        shift_c = np.array([[comb(q, j) * (-c) ** (q - j) if j <= q else 0. for j in range(order + 1)]
+                            for q in range(order + 1)])
+        return shift_r @ m @ shift_c.T
+
+    def normalized_moments(self, order: int) -> np.ndarray:
+        """Retourne les moments centrés normalisés eta[p, q], invariants à l'échelle"""
+        mu = self.central_moments(order)
+        p, q = np.indices(mu.shape)
+        return mu / mu[0, 0] ** (1 + (p + q) / 2)
+
+    @property
+    def area(self) -> float:
+        return self.raw_moments(0)[0, 0]
+
+    @cached_property
+    def centroid(self) -> np.ndarray:
+        m = self.raw_moments(1)
+        return np.array((m[1, 0], m[0, 1])) / m[0, 0]
+
+    @cached_property
+    def perimeter(self) -> int:
+        return ShapeCalculator.perimeter(self._image)
+
+    @cached_property
+    def boundary(self) -> np.ndarray:
+        """Points (ligne, colonne) du périmètre, triés par ligne puis par colonne"""
+        return ShapeCalculator.boundary_points(self._image)
+
+    @cached_property
+    def radii(self) -> tuple[float, float]:
+        """Plus petite et plus grande distance entre le centre et le périmètre"""
+        return ShapeCalculator.radii(self.centroid, self.boundary)
+
+    @cached_property
+    def hull(self) -> np.ndarray:
+        """Sommets de l'enveloppe convexe des pixels de la forme (coins des pixels)"""
+        extremities = ShapeCalculator.row_extremities(self.boundary)
+        corners = (extremities[:, None, :] + ((0, 0), (0, 1), (1, 0), (1, 1))).reshape(-1, 2)
+        return ShapeCalculator.convex_hull(corners)
+
+    @cached_property
+    def hull_area(self) -> float:
+        """Aire de l'enveloppe convexe (formule du lacet)"""
+        r, c = self.hull[:, 0], self.hull[:, 1]
+        return abs(np.dot(r, np.roll(c, -1)) - np.dot(c, np.roll(r, -1))) / 2
+
+    @cached_property
+    def inertia(self) -> tuple[float, float]:
+        """Valeurs propres (grande, petite) de la matrice de covariance de la forme"""
+        mu = self.central_moments(2) / self.area
+        half_trace = (mu[2, 0] + mu[0, 2]) / 2
+        delta = np.sqrt(((mu[2, 0] - mu[0, 2]) / 2) ** 2 + mu[1, 1] ** 2)
+        return half_trace + delta, half_trace - delta
+
+    @cached_property
+    def hu_moments(self) -> np.ndarray:
+        """Les 7 moments invariants de Hu"""
+        n = self.normalized_moments(3)
+        n20, n02, n11 = n[2, 0], n[0, 2], n[1, 1]
+        n30, n03, n21, n12 = n[3, 0], n[0, 3], n[2, 1], n[1, 2]
+        a, b = n30 + n12, n21 + n03
+        return np.array((
+            n20 + n02,
+            (n20 - n02) ** 2 + 4 * n11 ** 2,
+            (n30 - 3 * n12) ** 2 + (3 * n21 - n03) ** 2,
+            a ** 2 + b ** 2,
+            (n30 - 3 * n12) * a * (a ** 2 - 3 * b ** 2) + (3 * n21 - n03) * b * (3 * a ** 2 - b ** 2),
+            (n20 - n02) * (a ** 2 - b ** 2) + 4 * n11 * a * b,
+            (3 * n21 - n03) * a * (a ** 2 - 3 * b ** 2) - (n30 - 3 * n12) * b * (3 * a ** 2 - b ** 2)))
+
+
+def _power_sums(n: np.ndarray, order: int) -> np.ndarray:
+    """Retourne les sommes S_q(n) = 0^q + 1^q + ... + (n - 1)^q pour q <= order (Faulhaber)"""
+    n = n.astype(np.float64)
+    sums = [n, n * (n - 1) / 2, (n - 1) * n * (2 * n - 1) / 6, (n * (n - 1) / 2) ** 2]
+    if order >= len(sums):
+        raise ValueError(f"ordre de moment non supporté pour une forme encodée : {order}")
+    return np.array(sums[:order + 1])
+
+
+class RunLengthMeasures(ShapeMeasures):
+    """Mesures d'une RunLengthShape, calculées à partir des segments et du contour.
+
+    Les coordonnées sont ramenées au coin de la boîte englobante pour garder
+    les moments d'ordre 3 précis.
+    """
+
+    def __init__(self, shape):
+        self._shape = shape
+        self._moments = np.zeros((0, 0))
+        self._origin = np.array((shape.rows.min(initial=0), shape.starts.min(initial=0)))
+
+    def _compute_moments(self, order):
+        rows = self._shape.rows - self._origin[0]
+        starts = self._shape.starts - self._origin[1]
+        ends = self._shape.ends - self._origin[1]
+        # somme des c^q sur un segment [début, fin[ : S_q(fin) - S_q(début)
+        col_sums = _power_sums(ends, order) - _power_sums(starts, order)
+        row_powers = np.vander(rows.astype(np.float64), order + 1, increasing=True)
+        return row_powers.T @ col_sums.T
+
+    @cached_property
+    def perimeter(self) -> int:
+        return self._shape.perimeter()
+
+    @cached_property
+    def boundary(self) -> np.ndarray:
+        return self._shape.contour - self._origin
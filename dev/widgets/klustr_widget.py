@@ -30,7 +30,9 @@
 # Cette dernière approche serait plus complexe et longue à mettre en place mais 
 # beaucoup plus efficace et, surtout, plus modulaire.
 
-from klustr_utils import qimage_argb32_from_png_decoding
+from klustr_utils import qimage_argb32
+from async_klustr_dao import AsyncKlustRDAO
+from prefetcher import Prefetcher
 
 
 from random import randint, choice
@@ -132,7 +134,7 @@ class KlustRLabelItem(QStandardItem):
         self._id = id
         self._name = name
 
-        img = qimage_argb32_from_png_decoding(thumbnail)
+        img = qimage_argb32(thumbnail)
         self._thumbnail_icon = QIcon() if img.is_null() else QIcon(QPixmap.from_image(img))
 
         super().__init__(self._thumbnail_icon, self._name)
@@ -164,7 +166,7 @@ class KlustRLabelModel(QStandardItemModel):
 
 class KlustRImageItem(QStandardItem):
 
-    def __init__(self, label_id, image_id, name, width, height, image, thumbnail, transformation):
+    def __init__(self, label_id, image_id, name, width, height, image, thumbnail, transformation, image_loader=None):
         self._label_id = label_id
         self._image_id = image_id
         self._name = name
@@ -174,14 +176,21 @@ class KlustRImageItem(QStandardItem):
         self._rotated = transformation[1] == '1'
         self._scaled = transformation[2] == '1'
 
-        img = qimage_argb32_from_png_decoding(thumbnail)
+        img = qimage_argb32(thumbnail)
         self._thumbnail_icon = QIcon() if img.is_null() else QIcon(QPixmap.from_image(img))
 
-        img = qimage_argb32_from_png_decoding(image)
-        self._image = QIcon() if img.is_null() else img
+        # sans image, image_loader() retourne le PNG quand l'image est affichée pour la première fois
+        self._image = None
+        self._image_loader = image_loader
+        if image is not None:
+            self._decode_image(image)
 
         super().__init__(self._thumbnail_icon, self._name)
 
+    def _decode_image(self, image):
+        img = qimage_argb32(image)
+        self._image = QIcon() if img.is_null() else img
+
     @property
     def label_id(self):
         return self._label_id
@@ -202,8 +211,19 @@ class KlustRImageItem(QStandardItem):
     def height(self):
         return self._height
 
+    @property
+    def image_loaded(self):
+        return self._image is not None
+
+    def load_image(self, image):
+        self._decode_image(image)
+        self._image_loader = None
+
     @property
     def image(self):
+        if self._image is None and self._image_loader is not None:
+            self._decode_image(self._image_loader())
+            self._image_loader = None
         return self._image
 
     @property
@@ -224,21 +244,27 @@ class KlustRImageModel(QStandardItemModel):
         super().__init__()
         self._label_id = None
 
-    def _update(self, images):
+    def _update(self, images, klustr_dao):
         sb = QtCore.QSignalBlocker(self)
         self.clear()
         sb.unblock()
         for image_info in images:
             # label_id, image_id, name, width, height, image, thumbnail, transformation
-            new_item = KlustRImageItem(image_info[0], image_info[2], image_info[3], image_info[4], image_info[5], image_info[6], image_info[7], image_info[11])
+            new_item = KlustRImageItem(image_info[0], image_info[2], image_info[3], image_info[4], image_info[5], image_info[6], image_info[7], image_info[11],
+                                       self._image_loader(klustr_dao, image_info[0], image_info[2]))
             self.append_row(new_item)
 
+    @staticmethod
+    def _image_loader(klustr_dao, label_id, image_id):
+        return lambda: klustr_dao.images_by_ids(label_id, [image_id], (klustr_dao.IMAGE_COLUMN,))[0][klustr_dao.IMAGE_COLUMN]
+
+    # seules les vignettes sont chargées avec la liste, les images le sont à la sélection
     def update_for_all_images(self, klustr_dao, label_id, translated, rotated, scaled, exclusive):
         klustr_dao.set_transformation_filters(translated, rotated, scaled, exclusive)
-        self._update(klustr_dao.image_from_label(label_id))
+        self._update(klustr_dao.image_metadata_from_label(label_id, (klustr_dao.THUMBNAIL_COLUMN,)), klustr_dao)
 
     def update_from_dataset(self, klustr_dao, dataset_name, label_id, training_image):
-        self._update(klustr_dao.image_from_dataset_label(dataset_name, label_id, training_image))
+        self._update(klustr_dao.image_metadata_from_dataset_label(dataset_name, label_id, training_image, (klustr_dao.THUMBNAIL_COLUMN,)), klustr_dao)
 
 
 class ColoredWidget(QWidget):
@@ -384,6 +410,10 @@ class KlustRDataSourceViewWidget(QWidget):
         super().__init__(parent)
 
         self.klustr_dao = klustr_dao
+        # les étiquettes, les images et les images pleine grandeur sont lues hors du fil de l'interface
+        self.async_dao = AsyncKlustRDAO(klustr_dao, parent=self)
+        # les voisines de chaque sélection sont lues d'avance, en basse priorité
+        self.prefetcher = Prefetcher(klustr_dao, foreground=self.async_dao)
         if self.klustr_dao.is_available:
             self._setup_models()
             self._setup_gui()
@@ -517,41 +547,104 @@ class KlustRDataSourceViewWidget(QWidget):
         if selected:
             index = selected.indexes()[0]
             item = index.model().item_from_index(index)
+            # les images de l'ancienne sélection ne sont plus attendues
+            self.async_dao.cancel('images')
+            self.async_dao.cancel('image')
+            self.prefetcher.cancel('images')
+            self.prefetcher.cancel('image')
             if isinstance(item, KlustRDatasetItem):
                 if item.id == -1:
-                    self.label_model.update_for_all_images(self.klustr_dao)
+                    request, args, filters = self._label_request(item)
+                    self.prefetcher.fetch(self.async_dao, 'labels', request, *args, callback=self._show_labels,
+                                          filters=filters)
                 else:
                     self.dataset_tree_view.set_current_index(self.dataset_model.index(0, 0, index))
+                    return
             else:
-                self.label_model.update_from_dataset(item.parent().name, self.klustr_dao)
-            self.image_label_list_view.set_current_index(self.label_model.index(0, 0))
-            self.image_label_count_label.text  = f'''{self.label_model.row_count()} labels'''
+                request, args, filters = self._label_request(item.parent())
+                self.prefetcher.fetch(self.async_dao, 'labels', request, *args, callback=self._show_labels,
+                                      filters=filters)
+
+            # étiquettes des jeux de données voisins
+            row = index.row() if isinstance(item, KlustRDatasetItem) else index.parent().row()
+            self.prefetcher.prefetch('labels', [(*self._label_request(self.dataset_model.item(neighbour, 0)),
+                                                 Prefetcher.decoded(2))
+                                                for neighbour in (row + 1, row - 1)
+                                                if 0 <= neighbour < self.dataset_model.row_count()])
+
+    def _label_request(self, dataset_item):
+        # (request, args, filters) des étiquettes d'un jeu de données, voir Prefetcher.key
+        if dataset_item.id == -1:
+            return 'available_labels', (), None
+        return 'labels_from_dataset', (dataset_item.name,), None
+
+    def _show_labels(self, labels):
+        self.label_model._update(labels or [])
+        self.image_label_list_view.set_current_index(self.label_model.index(0, 0))
+        self.image_label_count_label.text  = f'''{self.label_model.row_count()} labels'''
 
 
     @Slot()
     def select_label(self, selected, deselected):
         if selected:
-            dataset_index = self.dataset_tree_view.selection_model().selected_indexes[0]
-            dataset_item = self.dataset_model.item_from_index(dataset_index)
-            if isinstance(dataset_item, KlustRDatasetItem):
-                self.image_model.update_for_all_images(
-                                        self.klustr_dao, 
-                                        self.label_model.item_from_index(selected.indexes()[0]).id, 
-                                        self.translation_checkbox.checked,
-                                        self.rotation_checkbox.checked,
-                                        self.scaling_checkbox.checked,
-                                        self.exclusive_checkbox.checked)
-            else:
-                training = dataset_index.row() == 0
-                dataset_index = self.dataset_tree_view.selection_model().selected_indexes[0].parent()
-                dataset_item = self.dataset_model.item_from_index(dataset_index)
-                label_index = self.image_label_list_view.selection_model().selected_indexes[0]
-                label_item = self.label_model.item_from_index(label_index)
-                self.image_model.update_from_dataset(self.klustr_dao, dataset_item.name, label_item.id, training)
-            self.image_list_view.set_current_index(self.image_model.index(0, 0))
-            self.image_count_label.text  = f'''{self.image_model.row_count()} images'''
+            # seules les vignettes sont chargées avec la liste, les images le sont à la sélection
+            self.async_dao.cancel('image')
+            self.prefetcher.cancel('image')
+            label_index = selected.indexes()[0]
+            request, args, filters = self._image_request(self.label_model.item_from_index(label_index).id)
+            self.prefetcher.fetch(self.async_dao, 'images', request, *args, callback=self._show_images, filters=filters)
+
+            # listes d'images des étiquettes suivantes
+            row = label_index.row()
+            self.prefetcher.prefetch('images', [(*self._image_request(self.label_model.item(neighbour, 0).id),
+                                                 Prefetcher.decoded(self.klustr_dao.THUMBNAIL_COLUMN))
+                                                for neighbour in (row + 1, row + 2, row - 1)
+                                                if 0 <= neighbour < self.label_model.row_count()])
+
+    def _image_request(self, label_id):
+        # (request, args, filters) des images d'une étiquette du jeu de données choisi, voir Prefetcher.key
+        dataset_index = self.dataset_tree_view.selection_model().selected_indexes[0]
+        dataset_item = self.dataset_model.item_from_index(dataset_index)
+        filters = (self.translation_checkbox.checked,
+                   self.rotation_checkbox.checked,
+                   self.scaling_checkbox.checked,
+                   self.exclusive_checkbox.checked)
+        if isinstance(dataset_item, KlustRDatasetItem):
+            return 'image_metadata_from_label', (label_id, (self.klustr_dao.THUMBNAIL_COLUMN,)), filters
+        training = dataset_index.row() == 0
+        dataset_item = self.dataset_model.item_from_index(dataset_index.parent())
+        return ('image_metadata_from_dataset_label',
+                (dataset_item.name, label_id, training, (self.klustr_dao.THUMBNAIL_COLUMN,)), filters)
+
+    def _show_images(self, images):
+        self.image_model._update(images or [], self.klustr_dao)
+        self.image_list_view.set_current_index(self.image_model.index(0, 0))
+        self.image_count_label.text  = f'''{self.image_model.row_count()} images'''
 
     @Slot()
     def select_image(self, selected, deselected):
         if selected:
-            self.image_info_widget.update_info(self.image_model.item_from_index(selected.indexes()[0]))
\ No newline at end of file
+            image_index = selected.indexes()[0]
+            item = self.image_model.item_from_index(image_index)
+            if item.image_loaded:
+                self.image_info_widget.update_info(item)
+            else:
+                request, args, filters = self._full_image_request(item)
+                self.prefetcher.fetch(self.async_dao, 'image', request, *args,
+                                      callback=lambda rows: self._show_image(item, rows), filters=filters)
+
+            # images suivantes, décodées d'avance
+            row = image_index.row()
+            neighbours = [self.image_model.item(neighbour, 0) for neighbour in (row + 1, row + 2, row + 3, row - 1)
+                          if 0 <= neighbour < self.image_model.row_count()]
+            self.prefetcher.prefetch('image', [(*self._full_image_request(neighbour),
+                                                Prefetcher.decoded(self.klustr_dao.IMAGE_COLUMN))
+                                               for neighbour in neighbours if not neighbour.image_loaded])
+
+    def _full_image_request(self, item):
+        return 'images_by_ids', (item.label_id, (item.image_id,), (self.klustr_dao.IMAGE_COLUMN,)), None
+
+    def _show_image(self, item, rows):
+        if rows:
+            item.load_image(rows[0][self.klustr_dao.IMAGE_COLUMN])
+            self.image_info_widget.update_info(item)
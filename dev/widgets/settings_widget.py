@@ -1,6 +1,11 @@
 import image_processor as imp 
 import KNN as knn
 
+from async_klustr_dao import AsyncKlustRDAO
+from feature_cache import FeatureCache
+from feature_ingest import FeatureIngest
+from prefetcher import Prefetcher
+from shape_features import FeaturePlan
 from klustr_utils import qimage_argb32_from_png_decoding
 
 from widgets.dataset_widget import DatasetWidget
@@ -8,21 +13,36 @@ from widgets.single_test_widget import SingleTestWidget
 from widgets.knn_param_widget import KNNParamsWidget
 from widgets.about_widget import AboutWindow
 
-from PySide6.QtCore import Slot
-from PySide6.QtWidgets import  (QWidget, QVBoxLayout, QPushButton)
+from PySide6.QtCore import Slot, Signal
+from PySide6.QtWidgets import  (QWidget, QVBoxLayout, QPushButton, QMessageBox)
 from PySide6.QtGui import  QPixmap
 from __feature__ import snake_case, true_property
 
 class SettingsWidget(QWidget):
+
+    # émis après chaque paquet d'images d'entrainement ajouté au KNN
+    training_data_changed = Signal()
+
+    # filtres de transformation (translated, rotated, scaled, exclusive) laissant passer toutes les images
+    ALL_IMAGES = (True, True, True, False)
        
     def __init__(self, sql_dao):
         super().__init__()
         
         self.sql_dao = sql_dao
+        self.async_dao = AsyncKlustRDAO(sql_dao, parent=self)
+        # images de test et listes des jeux de données voisins, lues d'avance pendant le chargement du KNN
+        self.prefetcher = Prefetcher(sql_dao, foreground=self.async_dao, ignored_channels=('training',))
         self.datasets = self.sql_dao.available_datasets
         self.__fixed_width = 350
         self.knn = None
         self.current_image = None
+        self.feature_plan = FeaturePlan()
+        self.feature_cache = FeatureCache(imp.ImageProcessor.extractor_version(self.feature_plan))
+        self.feature_ingest = FeatureIngest(cache=self.feature_cache, plan=self.feature_plan)
+        self.__ingest_failures = []
+        # devient False si le DAO n'a pas de table des déterminants précalculés
+        self.__feature_table_available = True
             
         #Setting: combine les 3 layouts ensemble
         settings_layout = QVBoxLayout(self)
@@ -62,7 +82,7 @@ class SettingsWidget(QWidget):
       
     @Slot()
     def __update_data(self):
-        self.knn = knn.KNN(self.knn_params_widget.K_scrollbar.value, 3, 0.8)
+        self.knn = knn.KNN(self.knn_params_widget.K_scrollbar.value, len(self.feature_plan), 0.8)
         data = self.dataset_widget.data_search_bar.current_data()
         
         self.total_image_num = data[6] + data[7]
@@ -77,8 +97,17 @@ class SettingsWidget(QWidget):
         self.dataset_widget.rotated_value.text = str(data[3])
         self.dataset_widget.scaled_value.text = str(data[4])
         
-        self.sql_dao.set_transformation_filters(False, True, False, False)
-        self.get_image_from_label(data[1])
+        self.current_image = None
+        self.get_image_from_label(data[1], data[6])
+
+        # images de test des jeux de données voisins
+        index = self.dataset_widget.data_search_bar.current_index
+        self.prefetcher.cancel('current_image')
+        self.prefetcher.prefetch('test_images', [('image_metadata_from_dataset',
+                                                  (self.dataset_widget.data_search_bar.item_data(neighbour)[1], False),
+                                                  self.ALL_IMAGES, None)
+                                                 for neighbour in (index + 1, index - 1)
+                                                 if 0 <= neighbour < self.dataset_widget.data_search_bar.count])
 
         #update scrollbars
         self.knn_params_widget.K_scrollbar.set_range(0, (data[6] + data[7]) / 4)
@@ -90,13 +119,38 @@ class SettingsWidget(QWidget):
     @Slot()
     def __update_image(self):
         img_data = self.single_test_widget.img_search_bar.current_data() #image_list_info        
-        image = qimage_argb32_from_png_decoding(img_data[6]) #TypeError: 'NoneType' object is not subscriptable -> called when not initialized, normal
-        self.single_test_widget.view_label.pixmap = QPixmap.from_image(image)
+        #la liste ne contient que les métadonnées : l'image est chargée à la sélection, hors du fil de l'interface
+        self.current_image = None
+        if img_data is None:
+            return
+        self.prefetcher.fetch(self.async_dao, 'current_image', 'images_by_ids', *self.__image_request(img_data)[1],
+                              callback=self.__show_image)
+
+        # images de test suivantes
+        index = self.single_test_widget.img_search_bar.current_index
+        self.prefetcher.prefetch('current_image',
+                                 [(*self.__image_request(self.single_test_widget.img_search_bar.item_data(neighbour)), None)
+                                  for neighbour in (index + 1, index + 2, index + 3, index - 1)
+                                  if 0 <= neighbour < self.single_test_widget.img_search_bar.count])
+
+    def __image_request(self, img_data):
+        # (request, args, filters) de l'image pleine grandeur, voir Prefetcher.key
+        return 'images_by_ids', (img_data[0], (img_data[2],), (self.sql_dao.IMAGE_COLUMN,)), None
+
+    def __show_image(self, images):
+        if images:
+            self.current_image = images[0]
+            image = qimage_argb32_from_png_decoding(self.current_image[6])
+            self.single_test_widget.view_label.pixmap = QPixmap.from_image(image)
     
     @Slot()
     def __classify(self):
-        img_data = self.single_test_widget.img_search_bar.current_data()
-        processed_image = imp.ImageProcessor.get_shape(img_data[1], qimage_argb32_from_png_decoding(img_data[6]))
+        img_data = self.current_image
+        if img_data is None:
+            # l'image choisie n'est pas encore chargée
+            return
+        processed_image = imp.ImageProcessor.get_shape_from_png(img_data[1], img_data[6], img_data[2],
+                                                                self.feature_cache, self.feature_plan)
         
         self.single_test_widget.class_text.text = self.knn.classify(processed_image[1::]) 
         
@@ -104,21 +158,69 @@ class SettingsWidget(QWidget):
         self.knn.k = self.knn_params_widget.K_scrollbar.value
 
 
-    def get_image_from_label(self, dataset):
-
-        training_images = self.sql_dao.image_from_dataset(dataset, True)
-        test_images = self.sql_dao.image_from_dataset(dataset, False)
-        #print(labels)
-        i = 0
+    def get_image_from_label(self, dataset, training_image_count=None):
         self.single_test_widget.img_search_bar.clear()
-        for img in test_images:
-            i += 1
+        self.prefetcher.fetch(self.async_dao, 'test_images', 'image_metadata_from_dataset', dataset, False,
+                              callback=self.__show_test_images, filters=self.ALL_IMAGES)
+
+        self.__ingest_failures = []
+        if not self.__feature_table_available:
+            self.__stream_training_data(dataset)
+            return
+
+        # déterminants précalculés (voir populate_features) : quelques kilooctets au lieu des images ;
+        # s'il en manque, les images d'entrainement sont lues et traitées ici
+        def load(features):
+            if features is None:
+                self.__feature_table_available = False
+            if features is None or len(features) == 0 or (training_image_count is not None
+                                                          and len(features) != training_image_count):
+                self.__stream_training_data(dataset)
+                return
+            self.knn.add_points(list(features['label']), features['features'])
+            self.training_data_changed.emit()
+
+        def unavailable(error):
+            self.__feature_table_available = False
+            self.__stream_training_data(dataset)
+
+        self.async_dao.call('training', 'features_from_dataset', dataset, True, self.feature_ingest.extractor_version,
+                            callback=load, error_callback=unavailable, filters=self.ALL_IMAGES)
+
+    def __stream_training_data(self, dataset):
+        # les images d'entrainement sont lues et traitées dans un fil de travail, puis ajoutées au KNN
+        # paquet par paquet dans le fil de l'interface : on peut classifier avant la fin du chargement.
+        # Choisir un autre jeu de données annule le chargement en cours.
+        def stream(dao, filters):
+            return self.feature_ingest.stream(dao.iter_image_from_dataset(dataset, True, filters=filters))
+
+        self.async_dao.iterate('training', stream,
+                               item_callback=self.__add_training_data,
+                               done_callback=self.__training_done,
+                               error_callback=self.__training_failed,
+                               filters=self.ALL_IMAGES)
+
+    def __show_test_images(self, test_images):
+        self.single_test_widget.img_search_bar.clear()
+        for i, img in enumerate(test_images or [], 1):
             item = img[3] #img[3]: image_id
             self.single_test_widget.img_search_bar.insert_item(i, item, img)
-        
-       
-        [self.knn.add_point(imp.ImageProcessor.get_shape(img[1], qimage_argb32_from_png_decoding(img[6]))) for img in training_images]  
-       
+
+    def __add_training_data(self, ingest):
+        self.knn.add_points(ingest.labels, ingest.features)
+        self.__ingest_failures += ingest.failures
+        self.training_data_changed.emit()
+
+    def __training_done(self):
+        if self.__ingest_failures:
+            QMessageBox.warning(self, 'Images ignorées',
+                                f'{len(self.__ingest_failures)} image(s) d\'entrainement ignorée(s) :\n'
+                                + '\n'.join(f'{failure.image_id} : {failure.message}'
+                                            for failure in self.__ingest_failures[:10]))
+
+    def __training_failed(self, error):
+        QMessageBox.warning(self, 'Chargement interrompu',
+                            f'Le chargement des images d\'entrainement a échoué :\n{type(error).__name__}: {error}')
 
     def get_knn(self):
         return self.knn
\ No newline at end of file